@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+MusicGen Load Generator
+Drives musicgen_server.py, musicgen_server_mock.py or the Modal app with a
+reproducible mix of prompts built from the frontend's genre and instrument
+vocabularies, and reports latency percentiles, throughput, RTF and errors.
+
+Closed loop keeps --concurrency requests in flight; open loop sends Poisson
+arrivals at --rate requests/second whether or not earlier requests finished.
+
+Usage:
+    # Against a running server
+    python benchmark_load.py --url http://localhost:8000 --concurrency 4 --requests 40
+    python benchmark_load.py --url https://you--tunestory-musicgen-fastapi-app.modal.run --target modal --rate 0.5 --run-seconds 120
+
+    # CPU-only: start the real server on a tiny random MusicGen and load-test it
+    python benchmark_load.py --launch tiny --concurrency 8 --requests 64 --json results.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+GENRE_OPTIONS = os.path.join(REPO_DIR, "src", "lib", "genreOptions.ts")
+INSTRUMENT_OPTIONS = os.path.join(REPO_DIR, "src", "lib", "instrumentOptions.ts")
+
+# Generation endpoint per target; the Modal app serves it at the root
+TARGET_PATHS = {"server": "/generate", "mock": "/generate", "modal": "/"}
+# Server modules started by --launch
+LAUNCH_MODULES = {"server": "musicgen_server", "tiny": "musicgen_server", "mock": "musicgen_server_mock"}
+# The real server preloads models in the background and reports on /ready once they are warm
+LAUNCH_PROBES = {"server": "/ready", "tiny": "/ready", "mock": "/health"}
+
+
+def load_vocabulary():
+    """Read genre labels, their energy fits and instrument phrases from the frontend sources"""
+    with open(GENRE_OPTIONS) as f:
+        genre_source = f.read()
+    with open(INSTRUMENT_OPTIONS) as f:
+        instrument_source = f.read()
+
+    # Only the GENRES record; later exports reuse the same keys
+    genre_block = genre_source.split("export const GENRES", 1)[1].split("\n};", 1)[0]
+    genres = [
+        (label, re.findall(r"'(\w+)'", energy_fit))
+        for label, energy_fit in re.findall(r"label: '([^']+)',.*?energyFit: \[([^\]]*)\]", genre_block, re.S)
+    ]
+    instruments = re.findall(r"promptPhrase: '([^']+)'", instrument_source)
+    if not genres or not instruments:
+        raise ValueError("Could not read genre/instrument vocabularies from src/lib")
+    return genres, instruments
+
+
+def parse_mix(spec: str, cast):
+    """Parse "5:0.6,10:0.3,30:0.1" into ([values], [weights])"""
+    values, weights = [], []
+    for part in spec.split(","):
+        value, _, weight = part.partition(":")
+        values.append(cast(value))
+        weights.append(float(weight or 1))
+    return values, weights
+
+
+def build_workload(args, count: int):
+    """Pre-draw every request body so a given --seed always replays the same workload"""
+    genres, instruments = load_vocabulary()
+    durations, duration_weights = parse_mix(args.durations, int)
+    models, model_weights = parse_mix(args.models, str)
+    rng = random.Random(args.seed)
+
+    workload = []
+    for index in range(count):
+        genre, energy_fit = rng.choice(genres)
+        # Same shape as buildMusicGenPrompt(): genre, instruments joined with "with", energy
+        phrases = rng.sample(instruments, rng.randint(1, args.max_instruments))
+        prompt = f"{genre.lower()}, with {' with '.join(phrases)}, {rng.choice(energy_fit or ['Medium']).lower()} energy, high quality production"
+        model = rng.choices(models, model_weights)[0]
+        body = {
+            "prompt": prompt,
+            "duration": rng.choices(durations, duration_weights)[0],
+            "temperature": round(rng.uniform(args.min_temperature, args.max_temperature), 2),
+            "model_size": model,
+            "model": model,
+        }
+        if args.request_seeds:
+            body["seed"] = index
+        workload.append(body)
+    return workload
+
+
+async def send(client: httpx.AsyncClient, path: str, body: dict) -> dict:
+    """Issue one generation request and return its measurement"""
+    start = time.perf_counter()
+    result = {"duration": body["duration"], "model": body["model"], "status": None, "error": None}
+    try:
+        response = await client.post(path, json=body)
+        result["status"] = response.status_code
+        if response.status_code != 200:
+            result["error"] = f"HTTP {response.status_code}"
+        else:
+            data = response.json()
+            # Local servers nest metadata; the Modal app returns it flat
+            metadata = data.get("metadata", data)
+            if not data.get("success", False):
+                result["error"] = data.get("error") or "success=false"
+            result["server_seconds"] = metadata.get("generation_time_seconds")
+            result["server_rtf"] = metadata.get("real_time_factor")
+            result["batch_size"] = metadata.get("batch_size")
+            result["cache"] = metadata.get("cache")
+    except httpx.HTTPError as e:
+        result["error"] = type(e).__name__
+    result["latency"] = time.perf_counter() - start
+    return result
+
+
+async def closed_loop(client, path, workload, concurrency: int):
+    """concurrency workers each send their next request as soon as the previous one returns"""
+    results = []
+    pending = iter(workload)
+
+    async def worker():
+        for body in pending:
+            results.append(await send(client, path, body))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+async def open_loop(client, path, workload, rate: float, seed: int):
+    """Send requests at Poisson arrival times regardless of how many are outstanding"""
+    rng = random.Random(seed + 1)
+    start = time.perf_counter()
+    arrival = 0.0
+    tasks = []
+    for body in workload:
+        arrival += rng.expovariate(rate)
+        delay = start + arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(client, path, body)))
+    return await asyncio.gather(*tasks)
+
+
+def percentile(values, fraction: float) -> float:
+    """Nearest-rank percentile: the smallest value with at least that fraction of values at or below it"""
+    ordered = sorted(values)
+    # Rounded first so float error like 0.07 * 100 = 7.000000000000001 doesn't bump the rank
+    rank = math.ceil(round(fraction * len(ordered), 9))
+    return ordered[min(len(ordered) - 1, max(0, rank - 1))]
+
+
+def summarize(results, wall_seconds: float) -> dict:
+    """Aggregate per-request measurements into the report"""
+    ok = [r for r in results if r["error"] is None]
+    latencies = [r["latency"] for r in ok]
+    errors = {}
+    for r in results:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+
+    summary = {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors": errors,
+        "wall_seconds": round(wall_seconds, 2),
+        "throughput_rps": round(len(ok) / wall_seconds, 3),
+        "audio_seconds_per_second": round(sum(r["duration"] for r in ok) / wall_seconds, 3),
+    }
+    if latencies:
+        summary["latency_seconds"] = {
+            "p50": round(percentile(latencies, 0.50), 3),
+            "p95": round(percentile(latencies, 0.95), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+            "mean": round(statistics.mean(latencies), 3),
+            "max": round(max(latencies), 3),
+        }
+        # Client-side RTF includes queueing and transfer; server RTF is the model alone
+        summary["client_rtf_p50"] = round(percentile([r["duration"] / r["latency"] for r in ok], 0.50), 3)
+        server_rtfs = [r["server_rtf"] for r in ok if r.get("server_rtf")]
+        if server_rtfs:
+            summary["server_rtf_p50"] = round(percentile(server_rtfs, 0.50), 3)
+        batch_sizes = [r["batch_size"] for r in ok if r.get("batch_size")]
+        if batch_sizes:
+            summary["mean_batch_size"] = round(statistics.mean(batch_sizes), 2)
+        cache_hits = sum(1 for r in ok if r.get("cache") == "hit")
+        if cache_hits:
+            summary["cache_hits"] = cache_hits
+    return summary
+
+
+def print_report(summary: dict, args):
+    mode = f"closed loop x{args.concurrency}" if args.rate is None else f"open loop @ {args.rate} req/s"
+    print(f"\n📊 {summary['requests']} requests, {mode}, {summary['wall_seconds']}s")
+    print(f"   Succeeded: {summary['succeeded']}  Error rate: {summary['error_rate'] * 100:.1f}%")
+    for error, count in summary["errors"].items():
+        print(f"   ❌ {error}: {count}")
+    if "latency_seconds" in summary:
+        latency = summary["latency_seconds"]
+        print(f"   Latency p50/p95/p99: {latency['p50']}s / {latency['p95']}s / {latency['p99']}s (max {latency['max']}s)")
+        print(f"   Throughput: {summary['throughput_rps']} req/s, {summary['audio_seconds_per_second']} audio s/s")
+        print(f"   RTF p50: client {summary['client_rtf_p50']}, server {summary.get('server_rtf_p50', 'n/a')}")
+        if "mean_batch_size" in summary:
+            print(f"   Mean batch size: {summary['mean_batch_size']}")
+
+
+def launch_server(kind: str, port: int):
+    """Start a local server in a subprocess and wait until it reports ready"""
+    env = dict(os.environ)
+    if kind == "tiny":
+        env["MUSICGEN_TINY_MODEL"] = "1"
+        env["CUDA_VISIBLE_DEVICES"] = ""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{LAUNCH_MODULES[kind]}:app", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_DIR,
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{kind} server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"{url}{LAUNCH_PROBES[kind]}", timeout=1).status_code == 200:
+                print(f"🚀 Launched {kind} server on {url}")
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"{kind} server did not become ready")
+
+
+async def run(args, url: str) -> dict:
+    path = TARGET_PATHS[args.target]
+    count = args.requests if args.rate is None else max(1, int(args.rate * args.run_seconds))
+    workload = build_workload(args, args.warmup + count)
+
+    async with httpx.AsyncClient(base_url=url, timeout=args.timeout) as client:
+        # Warm-up pays for model loading outside the measured window
+        for body in workload[:args.warmup]:
+            await send(client, path, body)
+
+        start = time.perf_counter()
+        if args.rate is None:
+            results = await closed_loop(client, path, workload[args.warmup:], args.concurrency)
+        else:
+            results = await open_loop(client, path, workload[args.warmup:], args.rate, args.seed)
+        wall_seconds = time.perf_counter() - start
+
+        summary = summarize(results, wall_seconds)
+        try:
+            summary["server_stats"] = (await client.get("/stats")).json()
+        except (httpx.HTTPError, ValueError):
+            pass
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the MusicGen generation servers")
+    parser.add_argument("--url", default="http://localhost:8000", help="Server base URL (ignored with --launch)")
+    parser.add_argument("--target", choices=list(TARGET_PATHS), default="server")
+    parser.add_argument("--launch", choices=list(LAUNCH_MODULES), help="Start a local server first; 'tiny' runs the real server on a random CPU model")
+    parser.add_argument("--port", type=int, default=8765, help="Port for --launch")
+    parser.add_argument("--concurrency", type=int, default=4, help="Closed loop: requests kept in flight")
+    parser.add_argument("--requests", type=int, default=40, help="Closed loop: measured requests")
+    parser.add_argument("--rate", type=float, help="Open loop: mean arrivals per second (enables open loop)")
+    parser.add_argument("--run-seconds", type=float, default=60, help="Open loop: length of the arrival schedule")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured requests sent first")
+    parser.add_argument("--durations", default="5:0.5,10:0.3,30:0.2", help="Duration mix as seconds:weight,...")
+    parser.add_argument("--models", default="small", help="Model mix as size:weight,...")
+    parser.add_argument("--min-temperature", type=float, default=0.8)
+    parser.add_argument("--max-temperature", type=float, default=1.2)
+    parser.add_argument("--max-instruments", type=int, default=3)
+    parser.add_argument("--request-seeds", action="store_true", help="Send a per-request seed (exercises the generation cache, disables batching)")
+    parser.add_argument("--seed", type=int, default=0, help="Workload seed")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--json", help="Write the summary to this file")
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    if args.launch:
+        args.target = "mock" if args.launch == "mock" else "server"
+        process, url = launch_server(args.launch, args.port)
+    try:
+        summary = asyncio.run(run(args, url))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print_report(summary, args)
+    if args.json:
+        summary["config"] = vars(args)
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"💾 Wrote {args.json}")
+
+    # Non-zero exit lets CI runs fail on errors
+    sys.exit(1 if summary["error_rate"] > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Modal runtime, for running modal_musicgen.py without deploying.
+
+Installs a stub `modal` module before modal_musicgen is imported, then serves its
+FastAPI front end with uvicorn. Containers are emulated in-process: every parameter set
+of a class (e.g. MusicGenModel(model_size="small")) gets its own pool of up to
+MODAL_LOCAL_CONTAINERS instances, each started with its @enter methods and running one
+call at a time on a thread. .remote/.remote.aio, .spawn/.spawn.aio, .map/.map.aio,
+FunctionCall.from_id and Dict.from_name behave like their Modal counterparts, so the
+per-size routing, async calls and batch fan-out can be exercised locally.
+
+Usage:
+    python modal_local.py              # serves on http://localhost:8001
+    MODAL_LOCAL_PORT=9000 python modal_local.py
+
+Needs torch and audiocraft installed locally, like musicgen_server.py.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import types
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# Instances of one class and parameter set that may run calls at the same time
+LOCAL_CONTAINERS = int(os.environ.get("MODAL_LOCAL_CONTAINERS", "2"))
+LOCAL_PORT = int(os.environ.get("MODAL_LOCAL_PORT", "8001"))
+
+# Threads that run container calls and spawned calls
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="modal-local")
+_calls = {}  # call id -> future of a spawned call
+
+
+class _Dual:
+    """A blocking callable with an awaitable .aio twin, like Modal's method handles"""
+
+    def __init__(self, fn):
+        self._fn = fn
+
+    def __call__(self, *args, **kwargs):
+        return self._fn(*args, **kwargs)
+
+    async def aio(self, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(_executor, lambda: self._fn(*args, **kwargs))
+
+
+class _Pool:
+    """Emulated containers of one class and parameter set"""
+
+    def __init__(self, user_cls, params: dict, options: dict):
+        self.user_cls = user_cls
+        self.params = params
+        self.options = options
+        self._idle = []
+        self._started = 0
+        self._ready = threading.Condition()
+
+    def _start(self):
+        instance = self.user_cls.__new__(self.user_cls)
+        for name, value in self.params.items():
+            setattr(instance, name, value)
+        label = ", ".join(f"{name}={value!r}" for name, value in self.params.items())
+        print(f"🐳 Starting local container {self.user_cls.__name__}({label}) {self.options or ''}")
+        for attribute in vars(self.user_cls).values():
+            if getattr(attribute, "_modal_enter", False):
+                attribute(instance)
+        return instance
+
+    def run(self, method: str, args: tuple, kwargs: dict):
+        with self._ready:
+            while not self._idle and self._started >= LOCAL_CONTAINERS:
+                self._ready.wait()
+            instance = self._idle.pop() if self._idle else None
+            if instance is None:
+                self._started += 1
+        try:
+            if instance is None:
+                instance = self._start()
+            return getattr(instance, method)(*args, **kwargs)
+        except BaseException:
+            if instance is None:
+                with self._ready:
+                    self._started -= 1
+                    self._ready.notify()
+            raise
+        finally:
+            if instance is not None:
+                with self._ready:
+                    self._idle.append(instance)
+                    self._ready.notify()
+
+
+class _FunctionCall:
+    def __init__(self, object_id: str):
+        self.object_id = object_id
+        self.get = _Dual(self._get)
+
+    @staticmethod
+    def from_id(object_id: str):
+        return _FunctionCall(object_id)
+
+    def _get(self, timeout: float = None):
+        try:
+            return _calls[self.object_id].result(timeout=timeout)
+        except FutureTimeoutError:
+            # Modal raises the builtin TimeoutError, which this isn't before Python 3.11
+            raise TimeoutError(self.object_id)
+
+
+class _Method:
+    """Handle on one @modal.method of a parameterized instance"""
+
+    def __init__(self, pool: _Pool, name: str):
+        self.remote = _Dual(lambda *args, **kwargs: pool.run(name, args, kwargs))
+        self.spawn = _Dual(self._spawn)
+        self.map = _Dual(self._map)
+        self.map.aio = self._map_aio
+        self._pool = pool
+        self._name = name
+
+    def _spawn(self, *args, **kwargs):
+        object_id = f"fc-{uuid.uuid4().hex}"
+        _calls[object_id] = _executor.submit(self._pool.run, self._name, args, kwargs)
+        return _FunctionCall(object_id)
+
+    def _map(self, *iterables, return_exceptions: bool = False):
+        futures = [_executor.submit(self._pool.run, self._name, args, {}) for args in zip(*iterables)]
+        for future in futures:
+            try:
+                yield future.result()
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                yield e
+
+    async def _map_aio(self, *iterables, return_exceptions: bool = False):
+        loop = asyncio.get_running_loop()
+        futures = [
+            loop.run_in_executor(_executor, self._pool.run, self._name, args, {})
+            for args in zip(*iterables)
+        ]
+        for future in futures:
+            try:
+                yield await future
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                yield e
+
+
+class _Instance:
+    def __init__(self, pool: _Pool):
+        for name, attribute in vars(pool.user_cls).items():
+            if getattr(attribute, "_modal_method", False):
+                setattr(self, name, _Method(pool, name))
+
+
+class _Cls:
+    """What @app.cls returns: call it with parameters for a handle on that pool"""
+
+    def __init__(self, user_cls, options: dict, pools: dict):
+        self.user_cls = user_cls
+        self.options = options
+        self._pools = pools  # (options, params) -> _Pool, shared across with_options()
+
+    def with_options(self, **options):
+        return _Cls(self.user_cls, {**self.options, **options}, self._pools)
+
+    def __call__(self, **params):
+        defaults = {
+            name: value.default
+            for name, value in vars(self.user_cls).items()
+            if isinstance(value, _Parameter)
+        }
+        params = {**defaults, **params}
+        key = (tuple(sorted(self.options.items())), tuple(sorted(params.items())))
+        if key not in self._pools:
+            self._pools[key] = _Pool(self.user_cls, params, self.options)
+        return _Instance(self._pools[key])
+
+
+class _Parameter:
+    def __init__(self, default=None):
+        self.default = default
+
+
+class _Dict:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self.get = _Dual(self._get)
+        self.put = _Dual(self._put)
+        self.pop = _Dual(self._pop)
+
+    @staticmethod
+    def from_name(name: str, create_if_missing: bool = False):
+        return _dicts.setdefault(name, _Dict())
+
+    def _get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def _put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def _pop(self, key):
+        with self._lock:
+            return self._data.pop(key)
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._put(key, value)
+
+
+_dicts = {}
+
+
+class _Image:
+    """Image builder; every build step is a no-op locally"""
+
+    @classmethod
+    def debian_slim(cls, **kwargs):
+        return cls()
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+
+class _App:
+    def __init__(self, name: str, image=None):
+        self.name = name
+
+    def cls(self, **options):
+        return lambda user_cls: _Cls(user_cls, {}, {})
+
+    def function(self, **options):
+        return lambda fn: fn
+
+
+def _enter():
+    def mark(fn):
+        fn._modal_enter = True
+        return fn
+    return mark
+
+
+def _method():
+    def mark(fn):
+        fn._modal_method = True
+        return fn
+    return mark
+
+
+def install():
+    """Put the stub in sys.modules as `modal`; call before importing modal_musicgen"""
+    stub = types.ModuleType("modal")
+    stub.App = _App
+    stub.Image = _Image
+    stub.Dict = _Dict
+    stub.FunctionCall = _FunctionCall
+    stub.parameter = _Parameter
+    stub.enter = _enter
+    stub.method = _method
+    stub.asgi_app = lambda: (lambda fn: fn)
+    sys.modules["modal"] = stub
+    return stub
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    install()
+    import modal_musicgen
+
+    print(f"Starting local Modal stand-in on http://localhost:{LOCAL_PORT}")
+    print(f"Containers: up to {LOCAL_CONTAINERS} per model size, started on first use")
+    uvicorn.run(modal_musicgen.fastapi_app(), host="0.0.0.0", port=LOCAL_PORT)
@@ -8,14 +8,23 @@ Usage:
 Then call the endpoint:
     POST https://your-username--tunestory-musicgen-generate-music.modal.run
     Body: {"prompt": "upbeat electronic music", "duration": 30, "temperature": 1.0}
+
+Several requests at once, fanned out over the container pools:
+    POST .../batch
+    Body: {"requests": [{"prompt": "..."}, {"prompt": "...", "model": "medium"}]}
+
+To run the front end and containers locally without deploying:
+    python modal_local.py
 """
 
 import modal
 from modal import enter
-import io
 import base64
+from collections import OrderedDict
 from typing import Optional
 
+from musicgen_common import AUDIO_FORMATS, ConditioningCache, Crossfader, encode_audio
+
 # Note: torch, torchaudio, and audiocraft are only imported inside functions
 # that run on Modal's containers, not at module level
 
@@ -48,41 +57,262 @@ image = (
     .pip_install(
         "fastapi",
         "pydantic",
+        "prometheus_client",
     )
+    # Helpers shared with musicgen_server.py; Modal adds local files when containers start,
+    # so this has to stay the last step
+    .add_local_python_source("musicgen_common")
 )
 
 app = modal.App("tunestory-musicgen", image=image)
 
+# Job API: spawned calls are tracked here so any web container can report on them
+job_state = modal.Dict.from_name("tunestory-musicgen-jobs", create_if_missing=True)
+# Jobs that finished longer ago than this are reported as expired
+JOB_RETENTION_SECONDS = 3600
+# Most requests one POST /batch may fan out
+BATCH_MAX_REQUESTS = 16
+
+# Every model size gets its own pool of containers, which load that size's weights once
+# when they start. GPU per size: large (~14 GB resident with T5 and EnCodec) doesn't fit
+# a 16 GB T4 alongside its activations, so it runs on an A10G
+MODEL_SIZES = ["small", "medium", "large", "melody"]
+MODEL_GPUS = {"small": "T4", "medium": "T4", "large": "A10G", "melody": "T4"}
+
+# Long-form generation: durations above LONG_FORM_WINDOW_SECONDS (up to LONG_FORM_MAX_SECONDS)
+# are rendered as overlapping windows, each continuing from the last LONG_FORM_CONTEXT_SECONDS
+# of codes, and the decoded windows are cross-faded over LONG_FORM_CROSSFADE_SECONDS
+LONG_FORM_MAX_SECONDS = 180
+LONG_FORM_WINDOW_SECONDS = 30
+LONG_FORM_CONTEXT_SECONDS = 10
+LONG_FORM_CROSSFADE_SECONDS = 0.25
+# Each window must add new audio beyond its context, and more of it than the cross-fade
+# eats, or _generate_long never reaches the requested duration
+if not 0 <= LONG_FORM_CONTEXT_SECONDS < LONG_FORM_WINDOW_SECONDS:
+    raise ValueError("LONG_FORM_CONTEXT_SECONDS must be at least 0 and below LONG_FORM_WINDOW_SECONDS")
+if not 0 <= LONG_FORM_CROSSFADE_SECONDS < LONG_FORM_WINDOW_SECONDS - LONG_FORM_CONTEXT_SECONDS:
+    raise ValueError("LONG_FORM_CROSSFADE_SECONDS must be at least 0 and below the window minus its context")
+
+# Text-conditioning cache: T5 embeddings per (model size, normalised prompt), kept on CPU
+CONDITIONING_CACHE_MB = 64
+
+
 # Use GPU for faster inference
 # T4 GPU is cost-effective, A10G is faster but more expensive
 @app.cls(
-    gpu="T4",  # Switch to "A10G" for faster inference if needed
+    gpu="T4",  # Default; model_container() overrides it per size from MODEL_GPUS
     scaledown_window=300,  # Keep container warm for 5 min (reduces cold starts)
-    timeout=120,  # 2 min timeout per request
+    timeout=600,  # 10 min per request, enough for a LONG_FORM_MAX_SECONDS track
 )
 class MusicGenModel:
     """
-    MusicGen model container that loads the model once and reuses it.
-    This improves performance by avoiding reloading on every request.
+    MusicGen container for one model size, parameterized by model_size.
+    
+    Modal keeps a separate container pool per parameter value, so each size is loaded once
+    when its container starts and requests for other sizes never swap weights here.
     """
     
+    model_size: str = modal.parameter(default="small")
+    
     @enter()
     def load_model(self):
-        """Load model when container starts - will be reloaded per request if needed"""
-        # Model will be loaded dynamically based on request
-        self.model = None
-        self.current_model_size = None
-        print("✅ Model container ready (will load on first request)")
-    
-    def _load_model_if_needed(self, model_size: str):
-        """Load model if not already loaded or if different model is requested"""
+        """Load this container's model size when it starts"""
+        import time
         from audiocraft.models import MusicGen
         
-        if self.model is None or self.current_model_size != model_size:
-            print(f"🔄 Loading MusicGen model: {model_size}...")
-            self.model = MusicGen.get_pretrained(f'facebook/musicgen-{model_size}')
-            self.current_model_size = model_size
-            print(f"✅ Model {model_size} loaded successfully!")
+        if self.model_size not in MODEL_SIZES:
+            raise ValueError(f"Invalid model. Must be one of: {MODEL_SIZES}")
+        
+        started = time.time()
+        print(f"🔄 Loading MusicGen model: {self.model_size}...")
+        self.model = MusicGen.get_pretrained(f'facebook/musicgen-{self.model_size}')
+        self.conditioning_cache = ConditioningCache(int(CONDITIONING_CACHE_MB * 1024**2))
+        self.conditioning_cache.install(self.model, self.model_size)
+        self.model_bytes = sum(
+            tensor.numel() * tensor.element_size()
+            for module in (self.model.lm, self.model.compression_model)
+            for tensor in list(module.parameters()) + list(module.buffers())
+        )
+        self.load_seconds = round(time.time() - started, 3)
+        self.diffusion_decoder = None  # MultiBand Diffusion, loaded on first use
+        print(f"✅ Model {self.model_size} loaded in {self.load_seconds}s")
+    
+    def _decode(self, tokens, decoder: str):
+        """Decode [batch, codebooks, frames] tokens with EnCodec or MultiBand Diffusion"""
+        if decoder != "multiband_diffusion":
+            return self.model.generate_audio(tokens)
+        if self.diffusion_decoder is None:
+            from audiocraft.models import MultiBandDiffusion
+            print("📥 Loading MultiBand Diffusion decoder...")
+            self.diffusion_decoder = MultiBandDiffusion.get_mbd_musicgen()
+        return self.diffusion_decoder.tokens_to_wav(tokens)
+    
+    def _generate(self, prompts: list, decoder: str, timings: Optional[dict] = None, progress: bool = False):
+        """MusicGen.generate() with the decode step swappable for MultiBand Diffusion"""
+        import time
+        
+        stage_start = time.time()
+        attributes, prompt_tokens = self.model._prepare_tokens_and_attributes(prompts, None)
+        # The custom progress callback is only invoked with progress on
+        tokens = self.model._generate_tokens(attributes, prompt_tokens, progress)
+        if timings is not None:
+            timings["token_generation_seconds"] = round(time.time() - stage_start, 3)
+        stage_start = time.time()
+        wav = self._decode(tokens, decoder)
+        if timings is not None:
+            timings["decode_seconds"] = round(time.time() - stage_start, 3)
+        return wav
+    
+    def _generate_long(self, prompt: str, duration: int, temperature: float, decoder: str, on_progress=None):
+        """
+        Render a track longer than one LM window, returns ([channels, samples] wav, window timings).
+        
+        The first window is sampled from the prompt alone; each later one is prompted with
+        the last LONG_FORM_CONTEXT_SECONDS of codes and adds the rest of a window, so LM
+        memory and per-step cost stay those of a single window. Each window's new codes are
+        decoded with a short lead-in of earlier codes and cross-faded into the previous one.
+        """
+        import time
+        import torch
+        
+        frame_rate = self.model.frame_rate
+        samples_per_frame = int(self.model.sample_rate / frame_rate)
+        window_frames = int(LONG_FORM_WINDOW_SECONDS * frame_rate)
+        context_frames = int(LONG_FORM_CONTEXT_SECONDS * frame_rate)
+        fade_frames = max(1, round(LONG_FORM_CROSSFADE_SECONDS * frame_rate))
+        total_frames = int(duration * frame_rate)
+        crossfader = Crossfader(fade_frames * samples_per_frame)
+        codes = None
+        parts = []
+        windows = []
+        
+        while codes is None or codes.shape[-1] < total_frames:
+            produced = 0 if codes is None else codes.shape[-1]
+            context = None if codes is None else codes[..., -context_frames:]
+            context_length = 0 if context is None else context.shape[-1]
+            seconds = min(total_frames - produced, window_frames - context_length) / frame_rate
+            self.model.set_generation_params(duration=context_length / frame_rate + seconds, temperature=temperature)
+            
+            stage_start = time.time()
+            attributes, _ = self.model._prepare_tokens_and_attributes([prompt], None)
+            new_codes = self.model._generate_tokens(attributes, context, False)[..., context_length:]
+            lm_seconds = time.time() - stage_start
+            
+            lead = min(2 * fade_frames, produced)
+            decode_input = new_codes if codes is None else torch.cat([codes[..., produced - lead:], new_codes], dim=-1)
+            codes = new_codes if codes is None else torch.cat([codes, new_codes], dim=-1)
+            stage_start = time.time()
+            wav = self._decode(decode_input, decoder)[0].cpu()
+            parts.append(crossfader.push(wav, lead * samples_per_frame, last=codes.shape[-1] >= total_frames))
+            windows.append({
+                "index": len(windows),
+                "start_seconds": round(produced / frame_rate, 3),
+                "seconds": round(new_codes.shape[-1] / frame_rate, 3),
+                "context_seconds": round(context_length / frame_rate, 3),
+                "lm_seconds": round(lm_seconds, 3),
+                "decode_seconds": round(time.time() - stage_start, 3),
+            })
+            print(f"   🪟 Window {len(windows) - 1}: {windows[-1]['seconds']}s in {windows[-1]['lm_seconds']}s")
+            if on_progress is not None:
+                on_progress(codes.shape[-1], total_frames)
+        
+        return torch.cat(parts, dim=-1), windows
+    
+    @modal.method()
+    def generate_variations(
+        self,
+        prompts: list,
+        temperatures: list,
+        duration: int = 30,
+        decoder: str = "default",
+        seed: Optional[int] = None,
+        format: str = "wav"
+    ) -> dict:
+        """
+        Generate one variation per (prompt, temperature) pair in batched forward passes.
+        
+        MusicGen samples a whole batch at one temperature, so variations are grouped by
+        temperature and each group is a single generate() call. A seed makes the set
+        reproducible as a unit (group i is seeded with seed + i).
+        
+        Returns:
+            Dictionary with success status, per-variation base64 audio, and metadata
+        """
+        import torch
+        import time
+        
+        start_time = time.time()
+        
+        if len(prompts) != len(temperatures):
+            raise ValueError("prompts and temperatures must have the same length")
+        
+        groups = OrderedDict()  # temperature -> variation indices
+        for index, temperature in enumerate(temperatures):
+            groups.setdefault(temperature, []).append(index)
+        
+        print(f"🎵 Generating {len(prompts)} variations in {len(groups)} batch(es)...")
+        
+        variations = [None] * len(prompts)
+        for group_index, (temperature, indices) in enumerate(groups.items()):
+            group_seed = None if seed is None else seed + group_index
+            if group_seed is not None:
+                torch.manual_seed(group_seed)
+            self.model.set_generation_params(duration=duration, temperature=temperature)
+            
+            with torch.no_grad():
+                wav = self._generate([prompts[i] for i in indices], decoder)
+            
+            for row, i in enumerate(indices):
+                audio_bytes = encode_audio(wav[row].cpu(), self.model.sample_rate, format)
+                variations[i] = {
+                    "index": i,
+                    "prompt": prompts[i],
+                    "temperature": temperature,
+                    "seed": group_seed,
+                    "audio_base64": base64.b64encode(audio_bytes).decode('utf-8'),
+                    "size_bytes": len(audio_bytes),
+                }
+        
+        generation_time = time.time() - start_time
+        print(f"✅ Variations complete in {generation_time:.2f}s")
+        
+        return {
+            "success": True,
+            "variations": variations,
+            "model": self.model_size,
+            "decoder": decoder,
+            "duration": duration,
+            "seed": seed,
+            "count": len(prompts),
+            "generate_calls": len(groups),
+            "sample_rate": self.model.sample_rate,
+            "generation_time_seconds": round(generation_time, 2),
+            "format": format
+        }
+    
+    def _job_progress_callback(self, job_id: str):
+        """Progress callback that publishes to job_state in 5% steps to keep Dict writes cheap"""
+        last_published = [-1]
+        
+        def callback(generated_tokens: int, total_tokens: int):
+            percent = int(100 * generated_tokens / total_tokens) if total_tokens else 0
+            if percent - last_published[0] >= 5 or generated_tokens == total_tokens:
+                last_published[0] = percent
+                job_state[f"progress:{job_id}"] = percent
+        
+        job_state[f"progress:{job_id}"] = 0
+        return callback
+    
+    @modal.method()
+    def stats(self) -> dict:
+        """Report this container's model and what it costs"""
+        return {
+            "model_size": self.model_size,
+            "memory_gb": round(self.model_bytes / 1024**3, 2),
+            "load_seconds": self.load_seconds,
+            "diffusion_decoder_loaded": self.diffusion_decoder is not None,
+            "conditioning_cache": self.conditioning_cache.stats(),
+        }
     
     @modal.method()
     def generate(
@@ -90,35 +320,34 @@ class MusicGenModel:
         prompt: str, 
         duration: int = 30,
         temperature: float = 1.0,
-        model: str = "small",
-        decoder: str = "default"
+        decoder: str = "default",
+        seed: Optional[int] = None,
+        format: str = "wav",
+        binary: bool = False,
+        job_id: Optional[str] = None
     ) -> dict:
         """
-        Generate music from text prompt and return base64-encoded WAV.
+        Generate music from text prompt and return the encoded audio.
         
         Args:
             prompt: Text description of the music to generate
-            duration: Length of audio in seconds (1-30)
+            duration: Length of audio in seconds (1-30, up to LONG_FORM_MAX_SECONDS in windows)
             temperature: Controls randomness (0.1-2.0), higher = more creative
-            model: Model size ('small', 'medium', 'large', 'melody')
             decoder: Decoder type ('default' or 'multiband_diffusion')
+            seed: Optional sampling seed so the same request renders the same audio
+            format: Audio format ('wav', 'flac', 'opus', 'mp3')
+            binary: Return raw bytes under "audio_bytes" instead of "audio_base64"
+            job_id: When spawned through /jobs, progress is published under this id
         
         Returns:
-            Dictionary with success status, base64 audio, and metadata
+            Dictionary with success status, audio, and metadata
         """
         import torch
-        import torchaudio
         import time
         
         start_time = time.time()
-        
-        # Validate model
-        valid_models = ['small', 'medium', 'large', 'melody']
-        if model not in valid_models:
-            raise ValueError(f"Invalid model. Must be one of: {valid_models}")
-        
-        # Load model if needed
-        self._load_model_if_needed(model)
+        # The model was loaded when the container started
+        timings = {}
         
         # Set generation parameters
         self.model.set_generation_params(
@@ -126,60 +355,79 @@ class MusicGenModel:
             temperature=temperature
         )
         
-        use_multiband = decoder == "multiband_diffusion"
+        if seed is not None:
+            torch.manual_seed(seed)
         
         print(f"🎵 Generating music...")
         print(f"   Prompt: {prompt}")
-        print(f"   Model: {model}")
+        print(f"   Model: {self.model_size}")
         print(f"   Decoder: {decoder}")
         print(f"   Duration: {duration}s")
         print(f"   Temperature: {temperature}")
         
-        # Generate audio
-        # Note: MultiBand Diffusion decoder support requires additional AudioCraft setup
-        # The standard MusicGen.generate() uses the default decoder
-        # For full MultiBand Diffusion support, you may need to:
-        # 1. Use MusicGen's extended API with decoder parameter
-        # 2. Or apply MultiBand Diffusion as a post-processing step
-        # For now, we log the preference but use standard generation
+        # Generate tokens with the LM, then decode them with the requested decoder
+        windows = None
         with torch.no_grad():
-            if use_multiband:
-                print("   ⚠️ MultiBand Diffusion requested but using default decoder")
-                print("   Note: Full MultiBand Diffusion support may require AudioCraft API updates")
-            wav = self.model.generate([prompt])
+            stage_start = time.time()
+            if duration > LONG_FORM_WINDOW_SECONDS:
+                on_progress = self._job_progress_callback(job_id) if job_id is not None else None
+                audio_tensor, windows = self._generate_long(prompt, duration, temperature, decoder, on_progress)
+                timings["token_generation_seconds"] = round(sum(window["lm_seconds"] for window in windows), 3)
+                timings["decode_seconds"] = round(sum(window["decode_seconds"] for window in windows), 3)
+            else:
+                if job_id is not None:
+                    self.model.set_custom_progress_callback(self._job_progress_callback(job_id))
+                try:
+                    wav = self._generate([prompt], decoder, timings, progress=job_id is not None)
+                finally:
+                    if job_id is not None:
+                        self.model.set_custom_progress_callback(None)
+                audio_tensor = wav[0].cpu()  # Shape: [1, sample_rate * duration]
         
-        # Convert to WAV bytes
-        audio_tensor = wav[0].cpu()  # Shape: [1, sample_rate * duration]
+        # Encode in the requested format
         sample_rate = self.model.sample_rate
+        timings["generation_seconds"] = round(time.time() - stage_start, 3)
         
-        buffer = io.BytesIO()
-        torchaudio.save(buffer, audio_tensor, sample_rate, format="wav")
-        wav_bytes = buffer.getvalue()
-        
-        # Convert to base64 for JSON response
-        audio_base64 = base64.b64encode(wav_bytes).decode('utf-8')
+        stage_start = time.time()
+        audio_bytes = encode_audio(audio_tensor, sample_rate, format)
+        timings["encode_seconds"] = round(time.time() - stage_start, 3)
         
         generation_time = time.time() - start_time
         
         print(f"✅ Generation complete in {generation_time:.2f}s")
-        print(f"   Audio size: {len(wav_bytes)} bytes")
+        print(f"   Audio size: {len(audio_bytes)} bytes ({format})")
+        
+        # Binary callers get the bytes as-is; Modal ships them without base64 inflation
+        stage_start = time.time()
+        audio_field = (
+            {"audio_bytes": bytes(audio_bytes)}
+            if binary
+            else {"audio_base64": base64.b64encode(audio_bytes).decode('utf-8')}
+        )
+        if not binary:
+            timings["base64_seconds"] = round(time.time() - stage_start, 3)
         
         return {
             "success": True,
-            "audio_base64": audio_base64,
+            **audio_field,
             "prompt": prompt,
-            "model": model,
+            "model": self.model_size,
             "decoder": decoder,
             "duration": duration,
+            "seed": seed,
             "sample_rate": sample_rate,
-            "size_bytes": len(wav_bytes),
+            "size_bytes": len(audio_bytes),
             "generation_time_seconds": round(generation_time, 2),
-            "format": "wav"
+            "timings": timings,
+            "real_time_factor": round(duration / timings["generation_seconds"], 3),
+            **({"windows": windows} if windows is not None else {}),
+            "format": format
         }
 
 
-# Global remote-capable instance for FastAPI to use
-musicgen_model = MusicGenModel()
+def model_container(model_size: str):
+    """Handle on the container pool serving model_size, on that size's GPU"""
+    return MusicGenModel.with_options(gpu=MODEL_GPUS[model_size])(model_size=model_size)
 
 
 @app.function()
@@ -187,18 +435,64 @@ musicgen_model = MusicGenModel()
 def fastapi_app():
     """Create FastAPI app for HTTP endpoint"""
     from fastapi import FastAPI, Request, HTTPException
-    from fastapi.responses import JSONResponse
+    from fastapi.responses import JSONResponse, Response
     from pydantic import BaseModel
+    from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
     import json
     
     web_app = FastAPI(title="TuneStory MusicGen")
     
+    # Stage timings come back in each result and are observed here, so /metrics
+    # covers the web container that served the request
+    stage_seconds = Histogram(
+        "musicgen_stage_seconds", "Time spent in each generation stage", ["stage", "model"],
+        buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+    )
+    request_seconds = Histogram(
+        "musicgen_request_seconds", "End-to-end request latency", ["endpoint"],
+        buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+    )
+    real_time_factor = Histogram(
+        "musicgen_real_time_factor", "Seconds of audio per second of generation", ["model"],
+        buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16),
+    )
+    
+    def observe(endpoint: str, result: dict, seconds: float):
+        request_seconds.labels(endpoint).observe(seconds)
+        for stage, stage_time in result.get("timings", {}).items():
+            stage_seconds.labels(stage.removesuffix("_seconds"), result["model"]).observe(stage_time)
+        if "real_time_factor" in result:
+            real_time_factor.labels(result["model"]).observe(result["real_time_factor"])
+    
     class MusicRequest(BaseModel):
         prompt: str
         duration: int = 30
         temperature: float = 1.0
         model: str = "small"
         decoder: str = "default"
+        seed: Optional[int] = None
+        format: str = "wav"
+    
+    def validate(request: MusicRequest, max_duration: int = LONG_FORM_MAX_SECONDS):
+        if not request.prompt or not request.prompt.strip():
+            raise HTTPException(status_code=400, detail="Prompt is required and cannot be empty")
+        
+        # Validate inputs; beyond 30 seconds generate() renders long-form windows
+        if not (1 <= request.duration <= max_duration):
+            raise HTTPException(status_code=400, detail=f"Duration must be between 1 and {max_duration} seconds")
+        
+        if not (0.1 <= request.temperature <= 2.0):
+            raise HTTPException(status_code=400, detail="Temperature must be between 0.1 and 2.0")
+        
+        # Validate inputs
+        if request.model not in MODEL_SIZES:
+            raise HTTPException(status_code=400, detail=f"Invalid model. Must be one of: {MODEL_SIZES}")
+        
+        if request.decoder not in ['default', 'multiband_diffusion']:
+            raise HTTPException(status_code=400, detail="Invalid decoder. Must be 'default' or 'multiband_diffusion'")
+        
+        if request.format not in AUDIO_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Invalid format. Must be one of: {list(AUDIO_FORMATS)}")
     
     @web_app.post("/")
     async def generate_music(request: MusicRequest):
@@ -224,33 +518,22 @@ def fastapi_app():
                 "format": "wav"
             }
         """
+        import time
+        
         try:
-            if not request.prompt or not request.prompt.strip():
-                raise HTTPException(status_code=400, detail="Prompt is required and cannot be empty")
-            
-            # Validate inputs
-            if not (1 <= request.duration <= 30):
-                raise HTTPException(status_code=400, detail="Duration must be between 1 and 30 seconds")
-            
-            if not (0.1 <= request.temperature <= 2.0):
-                raise HTTPException(status_code=400, detail="Temperature must be between 0.1 and 2.0")
-            
-            # Validate inputs
-            valid_models = ['small', 'medium', 'large', 'melody']
-            if request.model not in valid_models:
-                raise HTTPException(status_code=400, detail=f"Invalid model. Must be one of: {valid_models}")
-            
-            if request.decoder not in ['default', 'multiband_diffusion']:
-                raise HTTPException(status_code=400, detail="Invalid decoder. Must be 'default' or 'multiband_diffusion'")
+            validate(request)
             
-            # Use the shared remote instance
-            result = musicgen_model.generate.remote(
+            # Awaiting the call keeps this web container free to serve other requests
+            start_time = time.time()
+            result = await model_container(request.model).generate.remote.aio(
                 prompt=request.prompt,
                 duration=request.duration,
                 temperature=request.temperature,
-                model=request.model,
-                decoder=request.decoder
+                decoder=request.decoder,
+                seed=request.seed,
+                format=request.format
             )
+            observe("generate", result, time.time() - start_time)
             
             return JSONResponse(content=result)
             
@@ -265,6 +548,276 @@ def fastapi_app():
                 detail=f"Generation failed: {str(e)}"
             )
     
+    @web_app.post("/audio")
+    async def generate_music_audio(request: MusicRequest):
+        """
+        HTTP endpoint returning the encoded audio as the raw response body.
+        
+        Metadata that the JSON endpoint puts in the body comes back as X-* headers.
+        """
+        import time
+        
+        validate(request)
+        start_time = time.time()
+        try:
+            result = await model_container(request.model).generate.remote.aio(
+                prompt=request.prompt,
+                duration=request.duration,
+                temperature=request.temperature,
+                decoder=request.decoder,
+                seed=request.seed,
+                format=request.format,
+                binary=True
+            )
+        except Exception as e:
+            import traceback
+            print(f"❌ Error generating music: {traceback.format_exc()}")
+            raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
+        observe("audio", result, time.time() - start_time)
+        
+        return Response(
+            content=result["audio_bytes"],
+            media_type=AUDIO_FORMATS[result["format"]],
+            headers={
+                "Accept-Ranges": "none",
+                "X-Model": result["model"],
+                "X-Duration-Seconds": str(result["duration"]),
+                "X-Sample-Rate": str(result["sample_rate"]),
+                "X-Generation-Time-Seconds": str(result["generation_time_seconds"]),
+            }
+        )
+    
+    class VariationsRequest(BaseModel):
+        prompt: Optional[str] = None
+        prompts: Optional[list] = None  # prompt variants, cycled over the variations
+        count: Optional[int] = None  # defaults to the longest of prompts/temperatures, else 4
+        temperatures: Optional[list] = None  # per-variation temperature, cycled
+        temperature: float = 1.0
+        seed: Optional[int] = None
+        duration: int = 30
+        model: str = "small"
+        decoder: str = "default"
+        format: str = "wav"
+    
+    @web_app.post("/variations")
+    async def generate_variations(request: VariationsRequest):
+        """HTTP endpoint returning several variations from one batched generation"""
+        prompts = request.prompts or ([request.prompt] if request.prompt else [])
+        temperatures = request.temperatures or [request.temperature]
+        count = request.count or max(len(request.prompts or []), len(request.temperatures or []), 0) or 4
+        
+        validate(MusicRequest(
+            prompt=prompts[0] if prompts else "",
+            duration=request.duration,
+            model=request.model,
+            decoder=request.decoder,
+            format=request.format,
+        ), max_duration=30)
+        if any(not prompt or not prompt.strip() for prompt in prompts):
+            raise HTTPException(status_code=400, detail="Prompts cannot be empty")
+        if any(not (0.1 <= temperature <= 2.0) for temperature in temperatures):
+            raise HTTPException(status_code=400, detail="Temperature must be between 0.1 and 2.0")
+        if not (1 <= count <= 8):
+            raise HTTPException(status_code=400, detail="Count must be between 1 and 8")
+        
+        try:
+            result = await model_container(request.model).generate_variations.remote.aio(
+                prompts=[prompts[i % len(prompts)] for i in range(count)],
+                temperatures=[temperatures[i % len(temperatures)] for i in range(count)],
+                duration=request.duration,
+                decoder=request.decoder,
+                seed=request.seed,
+                format=request.format
+            )
+        except Exception as e:
+            import traceback
+            print(f"❌ Error generating variations: {traceback.format_exc()}")
+            raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
+        
+        return JSONResponse(content=result)
+    
+    class BatchRequest(BaseModel):
+        requests: list[MusicRequest]
+    
+    @web_app.post("/batch")
+    async def generate_batch(request: BatchRequest):
+        """
+        Render several independent requests in one call.
+        
+        Requests are grouped by model and each group fans out with map() over that size's
+        container pool, so Modal spreads them across as many containers as it scales to.
+        Results come back in request order; a failed request gets success false and its
+        error without failing the others.
+        """
+        import asyncio
+        import time
+        
+        if not (1 <= len(request.requests) <= BATCH_MAX_REQUESTS):
+            raise HTTPException(status_code=400, detail=f"Batch must hold between 1 and {BATCH_MAX_REQUESTS} requests")
+        for item in request.requests:
+            validate(item)
+        
+        groups = OrderedDict()  # model size -> request indices
+        for index, item in enumerate(request.requests):
+            groups.setdefault(item.model, []).append(index)
+        
+        start_time = time.time()
+        
+        async def fan_out(model_size: str, indices: list):
+            items = [request.requests[i] for i in indices]
+            # map() takes one iterable per positional parameter of generate()
+            outputs = model_container(model_size).generate.map.aio(
+                [item.prompt for item in items],
+                [item.duration for item in items],
+                [item.temperature for item in items],
+                [item.decoder for item in items],
+                [item.seed for item in items],
+                [item.format for item in items],
+                return_exceptions=True,
+            )
+            return indices, [output async for output in outputs]
+        
+        results = [None] * len(request.requests)
+        for indices, outputs in await asyncio.gather(*(fan_out(size, indices) for size, indices in groups.items())):
+            for i, output in zip(indices, outputs):
+                if isinstance(output, Exception):
+                    print(f"❌ Batch item {i} failed: {output}")
+                    results[i] = {"success": False, "prompt": request.requests[i].prompt, "error": f"Generation failed: {str(output)}"}
+                else:
+                    results[i] = output
+        
+        generation_time = time.time() - start_time
+        for result in results:
+            if result["success"]:
+                observe("batch", result, generation_time)
+        print(f"✅ Batch of {len(results)} over {len(groups)} model pool(s) in {generation_time:.2f}s")
+        
+        return JSONResponse(content={
+            "success": all(result["success"] for result in results),
+            "results": results,
+            "generation_time_seconds": round(generation_time, 2),
+        })
+    
+    @web_app.post("/jobs", status_code=202)
+    async def create_job(request: MusicRequest):
+        """
+        Spawn a generation and return immediately with a job id.
+        
+        Poll GET /jobs/{job_id} for status and progress, then fetch the audio from
+        GET /jobs/{job_id}/result. No HTTP connection is held open while it renders.
+        """
+        import time
+        import uuid
+        
+        validate(request)
+        job_id = uuid.uuid4().hex
+        call = await model_container(request.model).generate.spawn.aio(
+            prompt=request.prompt,
+            duration=request.duration,
+            temperature=request.temperature,
+            decoder=request.decoder,
+            seed=request.seed,
+            format=request.format,
+            binary=True,
+            job_id=job_id
+        )
+        await job_state.put.aio(job_id, {"call_id": call.object_id, "prompt": request.prompt, "created_at": time.time()})
+        
+        return {
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": f"/jobs/{job_id}",
+            "result_url": f"/jobs/{job_id}/result",
+        }
+    
+    async def forget_job(job_id: str):
+        for key in (job_id, f"progress:{job_id}"):
+            # Dict.pop takes no default; a missing key (never published, or another web
+            # container got there first) raises KeyError
+            try:
+                await job_state.pop.aio(key)
+            except KeyError:
+                pass
+    
+    async def poll_job(job_id: str):
+        """Returns (job entry, status, result or error)"""
+        import time
+        
+        job = await job_state.get.aio(job_id)
+        finished_at = None if job is None else job.get("finished_at")
+        if job is None or (finished_at is not None and time.time() - finished_at > JOB_RETENTION_SECONDS):
+            if job is not None:
+                await forget_job(job_id)
+            raise HTTPException(status_code=404, detail="Job not found or expired")
+        
+        try:
+            result = await modal.FunctionCall.from_id(job["call_id"]).get.aio(timeout=0)
+        except TimeoutError:
+            status = "running" if await job_state.get.aio(f"progress:{job_id}") is not None else "queued"
+            return job, status, None
+        except Exception as e:
+            status, outcome = "failed", f"Generation failed: {str(e)}"
+        else:
+            status, outcome = "completed", result
+        if finished_at is None:
+            # Modal doesn't say when a call finished; retention runs from the first poll that sees it done
+            job = {**job, "finished_at": time.time()}
+            await job_state.put.aio(job_id, job)
+        return job, status, outcome
+    
+    @web_app.get("/jobs/{job_id}")
+    async def get_job(job_id: str):
+        """Job status, progress percentage and, once completed, its metadata"""
+        job, status, outcome = await poll_job(job_id)
+        metadata = None
+        if status == "completed":
+            metadata = {key: value for key, value in outcome.items() if key != "audio_bytes"}
+        progress = 100 if status == "completed" else await job_state.get.aio(f"progress:{job_id}", 0)
+        
+        return {
+            "job_id": job_id,
+            "status": status,
+            "progress_percent": progress,
+            "prompt": job["prompt"],
+            "created_at": job["created_at"],
+            "result_url": f"/jobs/{job_id}/result" if status == "completed" else None,
+            "expires_at": job["finished_at"] + JOB_RETENTION_SECONDS if "finished_at" in job else None,
+            "error": outcome if status == "failed" else None,
+            "metadata": metadata,
+        }
+    
+    @web_app.get("/jobs/{job_id}/result")
+    async def get_job_result(job_id: str):
+        """Serve a completed job's audio as the raw response body"""
+        _, status, outcome = await poll_job(job_id)
+        if status == "failed":
+            raise HTTPException(status_code=500, detail=outcome)
+        if status != "completed":
+            raise HTTPException(status_code=409, detail=f"Job is {status}")
+        
+        return Response(
+            content=outcome["audio_bytes"],
+            media_type=AUDIO_FORMATS[outcome["format"]],
+            headers={
+                "X-Model": outcome["model"],
+                "X-Duration-Seconds": str(outcome["duration"]),
+                "X-Sample-Rate": str(outcome["sample_rate"]),
+                "X-Generation-Time-Seconds": str(outcome["generation_time_seconds"]),
+            }
+        )
+    
+    @web_app.get("/metrics")
+    async def get_metrics():
+        """Prometheus metrics for this web container"""
+        return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    
+    @web_app.get("/stats")
+    async def get_stats(model: str = "small"):
+        """Report the model and caches of a container from one size's pool"""
+        if model not in MODEL_SIZES:
+            raise HTTPException(status_code=400, detail=f"Invalid model. Must be one of: {MODEL_SIZES}")
+        return JSONResponse(content=await model_container(model).stats.remote.aio())
+    
     return web_app
 
 
@@ -0,0 +1,209 @@
+"""
+Caches in front of generation for musicgen_server.py.
+
+GenerationCache holds rendered responses by content hash in memory and on disk,
+AudioStore the renditions recently served from stored codes, and
+MeteredConditioningCache is the T5 conditioning cache with Prometheus counters.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from prometheus_client import Counter
+
+from musicgen_common import ConditioningCache
+
+# Prometheus metrics, exposed on musicgen_server.py's /metrics
+CONDITIONING_LOOKUPS = Counter("musicgen_conditioning_cache_lookups_total", "Text-conditioning cache lookups", ["result"])
+
+class MeteredConditioningCache(ConditioningCache):
+    """ConditioningCache that also counts its lookups for /metrics"""
+    def get(self, size: str, text: str):
+        embeds = super().get(size, text)
+        CONDITIONING_LOOKUPS.labels("miss" if embeds is None else "hit").inc()
+        return embeds
+    
+    def count_lookups(self, hits: int, misses: int):
+        super().count_lookups(hits, misses)
+        CONDITIONING_LOOKUPS.labels("hit").inc(hits)
+        CONDITIONING_LOOKUPS.labels("miss").inc(misses)
+
+def make_cache_key(prompt: str, size: str, duration: int, temperature: float, decoder: str, seed: int, audio_format: Optional[str] = "wav") -> str:
+    """Canonical content hash of everything that determines the rendered audio; audio_format=None keys the generation alone"""
+    canonical = json.dumps({
+        "prompt": " ".join(prompt.split()),
+        "model": size,
+        "duration": duration,
+        "temperature": temperature,
+        "decoder": decoder,
+        "seed": seed,
+        "format": audio_format,
+    }, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class GenerationCache:
+    """
+    Two-tier cache of rendered audio keyed by make_cache_key().
+    
+    The memory tier is an LRU bounded by total audio bytes. The disk tier keeps
+    <key>.audio plus <key>.json metadata under cache_dir and evicts the least recently
+    used entries once it passes its own byte budget. Disk hits are promoted to memory.
+    Disk work happens on worker threads; the memory tier is only touched from the loop.
+    """
+    
+    def __init__(self, memory_bytes: int, disk_bytes: int, cache_dir: str):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.cache_dir = cache_dir
+        self._memory = OrderedDict()  # key -> (audio bytes, metadata), least recently used first
+        self._memory_used = 0
+        self._disk_lock = threading.Lock()
+        self._disk = OrderedDict()  # key -> bytes on disk, least recently used first
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._scan_disk()
+    
+    def _scan_disk(self):
+        if self.disk_bytes <= 0:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".audio"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name[:-len(".audio")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+    
+    def _paths(self, key: str):
+        base = os.path.join(self.cache_dir, key)
+        return base + ".audio", base + ".json"
+    
+    async def get(self, key: str):
+        """Return (audio bytes, metadata, tier) or None"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return entry[0], entry[1], "memory"
+        
+        entry = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key)
+        if entry is not None:
+            self._put_memory(key, *entry)
+            self.disk_hits += 1
+            return entry[0], entry[1], "disk"
+        
+        self.misses += 1
+        return None
+    
+    async def put(self, key: str, audio_bytes: bytes, metadata: dict):
+        self._put_memory(key, audio_bytes, metadata)
+        await asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, audio_bytes, metadata)
+    
+    def _put_memory(self, key: str, audio_bytes: bytes, metadata: dict):
+        if len(audio_bytes) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_used -= len(self._memory.pop(key)[0])
+        self._memory[key] = (audio_bytes, metadata)
+        self._memory_used += len(audio_bytes)
+        while self._memory_used > self.memory_bytes:
+            _, (evicted, _) = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+    
+    def _read_disk(self, key: str):
+        with self._disk_lock:
+            if key not in self._disk:
+                return None
+            audio_path, meta_path = self._paths(key)
+            try:
+                with open(audio_path, "rb") as f:
+                    audio_bytes = f.read()
+                with open(meta_path) as f:
+                    metadata = json.load(f)
+                os.utime(audio_path)
+            except (OSError, ValueError):
+                self._remove_disk(key)
+                return None
+            self._disk.move_to_end(key)
+            return audio_bytes, metadata
+    
+    def _write_disk(self, key: str, audio_bytes: bytes, metadata: dict):
+        if len(audio_bytes) > self.disk_bytes:
+            return
+        with self._disk_lock:
+            audio_path, meta_path = self._paths(key)
+            try:
+                with open(meta_path, "w") as f:
+                    json.dump(metadata, f)
+                # Write the audio last and atomically; its presence marks the entry complete
+                with open(audio_path + ".tmp", "wb") as f:
+                    f.write(audio_bytes)
+                os.replace(audio_path + ".tmp", audio_path)
+            except OSError as e:
+                print(f"⚠️ Could not write cache entry {key}: {e}")
+                return
+            self._disk[key] = len(audio_bytes)
+            self._disk.move_to_end(key)
+            while sum(self._disk.values()) > self.disk_bytes:
+                self._remove_disk(next(iter(self._disk)))
+    
+    def _remove_disk(self, key: str):
+        self._disk.pop(key, None)
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "memory_mb": round(self._memory_used / 1024**2, 2),
+            "memory_budget_mb": round(self.memory_bytes / 1024**2, 2),
+            "disk_entries": len(self._disk),
+            "disk_mb": round(sum(self._disk.values()) / 1024**2, 2),
+            "disk_budget_mb": round(self.disk_bytes / 1024**2, 2),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else None,
+        }
+
+class AudioStore:
+    """Recently served renditions by rendition_key(), least recently used dropped past a byte budget"""
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # rendition key -> (audio bytes, metadata)
+        self._used = 0
+    
+    def put(self, key: str, audio_bytes: bytes, metadata: dict):
+        if key in self._entries:
+            return
+        self._entries[key] = (audio_bytes, metadata)
+        self._used += len(audio_bytes)
+        while self._used > self.max_bytes and len(self._entries) > 1:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._used -= len(evicted)
+    
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+    
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "mb": round(self._used / 1024**2, 2), "budget_mb": round(self.max_bytes / 1024**2, 2)}
+
+def rendition_key(track_id: str, audio_format: str, sample_rate: int) -> str:
+    return f"{track_id}.{sample_rate}.{audio_format}"
@@ -0,0 +1,138 @@
+"""
+Track storage for musicgen_server.py: every generated track is kept as its EnCodec codes.
+
+pregenerate_library.py writes the prompt library in the same format, so library
+tracks are read through a CodeStore too.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+import numpy as np
+
+# One fixed-size record per track in codes.idx
+CODE_INDEX_DTYPE = np.dtype([
+    ("track_id", "S32"),
+    ("model_size", "S8"),
+    ("offset", "<i8"),  # byte offset of the codes in codes.bin
+    ("codebooks", "<i2"),
+    ("frames", "<i4"),
+    ("sample_rate", "<i4"),
+    ("frame_rate", "<f4"),
+    ("created_at", "<f8"),
+])
+
+class CodeStore:
+    """
+    Generated tracks kept as their EnCodec codes, the artifact every rendition is decoded from.
+    
+    codes.bin holds each track's [codebooks, frames] codes as int16, back to back;
+    codes.idx is an array of CODE_INDEX_DTYPE records read through a numpy memmap; and
+    tracks.jsonl has the request metadata. All three are append-only. A 30 s track from a
+    mono model is 4 x 1500 codes, about 12 KB against 1.9 MB of 16-bit WAV.
+    """
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.codes_path = os.path.join(directory, "codes.bin")
+        self.index_path = os.path.join(directory, "codes.idx")
+        self.metadata_path = os.path.join(directory, "tracks.jsonl")
+        self._lock = threading.Lock()
+        self._rows = {}  # track id -> row in codes.idx
+        self._metadata = {}  # track id -> metadata
+        self._index = None  # memmap over codes.idx, reopened after appends
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+    
+    def _load(self):
+        index = self._mapped_index()
+        if index is not None:
+            for row, track_id in enumerate(index["track_id"]):
+                self._rows[track_id.decode()] = row
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a torn final line from a crash
+                    self._metadata[entry.pop("track_id")] = entry
+        if self._rows:
+            print(f"📂 Code store: {len(self._rows)} tracks")
+    
+    def _mapped_index(self):
+        if self._index is None and os.path.exists(self.index_path):
+            records = os.path.getsize(self.index_path) // CODE_INDEX_DTYPE.itemsize
+            if records:
+                self._index = np.memmap(self.index_path, dtype=CODE_INDEX_DTYPE, mode="r", shape=(records,))
+        return self._index
+    
+    def put(self, codes, model_size: str, sample_rate: int, frame_rate: float, metadata: dict) -> str:
+        """Append a track's [codebooks, frames] codes, returns its track id; blocking, call off the loop"""
+        array = codes.numpy() if hasattr(codes, "numpy") else np.asarray(codes)
+        if array.size and (array.min() < 0 or array.max() > np.iinfo(np.int16).max):
+            raise ValueError("EnCodec codes out of int16 range")
+        array = np.ascontiguousarray(array, dtype="<i2")
+        track_id = uuid.uuid4().hex
+        
+        with self._lock:
+            with open(self.codes_path, "ab") as f:
+                offset = f.tell()
+                f.write(array.tobytes())
+            record = np.array([(
+                track_id, model_size, offset, array.shape[0], array.shape[1], sample_rate, frame_rate, time.time()
+            )], dtype=CODE_INDEX_DTYPE)
+            with open(self.index_path, "ab") as f:
+                f.write(record.tobytes())
+            with open(self.metadata_path, "a") as f:
+                f.write(json.dumps({"track_id": track_id, **metadata}) + "\n")
+            self._rows[track_id] = len(self._rows)
+            self._metadata[track_id] = metadata
+            self._index = None
+        return track_id
+    
+    def record(self, track_id: str):
+        """Index record for a track as a dict, or None"""
+        row = self._rows.get(track_id)
+        if row is None:
+            return None
+        with self._lock:
+            entry = self._mapped_index()[row]
+        return {
+            "model_size": entry["model_size"].decode(),
+            "offset": int(entry["offset"]),
+            "codebooks": int(entry["codebooks"]),
+            "frames": int(entry["frames"]),
+            "sample_rate": int(entry["sample_rate"]),
+            "frame_rate": float(entry["frame_rate"]),
+            "duration": round(int(entry["frames"]) / float(entry["frame_rate"]), 3),
+            "created_at": float(entry["created_at"]),
+        }
+    
+    def codes(self, track_id: str, last_frames: Optional[int] = None):
+        """A track's codes as a [codebooks, frames] int64 tensor, optionally only its last frames"""
+        import torch
+        record = self.record(track_id)
+        if record is None:
+            return None
+        mapped = np.memmap(self.codes_path, dtype="<i2", mode="r", offset=record["offset"], shape=(record["codebooks"], record["frames"]))
+        if last_frames is not None:
+            mapped = mapped[:, -last_frames:]
+        return torch.from_numpy(mapped.astype(np.int64))
+    
+    def metadata(self, track_id: str) -> Optional[dict]:
+        return self._metadata.get(track_id) if track_id in self._rows else None
+    
+    def track_ids(self) -> list:
+        return list(self._rows)
+    
+    def stats(self) -> dict:
+        return {
+            "tracks": len(self._rows),
+            "codes_mb": round(os.path.getsize(self.codes_path) / 1024**2, 2) if os.path.exists(self.codes_path) else 0.0,
+            "directory": self.directory,
+        }
@@ -0,0 +1,269 @@
+"""
+Audio helpers shared by musicgen_server.py and modal_musicgen.py.
+
+WAV and compressed encoding, the T5 text-conditioning cache and the cross-fader that
+joins long-form windows. Only the standard library is imported at module level; torch
+and torchaudio are imported inside the functions that need them, so the Modal front end
+can import this without them.
+"""
+
+import io
+import os
+import struct
+from collections import OrderedDict
+from typing import Optional
+
+# Audio response formats
+AUDIO_FORMATS = {"wav": "audio/wav", "flac": "audio/flac", "opus": "audio/ogg", "mp3": "audio/mpeg"}
+# Compressed formats go through FFmpeg: format -> (container, encoder, encoder sample rate)
+COMPRESSED_ENCODERS = {
+    "flac": ("flac", "flac", None),
+    "opus": ("ogg", "libopus", 48000),  # Opus only runs at 48 kHz
+    "mp3": ("mp3", "libmp3lame", None),
+}
+
+# Samples quantized per step when encoding WAV; bounds the float scratch space
+WAV_ENCODE_BLOCK_SAMPLES = 1 << 16
+WAV_HEADER_BYTES = 44
+
+def encode_wav_batch(wav, sample_rate: int) -> list:
+    """
+    Encode every row of a [batch, channels, samples] float tensor as 16-bit PCM WAV.
+    
+    All files share one output allocation. Each RIFF header is packed straight into it and
+    samples are quantized block by block into an int16 view over the data sections,
+    interleaving channels on the way, so there is no full-size float or int16 copy and no
+    container round-trip. Returns one memoryview per row; the input is left untouched.
+    """
+    import torch
+    
+    batch, channels, samples = wav.shape
+    data_bytes = channels * samples * 2
+    file_bytes = WAV_HEADER_BYTES + data_bytes
+    out = bytearray(batch * file_bytes)
+    
+    for i in range(batch):
+        struct.pack_into(
+            "<4sI4s4sIHHIIHH4sI", out, i * file_bytes,
+            b"RIFF", file_bytes - 8, b"WAVE",
+            b"fmt ", 16, 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16,
+            b"data", data_bytes,
+        )
+    
+    if data_bytes:
+        # [batch, header + data] in int16 units, then drop the headers and split frames
+        pcm = torch.frombuffer(out, dtype=torch.int16).view(batch, file_bytes // 2)
+        pcm = pcm[:, WAV_HEADER_BYTES // 2:].view(batch, samples, channels)
+        for start in range(0, samples, WAV_ENCODE_BLOCK_SAMPLES):
+            end = start + WAV_ENCODE_BLOCK_SAMPLES
+            block = wav[:, :, start:end].clamp(-1.0, 1.0).mul_(32767.0).round_()
+            pcm[:, start:end].copy_(block.transpose(1, 2))
+    
+    view = memoryview(out)
+    return [view[i * file_bytes:(i + 1) * file_bytes] for i in range(batch)]
+
+def encode_wav(audio_tensor, sample_rate: int) -> memoryview:
+    """Encode a [channels, samples] float tensor as 16-bit PCM WAV, see encode_wav_batch()"""
+    return encode_wav_batch(audio_tensor.unsqueeze(0), sample_rate)[0]
+
+def encode_audio(audio_tensor, sample_rate: int, audio_format: str = "wav"):
+    """Encode a [channels, samples] float tensor in one of AUDIO_FORMATS, returns a bytes-like object"""
+    if audio_format == "wav":
+        return encode_wav(audio_tensor, sample_rate)
+    
+    # Only compressed formats need torchaudio's FFmpeg bindings
+    from torchaudio.io import StreamWriter
+    
+    buffer = io.BytesIO()
+    container, encoder, encoder_sample_rate = COMPRESSED_ENCODERS[audio_format]
+    writer = StreamWriter(dst=buffer, format=container)
+    writer.add_audio_stream(
+        sample_rate=sample_rate,
+        num_channels=audio_tensor.shape[0],
+        encoder=encoder,
+        encoder_sample_rate=encoder_sample_rate,
+    )
+    with writer.open():
+        writer.write_audio_chunk(0, audio_tensor.t().contiguous())
+    return buffer.getvalue()
+
+def normalize_prompt(text: Optional[str]) -> str:
+    """Collapse whitespace; T5's tokenizer drops extra whitespace, so this never changes the embedding"""
+    return " ".join(text.split()) if text else ""
+
+class ConditioningCache:
+    """
+    LRU of T5 text-conditioning outputs keyed by (model size, normalised prompt).
+    
+    Each entry is one prompt's embeddings trimmed to its own token count, kept on CPU.
+    Batches are rebuilt by zero-padding rows to the longest prompt, which is exactly what
+    the conditioner produces for a padded batch, so cached and uncached renders match.
+    With a path, entries can be saved there and read back by the next process.
+    """
+    
+    def __init__(self, max_bytes: int, path: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self._entries = OrderedDict()  # (size, text) -> embeddings [tokens, dim], least recently used first
+        self._bytes = 0
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+    
+    def __getstate__(self):
+        # A model pickled into a replica process takes an empty cache along, not a copy of this one
+        return {**self.__dict__, "_entries": OrderedDict(), "_bytes": 0, "_loaded": True, "hits": 0, "misses": 0}
+    
+    def get(self, size: str, text: str):
+        embeds = self._entries.get((size, text))
+        if embeds is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((size, text))
+        self.hits += 1
+        return embeds
+    
+    def put(self, size: str, text: str, embeds):
+        entry_bytes = embeds.numel() * embeds.element_size()
+        if entry_bytes > self.max_bytes or (size, text) in self._entries:
+            return
+        self._entries[(size, text)] = embeds
+        self._bytes += entry_bytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.numel() * evicted.element_size()
+    
+    def count_lookups(self, hits: int, misses: int):
+        """Add lookups made against a copy of this cache, e.g. in a replica process"""
+        self.hits += hits
+        self.misses += misses
+    
+    def items(self) -> list:
+        """((size, text), embeddings) of every entry, least recently used first"""
+        return list(self._entries.items())
+    
+    def install(self, loaded, size: str):
+        """Route the model's text conditioner through this cache"""
+        conditioners = getattr(getattr(loaded.lm, "condition_provider", None), "conditioners", {})
+        if "description" not in conditioners:
+            return
+        conditioner = conditioners["description"]
+        self.load()
+        conditioner.tokenize = _CachedTokenize()
+        conditioner.forward = _CachedConditionerForward(conditioner, size, self)
+    
+    def load(self):
+        """Read persisted entries once, on the first model load"""
+        if self._loaded or not self.path or not os.path.exists(self.path):
+            self._loaded = True
+            return
+        import torch
+        self._loaded = True
+        try:
+            entries = torch.load(self.path, map_location="cpu")
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable conditioning cache {self.path}: {e}")
+            return
+        for (size, text), embeds in entries.items():
+            self.put(size, text, embeds)
+        print(f"📂 Loaded {len(entries)} cached text conditionings")
+    
+    def save(self):
+        if not self.path or not self._entries:
+            return
+        import torch
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        torch.save(dict(self._entries), tmp_path)
+        os.replace(tmp_path, self.path)
+        print(f"💾 Saved {len(self._entries)} cached text conditionings")
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "mb": round(self._bytes / 1024**2, 2),
+            "budget_mb": round(self.max_bytes / 1024**2, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "persist_path": self.path,
+        }
+
+class _CachedTokenize:
+    """Replacement for the text conditioner's tokenize(); defers tokenizing to forward() so hits skip it"""
+    def __call__(self, texts: list):
+        return {"texts": [normalize_prompt(text) for text in texts]}
+
+class _CachedConditionerForward:
+    """
+    Replacement for the text conditioner's forward(): looks every prompt up in the cache
+    and runs T5 only on the misses, returns (embeddings, mask).
+    
+    A class rather than a closure so models carrying it can be pickled to replica processes.
+    """
+    def __init__(self, conditioner, size: str, cache: ConditioningCache):
+        self.conditioner = conditioner
+        self.size = size
+        self.cache = cache
+    
+    def __call__(self, inputs: dict):
+        import torch
+        
+        conditioner = self.conditioner
+        texts = inputs["texts"]
+        rows = {}
+        misses = []
+        for text in dict.fromkeys(texts):
+            embeds = self.cache.get(self.size, text)
+            if embeds is None:
+                misses.append(text)
+            else:
+                rows[text] = embeds
+        
+        if misses:
+            tokens = type(conditioner).tokenize(conditioner, misses)
+            embeds, mask = type(conditioner).forward(conditioner, tokens)
+            for i, text in enumerate(misses):
+                # An empty prompt is a single masked-out end-of-sequence token
+                length = int(mask[i].sum()) or 1
+                rows[text] = embeds[i, :length].detach().to("cpu", copy=True)
+                self.cache.put(self.size, text, rows[text])
+        
+        device = next(conditioner.parameters()).device
+        length = max(rows[text].shape[0] for text in texts)
+        dim = rows[texts[0]].shape[-1]
+        embeds = torch.zeros(len(texts), length, dim, dtype=rows[texts[0]].dtype, device=device)
+        mask = torch.zeros(len(texts), length, dtype=torch.long, device=device)
+        for i, text in enumerate(texts):
+            tokens = rows[text].shape[0]
+            embeds[i, :tokens] = rows[text]
+            mask[i, :tokens] = 1 if text else 0
+        return embeds, mask
+
+class Crossfader:
+    """
+    Joins audio decoded window by window into one seamless signal.
+    
+    Every window after the first is decoded with a lead-in of earlier codes in front of
+    its own. The end of that lead-in repeats the audio held back from the previous window
+    and is cross-faded with it, which hides the decoder's edge effects at the seam.
+    """
+    
+    def __init__(self, fade_samples: int):
+        self.fade_samples = fade_samples
+        self.held = None  # end of the previous window, not emitted yet
+    
+    def push(self, wav, lead_samples: int = 0, last: bool = False):
+        """Add a decoded [channels, samples] window, returns the audio that is now final"""
+        import torch
+        if self.held is not None:
+            held = self.held.shape[-1]
+            ramp = torch.linspace(0.0, 1.0, held)
+            seam = self.held * (1 - ramp) + wav[:, lead_samples - held:lead_samples] * ramp
+            wav = torch.cat([seam, wav[:, lead_samples:]], dim=-1)
+        if last:
+            self.held = None
+            return wav
+        self.held = wav[:, -self.fade_samples:]
+        return wav[:, :-self.fade_samples]
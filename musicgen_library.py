@@ -0,0 +1,176 @@
+"""
+The prompt library for musicgen_server.py: pre-rendered tracks for likely prompts,
+matched to incoming prompts by T5 embedding similarity.
+"""
+
+import os
+import threading
+import wave
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from prometheus_client import Counter
+
+from musicgen_code_store import CodeStore
+from musicgen_common import normalize_prompt
+
+# Prometheus metrics, exposed on musicgen_server.py's /metrics
+LIBRARY_LOOKUPS = Counter("musicgen_library_lookups_total", "Prompt library lookups", ["result"])
+
+def read_wav(path: str):
+    """Read a 16-bit PCM WAV into a [channels, samples] float tensor, returns (tensor, sample rate)"""
+    import torch
+    with wave.open(path, "rb") as f:
+        channels, sample_rate = f.getnchannels(), f.getframerate()
+        pcm = np.frombuffer(f.readframes(f.getnframes()), dtype="<i2")
+    return torch.from_numpy(pcm.reshape(-1, channels).T / 32768.0).float(), sample_rate
+
+class PromptEmbedder:
+    """
+    Unit-length, mean-pooled T5 encoder embeddings of prompts, computed on CPU.
+    
+    MusicGen conditions on the same encoder, so prompts that steer the model alike land
+    close together. Recently embedded prompts are kept in a small LRU.
+    """
+    
+    def __init__(self, name: str, cache_size: int = 1024):
+        self.name = name
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._tokenizer = None
+        self._model = None
+        self._cache = OrderedDict()  # normalised prompt -> embedding
+    
+    def embed(self, prompts: list) -> np.ndarray:
+        """[len(prompts), dim] float32 embeddings; blocking, call off the loop"""
+        import torch
+        texts = [normalize_prompt(prompt) for prompt in prompts]
+        with self._lock:
+            missing = [text for text in dict.fromkeys(texts) if text not in self._cache]
+            if missing:
+                if self._model is None:
+                    from transformers import AutoTokenizer, T5EncoderModel
+                    print(f"📥 Loading prompt embedder {self.name} on cpu")
+                    self._tokenizer = AutoTokenizer.from_pretrained(self.name)
+                    self._model = T5EncoderModel.from_pretrained(self.name).eval()
+                inputs = self._tokenizer(missing, return_tensors="pt", padding=True, truncation=True)
+                with torch.inference_mode():
+                    hidden = self._model(**inputs).last_hidden_state
+                mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                pooled = torch.nn.functional.normalize((hidden * mask).sum(1) / mask.sum(1).clamp_min(1), dim=-1)
+                for text, vector in zip(missing, pooled.float().numpy()):
+                    self._cache[text] = vector
+            vectors = np.stack([self._cache[text] for text in texts])
+            for text in texts:
+                self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return vectors
+
+class PromptLibrary:
+    """
+    Pre-rendered tracks for likely prompts, looked up by prompt embedding similarity.
+    
+    pregenerate_library.py owns the directory: a CodeStore with every track's codes (so
+    library tracks can be fetched, resampled and extended like any other), each track's
+    audio as audio/<track id>.wav, and embeddings.npz with the track ids and their prompt
+    embeddings. The server only reads it, reloading whenever embeddings.npz is replaced.
+    mode is how the server uses matches, only reported in stats().
+    """
+    
+    def __init__(self, directory: str, embedder: PromptEmbedder, threshold: float, mode: str):
+        self.directory = directory
+        self.embeddings_path = os.path.join(directory, "embeddings.npz")
+        self.embedder = embedder
+        self.threshold = threshold
+        self.mode = mode
+        self.store = None
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._track_ids = []
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._models = np.array([], dtype=str)
+        self._durations = np.array([], dtype=np.float64)
+        self.hits = 0
+        self.misses = 0
+    
+    def audio_path(self, track_id: str) -> str:
+        return os.path.join(self.directory, "audio", f"{track_id}.wav")
+    
+    def refresh(self):
+        """Reload the index if the pre-generation job has published a new one"""
+        try:
+            mtime = os.stat(self.embeddings_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            with np.load(self.embeddings_path) as index:
+                track_ids = [str(track_id) for track_id in index["track_ids"]]
+                vectors = index["vectors"].astype(np.float32)
+            store = CodeStore(self.directory)
+            records = [store.record(track_id) for track_id in track_ids]
+            keep = [i for i, record in enumerate(records) if record is not None and os.path.exists(self.audio_path(track_ids[i]))]
+            self.store = store
+            self._track_ids = [track_ids[i] for i in keep]
+            self._vectors = vectors[keep]
+            self._models = np.array([records[i]["model_size"] for i in keep], dtype=str)
+            self._durations = np.array([records[i]["duration"] for i in keep], dtype=np.float64)
+            self._mtime = mtime
+            print(f"📚 Prompt library: {len(self._track_ids)} tracks")
+    
+    def store_for(self, track_id: str) -> Optional[CodeStore]:
+        """The library's code store if it holds track_id, else None"""
+        self.refresh()
+        store = self.store
+        return store if store is not None and store.record(track_id) is not None else None
+    
+    def lookup(self, prompt: str, model_size: str, duration: float):
+        """
+        Closest library track rendered by model_size and at least duration seconds long.
+        
+        Returns (track id, similarity) when the similarity reaches the threshold, else None.
+        Blocking, call off the loop.
+        """
+        self.refresh()
+        with self._lock:
+            track_ids, vectors = self._track_ids, self._vectors
+            eligible = (self._models == model_size) & (self._durations >= duration)
+        match = None
+        if eligible.any():
+            similarities = np.where(eligible, vectors @ self.embedder.embed([prompt])[0], -np.inf)
+            best = int(similarities.argmax())
+            if similarities[best] >= self.threshold:
+                match = track_ids[best], float(similarities[best])
+        if match is None:
+            self.misses += 1
+            LIBRARY_LOOKUPS.labels("miss").inc()
+        else:
+            self.hits += 1
+            LIBRARY_LOOKUPS.labels("hit").inc()
+        return match
+    
+    def audio(self, track_id: str, duration: Optional[float] = None, fade_seconds: float = 0.1):
+        """A track's audio as ([channels, samples], sample rate), cut to duration with a short fade-out"""
+        wav, sample_rate = read_wav(self.audio_path(track_id))
+        if duration is not None and duration * sample_rate < wav.shape[-1]:
+            import torch
+            wav = wav[:, :int(duration * sample_rate)].clone()
+            fade = min(int(fade_seconds * sample_rate), wav.shape[-1])
+            wav[:, wav.shape[-1] - fade:] *= torch.linspace(1.0, 0.0, fade)
+        return wav, sample_rate
+    
+    def stats(self) -> dict:
+        self.refresh()
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "tracks": len(self._track_ids),
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "directory": self.directory,
+        }
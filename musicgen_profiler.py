@@ -0,0 +1,368 @@
+"""
+On-demand request profiling for musicgen_server.py.
+
+RequestProfiler is armed from /admin/profile to capture the next matching requests.
+A capture records the server's stage spans, samples the Python stack of every thread
+and can wrap the LM and decode stages in torch.profiler; it is written out as a Chrome
+trace, a flame graph and capture.json.
+"""
+
+import asyncio
+import hashlib
+import html
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+# Leaf frames of a thread with nothing to do; those samples are left out of a profile
+IDLE_FRAMES = {("threading.py", "wait"), ("selectors.py", "select"), ("thread.py", "_worker")}
+
+class StackSampler:
+    """
+    Samples the Python stack of every thread at a fixed interval, on its own thread.
+    
+    Each sample is (seconds since start, thread name, frames root first). Threads that are
+    only waiting are skipped, so the profile shows where time was spent, not parked.
+    """
+    
+    def __init__(self, interval_seconds: float, max_seconds: float):
+        self.interval = interval_seconds
+        self.max_seconds = max_seconds
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="musicgen-profiler", daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+    
+    def _run(self):
+        own = threading.get_ident()
+        started = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter() - started
+            if now > self.max_seconds:
+                break
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                code = frame.f_code
+                if ident == own or (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.samples.append((now, names.get(ident, str(ident)), tuple(reversed(stack))))
+
+def sample_spans(samples: list, interval: float):
+    """Turn stack samples into (thread, frame, start, end) spans, nested per thread like a flame chart"""
+    open_frames = {}  # thread -> [[frame, start], ...] from the root
+    last_seen = {}
+    for now, thread, stack in samples:
+        opened = open_frames.setdefault(thread, [])
+        # A thread that dropped out of the samples was idle in between
+        if thread in last_seen and now - last_seen[thread] > 2 * interval:
+            for frame, start in reversed(opened):
+                yield thread, frame, start, last_seen[thread] + interval
+            opened.clear()
+        common = 0
+        while common < min(len(opened), len(stack)) and opened[common][0] == stack[common]:
+            common += 1
+        for frame, start in reversed(opened[common:]):
+            yield thread, frame, start, now
+        del opened[common:]
+        opened.extend([frame, now] for frame in stack[common:])
+        last_seen[thread] = now
+    for thread, opened in open_frames.items():
+        for frame, start in reversed(opened):
+            yield thread, frame, start, last_seen[thread] + interval
+
+def render_flamegraph_svg(folded: dict, title: str) -> str:
+    """A self-contained flame graph of folded stacks ({frames tuple: samples}), hover for details"""
+    root = {"count": 0, "children": {}}
+    for stack, count in folded.items():
+        node = root
+        node["count"] += count
+        for frame in stack:
+            node = node["children"].setdefault(frame, {"count": 0, "children": {}})
+            node["count"] += count
+    
+    width, row = 1200.0, 16
+    depth = max((len(stack) for stack in folded), default=0) + 1
+    height = depth * row + 40
+    total = max(root["count"], 1)
+    rects = []
+    
+    def place(name: str, node: dict, x: float, level: int):
+        w = node["count"] / total * width
+        if w < 0.3:
+            return
+        y = height - (level + 1) * row
+        # Stable warm colour per frame name, as flamegraph.pl does
+        hue = int(hashlib.md5(name.encode("utf-8")).hexdigest()[:4], 16)
+        colour = f"rgb({205 + hue % 50},{80 + hue % 130},{hue % 55})"
+        label = html.escape(name)
+        text = html.escape(name[:int(w / 7)]) if w > 21 else ""
+        rects.append(
+            f'<g><title>{label} ({node["count"]} samples, {100 * node["count"] / total:.1f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row - 1}" fill="{colour}"/>'
+            f'<text x="{x + 3:.1f}" y="{y + row - 4}">{text}</text></g>'
+        )
+        child_x = x
+        for child_name, child in sorted(node["children"].items()):
+            place(child_name, child, child_x, level + 1)
+            child_x += child["count"] / total * width
+    
+    place("all", root, 0.0, 0)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height}" font-family="monospace" font-size="11">'
+        f'<text x="{width / 2:.0f}" y="20" text-anchor="middle" font-size="15">{html.escape(title)}</text>'
+        + "".join(rects) + "</svg>"
+    )
+
+class ProfileCapture:
+    """One request's profile: stage spans, stack samples and torch.profiler sessions while it runs"""
+    
+    def __init__(self, capture_id: str, directory: str, info: dict, modes: set, interval_seconds: float, max_seconds: float):
+        self.id = capture_id
+        self.directory = directory
+        self.info = info
+        self.modes = modes
+        self.interval = interval_seconds
+        self.created_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []  # (stage, thread name, start, end) in perf_counter seconds
+        self.files = []
+        self._lock = threading.Lock()
+        self.sampler = StackSampler(interval_seconds, max_seconds) if "sampling" in modes else None
+        os.makedirs(directory, exist_ok=True)
+        if self.sampler is not None:
+            self.sampler.start()
+    
+    def span(self, stage: str, started: float, ended: float):
+        self.spans.append((stage, threading.current_thread().name, started, ended))
+    
+    def add_file(self, name: str):
+        with self._lock:
+            self.files.append(name)
+    
+    def next_name(self, stem: str) -> str:
+        with self._lock:
+            return f"{stem}_{sum(1 for name in self.files if name.startswith(stem + '_'))}"
+    
+    def write(self, outcome: dict):
+        """Stop sampling and write the trace, flame graph and metadata; runs off the event loop"""
+        wall_seconds = time.perf_counter() - self.started
+        samples = []
+        if self.sampler is not None:
+            self.sampler.stop()
+            samples = self.sampler.samples
+        
+        # Chrome trace (chrome://tracing, Perfetto): stages on their own track per thread,
+        # sampled Python stacks as a flame chart underneath
+        tracks = {}
+        
+        def track(name: str) -> int:
+            return tracks.setdefault(name, len(tracks))
+        
+        events = [{
+            "name": f"{self.info['path']} {self.info.get('prompt', '')[:40]}", "cat": "request", "ph": "X",
+            "ts": 0, "dur": round(wall_seconds * 1e6), "pid": 0, "tid": track("request"),
+        }]
+        for stage, thread, started, ended in self.spans:
+            events.append({
+                "name": stage, "cat": "stage", "ph": "X", "pid": 0, "tid": track(f"{thread} stages"),
+                "ts": round((started - self.started) * 1e6), "dur": round((ended - started) * 1e6),
+            })
+        for thread, frame, started, ended in sample_spans(samples, self.interval):
+            events.append({
+                "name": frame, "cat": "sample", "ph": "X", "pid": 0, "tid": track(thread),
+                "ts": round(started * 1e6), "dur": round((ended - started) * 1e6),
+            })
+        events.extend(
+            {"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": name}}
+            for name, tid in tracks.items()
+        )
+        with open(os.path.join(self.directory, "trace.json"), "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": self.info}, f)
+        self.add_file("trace.json")
+        
+        if self.sampler is not None:
+            folded = {}
+            for _, thread, stack in samples:
+                key = (thread,) + stack
+                folded[key] = folded.get(key, 0) + 1
+            with open(os.path.join(self.directory, "flamegraph.folded"), "w") as f:
+                f.writelines(f"{';'.join(stack)} {count}\n" for stack, count in folded.items())
+            with open(os.path.join(self.directory, "flamegraph.svg"), "w") as f:
+                f.write(render_flamegraph_svg(folded, f"{self.info['path']}: {len(samples)} samples every {self.interval * 1000:g} ms"))
+            self.add_file("flamegraph.folded")
+            self.add_file("flamegraph.svg")
+        
+        metadata = {
+            "capture_id": self.id,
+            "created_at": self.created_at,
+            "wall_seconds": round(wall_seconds, 3),
+            "modes": sorted(self.modes),
+            "samples": len(samples),
+            "stages": [
+                {"stage": stage, "thread": thread, "start_seconds": round(started - self.started, 4), "seconds": round(ended - started, 4)}
+                for stage, thread, started, ended in self.spans
+            ],
+            **self.info,
+            **outcome,
+            "files": sorted(self.files),
+        }
+        with open(os.path.join(self.directory, "capture.json"), "w") as f:
+            json.dump(metadata, f, indent=2)
+        return metadata
+
+class RequestProfiler:
+    """
+    On-demand profiling of live requests, armed from /admin/profile.
+    
+    While disarmed the only cost is one attribute check per request. Once armed, the next
+    matching requests are captured one at a time: the capture covers the whole process
+    for as long as the request is in flight, since its work is spread over the event
+    loop, the inference, decode and loader threads and may share a batch with others.
+    Sampling stops after max_seconds so a stuck request can't grow a capture without bound.
+    """
+    
+    FILTERS = ("prompt_contains", "model", "path", "client", "min_duration")
+    
+    def __init__(self, directory: str, max_captures: int, max_bytes: int, retention_seconds: float, max_seconds: float):
+        self.directory = directory
+        self.max_captures = max_captures
+        self.max_bytes = max_bytes
+        self.retention_seconds = retention_seconds
+        self.max_seconds = max_seconds
+        self.armed = None  # arm settings and how many captures remain, None when disarmed
+        self.current = None  # ProfileCapture in progress
+        self.captured = 0
+    
+    def arm(self, settings: dict) -> dict:
+        self.armed = {**settings, "armed_at": time.time()}
+        print(f"🔬 Profiler armed for {settings['remaining']} request(s): {settings['filters'] or 'any'}")
+        return self.armed
+    
+    def disarm(self):
+        self.armed = None
+    
+    def _matches(self, filters: dict, info: dict) -> bool:
+        for name, wanted in filters.items():
+            if name == "prompt_contains":
+                if wanted.lower() not in info.get("prompt", "").lower():
+                    return False
+            elif name == "min_duration":
+                if (info.get("duration") or 0) < wanted:
+                    return False
+            elif info.get(name) != wanted:
+                return False
+        return True
+    
+    def begin(self, path: str, request=None, client: Optional[str] = None) -> Optional[ProfileCapture]:
+        """Start capturing this request (a GenerateRequest, if it has one) if the profiler is armed for it, else None"""
+        armed = self.armed
+        if armed is None or self.current is not None:
+            return None
+        if time.time() > armed["expires_at"]:
+            self.armed = None
+            return None
+        info = {"path": path, "client": client}
+        if request is not None:
+            info.update(prompt=request.prompt, model=request.model or request.model_size, duration=request.duration, seed=request.seed)
+        if not self._matches(armed["filters"], info):
+            return None
+        
+        armed["remaining"] -= 1
+        if armed["remaining"] <= 0:
+            self.armed = None
+        capture_id = uuid.uuid4().hex[:16]
+        self.current = ProfileCapture(capture_id, os.path.join(self.directory, capture_id), info, armed["modes"], armed["interval_seconds"], self.max_seconds)
+        print(f"🔬 Capturing profile {capture_id} for {path}")
+        return self.current
+    
+    async def end(self, capture: Optional[ProfileCapture], outcome: dict):
+        """Finish a capture from begin() and write it out; a no-op for None"""
+        if capture is None:
+            return
+        self.current = None
+        metadata = await asyncio.get_running_loop().run_in_executor(None, capture.write, outcome)
+        self.captured += 1
+        await asyncio.get_running_loop().run_in_executor(None, self.prune)
+        print(f"🔬 Profile {capture.id} written: {metadata['samples']} samples over {metadata['wall_seconds']}s")
+    
+    @contextmanager
+    def torch_session(self, stage: str):
+        """Record the block with torch.profiler into the current capture when it asked for torch traces"""
+        capture = self.current
+        if capture is None or "torch" not in capture.modes:
+            yield
+            return
+        import torch
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, record_shapes=True) as session:
+            yield
+        name = capture.next_name(f"torch_{stage}")
+        session.export_chrome_trace(os.path.join(capture.directory, f"{name}.json"))
+        with open(os.path.join(capture.directory, f"{name}.txt"), "w") as f:
+            f.write(session.key_averages().table(sort_by="self_cpu_time_total", row_limit=40))
+        capture.add_file(f"{name}.json")
+        capture.add_file(f"{name}.txt")
+    
+    def captures(self) -> list:
+        """Metadata of the stored captures, newest first"""
+        found = []
+        if os.path.isdir(self.directory):
+            for capture_id in os.listdir(self.directory):
+                try:
+                    with open(os.path.join(self.directory, capture_id, "capture.json")) as f:
+                        found.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return sorted(found, key=lambda capture: capture["created_at"], reverse=True)
+    
+    def artifact_path(self, capture_id: str, name: str) -> Optional[str]:
+        """Path of one file of a capture, None for unknown ids and names"""
+        if not capture_id.isalnum() or os.sep in name or name.startswith("."):
+            return None
+        path = os.path.join(self.directory, capture_id, name)
+        return path if os.path.isfile(path) else None
+    
+    def prune(self):
+        """Drop captures past the retention age, then the oldest beyond the count and size limits"""
+        now = time.time()
+        kept = []
+        for capture in self.captures():
+            if now - capture["created_at"] > self.retention_seconds:
+                shutil.rmtree(os.path.join(self.directory, capture["capture_id"]), ignore_errors=True)
+            else:
+                kept.append(capture)
+        total = 0
+        for index, capture in enumerate(kept):
+            path = os.path.join(self.directory, capture["capture_id"])
+            total += sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            if index >= self.max_captures or total > self.max_bytes:
+                shutil.rmtree(path, ignore_errors=True)
+    
+    def stats(self) -> dict:
+        armed = self.armed
+        return {
+            "armed": armed is not None,
+            "remaining": armed["remaining"] if armed is not None else 0,
+            "filters": armed["filters"] if armed is not None else None,
+            "capturing": self.current.id if self.current is not None else None,
+            "captured": self.captured,
+        }
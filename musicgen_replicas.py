@@ -0,0 +1,288 @@
+"""
+CPU replica processes for musicgen_server.py.
+
+Each replica is a spawned process pinned to its own cores that runs inference calls
+on models whose weights live in shared memory, so RAM does not grow with the number of
+workers. Text conditionings computed on any replica are shared through the front
+process's conditioning cache.
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+
+from musicgen_common import ConditioningCache
+
+def share_model_memory(loaded):
+    """Move a model's weights into shared memory so replicas map them instead of copying"""
+    loaded.lm.share_memory()
+    loaded.compression_model.share_memory()
+    # A frozen T5 is kept outside the LM's module tree (see optimize_for_cpu)
+    for conditioner in getattr(getattr(loaded.lm, "condition_provider", None), "conditioners", {}).values():
+        t5 = conditioner.__dict__.get("t5")
+        if t5 is not None:
+            t5.share_memory()
+    # The pattern provider memoises get_pattern() in an lru_cache on the instance, which
+    # can't be pickled; it is called once per generate(), so drop the memo
+    loaded.lm.pattern_provider.__dict__.pop("get_pattern", None)
+    loaded.shared_memory = True
+    return loaded
+
+def portable_conditioning(entries) -> list:
+    """((size, text), embeddings) entries as numpy arrays, sent between processes by value"""
+    return [(key, embeds.numpy()) for key, embeds in entries]
+
+def merge_conditioning(conditioning_cache: ConditioningCache, entries: list):
+    """Add entries from portable_conditioning() to a conditioning cache"""
+    import torch
+    for (size, text), embeds in entries:
+        conditioning_cache.put(size, text, torch.from_numpy(embeds))
+
+def replica_main(index: int, cores: list, setup, tasks, results):
+    """
+    CPU replica process: runs inference calls from its task queue on its own cores.
+    
+    Models arrive inside task messages the first time a replica serves a size; their
+    tensors are shared-memory handles, so every replica uses the front process's copy.
+    Their text conditioners use this process's conditioning cache, which each task tops
+    up with the front process's entries; the entries a task adds and its lookups are
+    reported back ahead of its result.
+    
+    setup(cores) runs first, in this process; it pins inference to the cores and returns
+    the conditioning cache the replica's models use.
+    """
+    conditioning_cache = setup(cores)
+    
+    models = {}  # size -> model
+    while True:
+        message = tasks.get()
+        if message is None:
+            break
+        task_id, size, shared_model, resident, conditioning, fn, args, kwargs, wants_progress, wants_chunks = message
+        for stale in set(models) - set(resident):
+            del models[stale]
+        if shared_model is not None:
+            if conditioning_cache.max_bytes > 0:
+                conditioning_cache.install(shared_model, size)
+            models[size] = shared_model
+        merge_conditioning(conditioning_cache, conditioning)
+        
+        if wants_progress:
+            last_percent = [-1]
+            
+            def relay_progress(generated_tokens, total_tokens):
+                percent = int(100 * generated_tokens / total_tokens) if total_tokens else 0
+                if percent != last_percent[0]:
+                    last_percent[0] = percent
+                    results.put((task_id, "progress", (generated_tokens, total_tokens)))
+            
+            kwargs["on_progress"] = relay_progress
+        if wants_chunks:
+            kwargs["on_chunk"] = lambda chunk: results.put((task_id, "chunk", chunk))
+        
+        known = {key for key, _ in conditioning_cache.items()}
+        hits, misses = conditioning_cache.hits, conditioning_cache.misses
+        try:
+            outcome = ("result", fn(models[size], *args, **kwargs))
+        except Exception as e:
+            outcome = ("error", f"{type(e).__name__}: {e}")
+        added = [(key, embeds) for key, embeds in conditioning_cache.items() if key not in known]
+        results.put((task_id, "conditioning", (
+            portable_conditioning(added), conditioning_cache.hits - hits, conditioning_cache.misses - misses,
+        )))
+        results.put((task_id, *outcome))
+
+class ReplicaPool:
+    """
+    CPU worker processes, each pinned to its own slice of cores, sharing model weights.
+    
+    The front process keeps loading models; with replicas enabled their weights are moved
+    to shared memory on load (share_model_memory) and handed to a replica the first
+    time it serves that size, so RAM does not grow with the number of workers. Each call
+    goes to the next idle replica, so up to `workers` batches render at once. A replica
+    that dies (OOM kill, crash in torch) fails the call it was running and is respawned.
+    
+    The front process's conditioning cache is the shared one: each call carries the
+    entries its replica hasn't seen, and the entries and lookups a replica reports back
+    are merged into it, so a prompt conditioned on one replica is a hit on the others
+    and /stats covers them all. setup is passed to replica_main().
+    """
+    
+    def __init__(self, workers: int, setup, conditioning_cache: ConditioningCache):
+        self.workers = workers
+        self.setup = setup
+        self.conditioning_cache = conditioning_cache
+        self._processes = []
+        self._task_queues = []
+        self._cores = []  # per replica: the cores it is pinned to
+        self._sent = []  # per replica: size -> weakref to the model it holds
+        self._synced = []  # per replica: conditioning cache keys it has been sent or has reported
+        self._idle = None
+        self._pending = {}  # task id -> (future, progress callback, chunk callback, replica index)
+        self._dying = set()  # replicas seen dead and not respawned yet
+        self._next_task = 0
+        self._loop = None
+        self._stopping = False
+        self.calls = 0
+        self.restarts = 0
+    
+    def start(self):
+        import torch.multiprocessing as mp
+        
+        self._loop = asyncio.get_running_loop()
+        self._idle = asyncio.Queue()
+        self._context = mp.get_context("spawn")
+        self._results = self._context.Queue()
+        
+        cores = sorted(os.sched_getaffinity(0))
+        per_worker = max(1, len(cores) // self.workers)
+        for index in range(self.workers):
+            self._cores.append(cores[index * per_worker:(index + 1) * per_worker] or cores[-per_worker:])
+            self._processes.append(None)
+            self._task_queues.append(None)
+            self._sent.append({})
+            self._synced.append(set())
+            self._spawn(index)
+            self._idle.put_nowait(index)
+        
+        threading.Thread(target=self._read_results, name="musicgen-replica-results", daemon=True).start()
+        threading.Thread(target=self._watch, name="musicgen-replica-watch", daemon=True).start()
+    
+    def _spawn(self, index: int):
+        worker_cores = self._cores[index]
+        tasks = self._context.Queue()
+        process = self._context.Process(
+            target=replica_main, args=(index, worker_cores, self.setup, tasks, self._results),
+            name=f"musicgen-replica-{index}", daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+        self._task_queues[index] = tasks
+        # A new process holds no models or conditioning yet
+        self._sent[index] = {}
+        self._synced[index] = set()
+        print(f"🧩 Replica {index} started on cores {worker_cores[0]}-{worker_cores[-1]}")
+    
+    def _read_results(self):
+        while True:
+            task_id, kind, payload = self._results.get()
+            self._loop.call_soon_threadsafe(self._deliver, task_id, kind, payload)
+    
+    def _watch(self):
+        """Wait on the replicas' process sentinels and report any that exit"""
+        from multiprocessing.connection import wait
+        while True:
+            watched = {
+                process.sentinel: index
+                for index, process in enumerate(self._processes)
+                if index not in self._dying
+            }
+            # The timeout picks up the sentinels of respawned replicas
+            ready = wait(list(watched), timeout=1.0)
+            if self._stopping:
+                return
+            for sentinel in ready:
+                index = watched[sentinel]
+                self._dying.add(index)
+                try:
+                    self._loop.call_soon_threadsafe(self._replica_died, index)
+                except RuntimeError:
+                    return  # the event loop is gone; the server is shutting down
+    
+    def _replica_died(self, index: int):
+        # The sentinel is ready, so this only reaps the process
+        self._processes[index].join(1)
+        exitcode = self._processes[index].exitcode
+        print(f"💥 Replica {index} died (exit code {exitcode}), respawning")
+        for task_id, (future, _, _, task_index) in list(self._pending.items()):
+            if task_index == index:
+                del self._pending[task_id]
+                if not future.done():
+                    future.set_exception(RuntimeError(f"Replica {index} died (exit code {exitcode})"))
+        self.restarts += 1
+        self._spawn(index)
+        self._dying.discard(index)
+    
+    def _deliver(self, task_id, kind, payload):
+        if kind == "conditioning":
+            self._merge_conditioning(task_id, *payload)
+            return
+        future, on_progress, on_chunk, _ = self._pending.get(task_id, (None, None, None, None))
+        if future is None:
+            return
+        if kind == "progress":
+            if on_progress is not None:
+                on_progress(*payload)
+            return
+        if kind == "chunk":
+            on_chunk(payload)
+            return
+        del self._pending[task_id]
+        if future.done():
+            return
+        if kind == "error":
+            future.set_exception(RuntimeError(payload))
+        else:
+            future.set_result(payload)
+    
+    def _merge_conditioning(self, task_id, entries: list, hits: int, misses: int):
+        merge_conditioning(self.conditioning_cache, entries)
+        self.conditioning_cache.count_lookups(hits, misses)
+        pending = self._pending.get(task_id)
+        if pending is not None:
+            self._synced[pending[3]].update(key for key, _ in entries)
+    
+    async def run(self, size: str, gen_model, fn, args: tuple, kwargs: dict, resident: list, on_start=None):
+        """
+        Run fn(model, *args, **kwargs) on an idle replica, returns its result.
+        
+        resident lists the model sizes still loaded in the front process; the replica
+        drops any other model it holds.
+        """
+        if self._idle is None:
+            self.start()
+        on_progress = kwargs.pop("on_progress", None)
+        on_chunk = kwargs.pop("on_chunk", None)
+        
+        index = await self._idle.get()
+        try:
+            if on_start is not None:
+                on_start()
+            held = self._sent[index].get(size)
+            shared_model = None if held is not None and held() is gen_model else gen_model
+            if shared_model is not None:
+                self._sent[index][size] = weakref.ref(gen_model)
+            entries = self.conditioning_cache.items()
+            conditioning = portable_conditioning(
+                (key, embeds) for key, embeds in entries if key not in self._synced[index]
+            )
+            self._synced[index] = {key for key, _ in entries}
+            
+            task_id = self._next_task
+            self._next_task += 1
+            future = self._loop.create_future()
+            self._pending[task_id] = (future, on_progress, on_chunk, index)
+            self._task_queues[index].put((
+                task_id, size, shared_model, resident, conditioning, fn, args, kwargs,
+                on_progress is not None, on_chunk is not None,
+            ))
+            self.calls += 1
+            return await asyncio.shield(future)
+        finally:
+            self._idle.put_nowait(index)
+    
+    def stop(self):
+        """Let every replica finish its call and exit, without respawning them"""
+        self._stopping = True
+        for tasks in self._task_queues:
+            tasks.put(None)
+    
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "alive": sum(1 for process in self._processes if process is not None and process.is_alive()),
+            "idle": self._idle.qsize() if self._idle is not None else self.workers,
+            "calls": self.calls,
+            "restarts": self.restarts,
+        }
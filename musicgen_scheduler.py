@@ -0,0 +1,290 @@
+"""
+Admission control and scheduling for musicgen_server.py's inference workers.
+
+InferenceQueue admits requests up to a queue depth and holds clients to their
+ClientQuotas; InferenceScheduler hands the worker slots to admitted work, shortest
+estimated job first.
+"""
+
+import asyncio
+import math
+import threading
+import time
+from typing import Optional
+
+from prometheus_client import Counter, Histogram
+
+# Prometheus metrics, exposed on musicgen_server.py's /metrics
+SCHEDULER_WAIT_SECONDS = Histogram(
+    "musicgen_scheduler_wait_seconds", "Time a job waited for the inference worker", ["model"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+CLIENT_REJECTIONS = Counter("musicgen_client_rejections_total", "Requests rejected by per-client limits", ["reason"])
+
+class QueueFullError(Exception):
+    """Raised when the inference queue can't admit another request"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class ClientLimitError(Exception):
+    """Raised when a client is over its concurrency limit or out of quota"""
+    
+    def __init__(self, reason: str, retry_after: int):
+        message = "Too many requests in progress" if reason == "concurrency" else "Compute quota exhausted"
+        super().__init__(f"{message} for this client, retry in {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+class ClientQuotas:
+    """
+    Per-client admission: a cap on items queued or running, and a token bucket of
+    estimated compute seconds. Only called under the InferenceQueue lock.
+    """
+    
+    def __init__(self, max_concurrent: int, rate: float, burst: float):
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self._clients = {}  # client id -> {"active", "tokens", "updated", "admitted", "rejected"}
+    
+    def _client(self, client: str) -> dict:
+        entry = self._clients.get(client)
+        now = time.monotonic()
+        if entry is None:
+            entry = self._clients[client] = {"active": 0, "tokens": self.burst, "updated": now, "admitted": 0, "rejected": 0}
+        elif self.rate > 0:
+            entry["tokens"] = min(self.burst, entry["tokens"] + (now - entry["updated"]) * self.rate)
+        entry["updated"] = now
+        return entry
+    
+    def admit(self, client: str, items: int, cost_seconds: float):
+        entry = self._client(client)
+        if self.max_concurrent > 0 and entry["active"] + items > max(self.max_concurrent, items):
+            entry["rejected"] += 1
+            CLIENT_REJECTIONS.labels("concurrency").inc()
+            raise ClientLimitError("concurrency", 5)
+        # A request costing more than the whole bucket still gets in when the bucket is full
+        if self.rate > 0 and cost_seconds > entry["tokens"] and entry["tokens"] < self.burst:
+            entry["rejected"] += 1
+            CLIENT_REJECTIONS.labels("quota").inc()
+            raise ClientLimitError("quota", max(1, math.ceil((min(cost_seconds, self.burst) - entry["tokens"]) / self.rate)))
+        if self.rate > 0:
+            entry["tokens"] -= cost_seconds
+        entry["active"] += items
+        entry["admitted"] += items
+    
+    def release(self, client: str, items: int):
+        entry = self._clients.get(client)
+        if entry is not None:
+            entry["active"] -= items
+    
+    def stats(self) -> dict:
+        # Idle clients with a full bucket carry no state worth keeping
+        for client, entry in list(self._clients.items()):
+            if entry["active"] == 0 and (self.rate == 0 or self._client(client)["tokens"] >= self.burst):
+                del self._clients[client]
+        return {
+            client: {
+                "active": entry["active"],
+                "admitted": entry["admitted"],
+                "rejected": entry["rejected"],
+                "quota_seconds": round(self._client(client)["tokens"], 1) if self.rate > 0 else None,
+            }
+            for client, entry in self._clients.items()
+        }
+
+class InferenceQueue:
+    """
+    Admission control and accounting for work headed to the inference executor.
+    
+    A request is admitted when it arrives and released once its audio comes back. Items
+    move from queued to in-flight while the executor is running their batch. The average
+    per-item service time is tracked as an exponential moving average to estimate waits.
+    Requests from a client are also held to that client's limits in ClientQuotas.
+    """
+    
+    def __init__(self, max_depth: int, clients: ClientQuotas):
+        self.max_depth = max_depth
+        self.clients = clients
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.in_flight = 0
+        self.rejected = 0
+        self.completed = 0
+        self.average_item_seconds = None
+    
+    def admit(self, items: int = 1, client: Optional[str] = None, cost_seconds: float = 0.0):
+        with self._lock:
+            # An oversized request still gets in when the queue is empty
+            if self.admitted - self.in_flight + items > max(self.max_depth, items):
+                self.rejected += 1
+                raise QueueFullError(max(1, math.ceil(self._estimated_wait())))
+            if client is not None:
+                self.clients.admit(client, items, cost_seconds)
+            self.admitted += items
+    
+    def release(self, items: int = 1, client: Optional[str] = None):
+        with self._lock:
+            self.admitted -= items
+            if client is not None:
+                self.clients.release(client, items)
+    
+    def start(self, items: int):
+        with self._lock:
+            self.in_flight += items
+    
+    def finish(self, items: int, seconds: float):
+        with self._lock:
+            self.in_flight -= items
+            self.completed += items
+            item_seconds = seconds / max(1, items)
+            if self.average_item_seconds is None:
+                self.average_item_seconds = item_seconds
+            else:
+                self.average_item_seconds = 0.8 * self.average_item_seconds + 0.2 * item_seconds
+    
+    def client_stats(self) -> dict:
+        with self._lock:
+            return self.clients.stats()
+    
+    def _estimated_wait(self) -> float:
+        # Nothing has run yet: assume one model load plus a full 30s clip
+        item_seconds = self.average_item_seconds if self.average_item_seconds is not None else 60.0
+        return self.admitted * item_seconds
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "depth": self.admitted - self.in_flight,
+                "max_depth": self.max_depth,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "average_item_seconds": round(self.average_item_seconds, 3) if self.average_item_seconds is not None else None,
+                "estimated_wait_seconds": round(self._estimated_wait(), 2),
+            }
+
+class ScheduledJob:
+    """One call waiting for, or holding, an inference slot"""
+    
+    def __init__(self, size: str, audio_seconds: float, cost: float, clients: tuple, turn):
+        self.size = size
+        self.audio_seconds = audio_seconds
+        self.cost = cost
+        self.clients = clients
+        self.turn = turn  # future resolved when the job may run
+        self.enqueued_at = time.perf_counter()
+
+class InferenceScheduler:
+    """
+    Hands inference slots to waiting work by shortest estimated job first, with aging.
+    
+    There is one slot per inference worker (the inference thread, or each CPU replica),
+    counted by slots(). Waiting jobs are ranked by their estimated compute seconds, plus
+    the estimated work their clients already have running, minus aging_rate x seconds
+    waited. Short previews overtake a queue of long renders, a client already holding the
+    worker yields to the others, and a long job's rank keeps improving until it runs.
+    """
+    
+    def __init__(self, aging_rate: float, cost_priors: dict, slots):
+        self.aging_rate = aging_rate
+        self.rates = dict(cost_priors)  # model size -> compute seconds per audio second
+        self.slots = slots
+        self._waiting = []
+        self._running = 0
+        self._running_cost = {}  # client id -> estimated seconds of its work running
+        self.dispatched = 0
+        self.overtaken = 0
+    
+    def estimate(self, size: str, audio_seconds: float) -> float:
+        """Estimated compute seconds for audio_seconds of audio (per generate() call) from size"""
+        return self.rates.get(size, max(self.rates.values())) * audio_seconds
+    
+    def _priority(self, job: ScheduledJob, now: float) -> float:
+        running = sum(self._running_cost.get(client, 0.0) for client in job.clients) / max(1, len(job.clients))
+        return job.cost + running - self.aging_rate * (now - job.enqueued_at)
+    
+    def _dispatch(self):
+        while self._waiting and self._running < self.slots():
+            now = time.perf_counter()
+            job = min(self._waiting, key=lambda job: self._priority(job, now))
+            if job is not self._waiting[0]:
+                self.overtaken += 1
+            self._waiting.remove(job)
+            if job.turn.done():
+                continue  # the caller went away
+            self._running += 1
+            for client in job.clients:
+                self._running_cost[client] = self._running_cost.get(client, 0.0) + job.cost / len(job.clients)
+            SCHEDULER_WAIT_SECONDS.labels(job.size).observe(now - job.enqueued_at)
+            self.dispatched += 1
+            job.turn.set_result(None)
+    
+    def _finish(self, job: ScheduledJob, started: float):
+        self._running -= 1
+        for client in job.clients:
+            remaining = self._running_cost.get(client, 0.0) - job.cost / len(job.clients)
+            if remaining > 1e-9:
+                self._running_cost[client] = remaining
+            else:
+                self._running_cost.pop(client, None)
+        if job.audio_seconds > 0:
+            rate = (time.perf_counter() - started) / job.audio_seconds
+            self.rates[job.size] = 0.8 * self.rates.get(job.size, rate) + 0.2 * rate
+        self._dispatch()
+    
+    async def run(self, size: str, audio_seconds: float, clients, call):
+        """
+        Wait for a slot, then return await call(). The slot is held until call() has
+        finished, even if the caller is cancelled, so a slot always means a busy worker.
+        """
+        loop = asyncio.get_running_loop()
+        job = ScheduledJob(size, audio_seconds, self.estimate(size, audio_seconds), tuple(clients), loop.create_future())
+        self._waiting.append(job)
+        self._dispatch()
+        try:
+            await job.turn
+        except asyncio.CancelledError:
+            if job in self._waiting:
+                self._waiting.remove(job)
+            elif job.turn.done() and not job.turn.cancelled():
+                # The turn came just as we were cancelled; nothing ran, so nothing to learn
+                job.audio_seconds = 0.0
+                self._finish(job, time.perf_counter())
+            raise
+        
+        started = time.perf_counter()
+        work = asyncio.ensure_future(call())
+        
+        def finished(work):
+            self._finish(job, started)
+            if not work.cancelled():
+                work.exception()  # the caller may be gone; don't warn about it
+        
+        work.add_done_callback(finished)
+        return await asyncio.shield(work)
+    
+    def client_stats(self) -> dict:
+        waiting = {}
+        for job in self._waiting:
+            for client in job.clients:
+                waiting[client] = waiting.get(client, 0) + 1
+        return {
+            client: {"waiting": waiting.get(client, 0), "running_estimated_seconds": round(self._running_cost.get(client, 0.0), 1)}
+            for client in set(waiting) | set(self._running_cost)
+        }
+    
+    def stats(self) -> dict:
+        now = time.perf_counter()
+        return {
+            "slots": self.slots(),
+            "running": self._running,
+            "waiting": len(self._waiting),
+            "oldest_wait_seconds": round(max((now - job.enqueued_at for job in self._waiting), default=0.0), 2),
+            "aging_rate": self.aging_rate,
+            "seconds_per_audio_second": {size: round(rate, 3) for size, rate in self.rates.items()},
+            "dispatched": self.dispatched,
+            "overtaken": self.overtaken,
+        }
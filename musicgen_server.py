@@ -4,19 +4,53 @@ MusicGen Local Server
 FastAPI server for local MusicGen inference using AudioCraft
 """
 
-from fastapi import FastAPI, HTTPException
+import time
+
+# Startup phases are measured from here
+PROCESS_STARTED = time.perf_counter()
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from musicgen_common import AUDIO_FORMATS, Crossfader, encode_audio, encode_wav, encode_wav_batch
+from musicgen_cache import AudioStore, GenerationCache, MeteredConditioningCache, make_cache_key, rendition_key
+from musicgen_code_store import CodeStore
+from musicgen_library import PromptEmbedder, PromptLibrary
+from musicgen_profiler import RequestProfiler
+from musicgen_replicas import ReplicaPool, share_model_memory
+from musicgen_scheduler import ClientLimitError, ClientQuotas, InferenceQueue, InferenceScheduler, QueueFullError
+from musicgen_single_flight import Flight, SingleFlight
+import asyncio
 import base64
-import io
-import time
-import torch
-import torchaudio
-from audiocraft.models import MusicGen
-from audiocraft.data.audio import audio_write
+import gc
+import hashlib
+import hmac
+import json
+import math
+import os
+import resource
+import threading
+import uuid
 
-app = FastAPI(title="MusicGen Server")
+# torch and audiocraft take seconds to import, so they are imported on the startup
+# thread (see init_torch) and /health answers as soon as the process is up
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_start_task = asyncio.ensure_future(warm_start())
+    yield
+    warm_start_task.cancel()
+    if replica_pool is not None:
+        replica_pool.stop()
+    conditioning_cache.save()
+
+app = FastAPI(title="MusicGen Server", lifespan=lifespan)
 
 # CORS middleware for frontend access
 app.add_middleware(
@@ -25,21 +59,347 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["*"],
 )
 
-# Global model variable
-model = None
-model_size = "small"  # Options: 'small', 'medium', 'large', 'melody'
-device = "cuda" if torch.cuda.is_available() else "cpu"
+device = None  # set by init_torch() once torch is imported
+
+# Startup configuration
+# These sizes are loaded and warmed up in the background at startup; /ready flips once they are
+PRELOAD_MODELS = [size for size in os.environ.get("MUSICGEN_PRELOAD_MODELS", "small").split(",") if size]
+# Length of the warm-up generation that triggers kernel selection and allocator growth
+WARMUP_SECONDS = float(os.environ.get("MUSICGEN_WARMUP_SECONDS", "1"))
+
+# CPU inference configuration
+# Sizes listed here ("all" for every size) get the CPU-optimised path when running on CPU:
+# dynamic int8 quantization of the LM linear layers, bf16 autocast of the LM forward pass
+# (when the CPU has native bf16) and torch.inference_mode. Compare with benchmark_cpu_inference.py
+CPU_OPTIMIZED_MODELS = [size for size in os.environ.get("MUSICGEN_CPU_OPTIMIZED_MODELS", "").split(",") if size]
+CPU_QUANTIZE_INT8 = os.environ.get("MUSICGEN_CPU_QUANTIZE_INT8", "1") == "1"
+CPU_AUTOCAST_BF16 = os.environ.get("MUSICGEN_CPU_AUTOCAST_BF16", "auto")  # "auto", "1" or "0"
+# 0 keeps torch's defaults (one intra-op thread per physical core)
+CPU_THREADS = int(os.environ.get("MUSICGEN_CPU_THREADS", "0"))
+CPU_INTEROP_THREADS = int(os.environ.get("MUSICGEN_CPU_INTEROP_THREADS", "0"))
+
+# CPU replica pool configuration
+# With N > 0 on a CPU host, inference runs in N worker processes, each pinned to its own
+# slice of cores, sharing one copy of the model weights through shared memory
+CPU_WORKERS = int(os.environ.get("MUSICGEN_CPU_WORKERS", "0"))
+
+# Benchmark configuration
+# Every model size resolves to AudioCraft's tiny randomly initialised "debug" MusicGen,
+# so batching, encoding and scheduling can be load-tested on CPU without weights
+TINY_MODEL = os.environ.get("MUSICGEN_TINY_MODEL", "0") == "1"
+
+# Model pool configuration
+# Several model sizes stay resident as long as they fit in MODEL_MEMORY_BUDGET_GB;
+# the least recently used idle model is evicted to make room for a new one
+MODEL_MEMORY_BUDGET_GB = float(os.environ.get("MUSICGEN_MODEL_MEMORY_BUDGET_GB", "12"))
+# Rough resident footprint (LM + T5 + EnCodec) used to plan evictions before a size is loaded
+MODEL_SIZE_ESTIMATES_GB = {"small": 2.4, "medium": 7.0, "large": 14.0, "melody": 7.5}
+
+# Memory-aware batching
+# The peak memory of every batch is recorded per (model, duration, batch size), and batches
+# are capped to what is predicted to fit in MEMORY_HEADROOM of the free memory: CUDA free
+# plus cached memory, or on CPU what is left of CPU_MEMORY_LIMIT_GB of RSS (0 = the cgroup
+# limit, else physical memory). A batch that runs out of memory anyway is split and retried;
+# after that, batch sizes for the shape stay capped for OOM_CAP_SECONDS
+MEMORY_HEADROOM = float(os.environ.get("MUSICGEN_MEMORY_HEADROOM", "0.9"))
+CPU_MEMORY_LIMIT_GB = float(os.environ.get("MUSICGEN_CPU_MEMORY_LIMIT_GB", "0"))
+OOM_CAP_SECONDS = float(os.environ.get("MUSICGEN_OOM_CAP_SECONDS", "600"))
+# Next smaller model for requests with allow_fallback when a size can't fit at all
+FALLBACK_MODELS = {"large": "medium", "medium": "small", "melody": "small"}
+
+# Micro-batching configuration
+# Concurrent requests with the same model, duration, decoder and temperature bucket
+# are gathered for up to BATCH_WINDOW_MS and rendered with a single generate() call
+BATCH_WINDOW_MS = float(os.environ.get("MUSICGEN_BATCH_WINDOW_MS", "50"))
+MAX_BATCH_SIZE = int(os.environ.get("MUSICGEN_MAX_BATCH_SIZE", "4"))
+TEMPERATURE_BUCKET = float(os.environ.get("MUSICGEN_TEMPERATURE_BUCKET", "0.05"))
+
+# Pipeline configuration
+# Generation runs in two stages with a queue between them: the language model on the inference
+# worker, then decoding its tokens to audio on a decode thread, so the LM starts on the next
+# batch while the last one decodes. CPU replicas run both stages themselves
+PIPELINE = os.environ.get("MUSICGEN_PIPELINE", "1") == "1"
+# Decode-stage backends; MultiBand Diffusion is loaded on first use and kept
+DECODERS = ("default", "multiband_diffusion")
+
+# Inference queue configuration
+# Requests beyond MAX_QUEUE_DEPTH waiting for the model are rejected with 503 + Retry-After
+MAX_QUEUE_DEPTH = int(os.environ.get("MUSICGEN_MAX_QUEUE_DEPTH", "16"))
+
+# Scheduler configuration
+# Work waiting for the inference worker runs shortest estimated job first. A job's estimate is
+# its audio seconds times the model's measured compute seconds per audio second (COST_PRIORS
+# until measured), and each second spent waiting takes SCHEDULER_AGING_RATE seconds off it
+SCHEDULER_AGING_RATE = float(os.environ.get("MUSICGEN_SCHEDULER_AGING_RATE", "1.0"))
+COST_PRIORS = {"small": 0.5, "medium": 1.2, "large": 2.5, "melody": 1.2}
+
+# Per-client limits
+# Requests are accounted to their X-API-Key, else the CLIENT_HEADER header, else the peer
+# address. A client may have CLIENT_MAX_CONCURRENT items queued or running, and spends
+# estimated compute seconds from a token bucket refilled at CLIENT_QUOTA_RATE per second up to
+# CLIENT_QUOTA_BURST. Both are off (0) by default: behind a proxy that doesn't set the header,
+# every user shares one peer address
+CLIENT_HEADER = os.environ.get("MUSICGEN_CLIENT_HEADER", "X-Client-Id")
+CLIENT_MAX_CONCURRENT = int(os.environ.get("MUSICGEN_CLIENT_MAX_CONCURRENT", "0"))
+CLIENT_QUOTA_RATE = float(os.environ.get("MUSICGEN_CLIENT_QUOTA_RATE", "0"))
+CLIENT_QUOTA_BURST = float(os.environ.get("MUSICGEN_CLIENT_QUOTA_BURST", "300"))
+
+# Streaming configuration
+# A streamed track is sampled in one LM pass and decoded from its progress callback each
+# time this much audio is complete; the first chunk is kept short to minimise
+# time-to-first-audio. Chunks are cross-faded like long-form windows
+STREAM_FIRST_CHUNK_SECONDS = float(os.environ.get("MUSICGEN_STREAM_FIRST_CHUNK_SECONDS", "2"))
+STREAM_CHUNK_SECONDS = float(os.environ.get("MUSICGEN_STREAM_CHUNK_SECONDS", "5"))
+
+# Long-form configuration
+# Durations above LONG_FORM_WINDOW_SECONDS (up to LONG_FORM_MAX_SECONDS) are rendered as
+# overlapping windows: each continues from the last LONG_FORM_CONTEXT_SECONDS of codes, so
+# the LM never attends over more than one window. Decoded windows are cross-faded over
+# LONG_FORM_CROSSFADE_SECONDS. Stored tracks longer than a window are decoded the same way
+LONG_FORM_MAX_SECONDS = int(os.environ.get("MUSICGEN_LONG_FORM_MAX_SECONDS", "180"))
+LONG_FORM_WINDOW_SECONDS = float(os.environ.get("MUSICGEN_LONG_FORM_WINDOW_SECONDS", "30"))
+LONG_FORM_CONTEXT_SECONDS = float(os.environ.get("MUSICGEN_LONG_FORM_CONTEXT_SECONDS", "10"))
+LONG_FORM_CROSSFADE_SECONDS = float(os.environ.get("MUSICGEN_LONG_FORM_CROSSFADE_SECONDS", "0.25"))
+# Each window must add new audio beyond its context, and more of it than the cross-fade
+# eats, or long-form rendering never reaches the requested duration
+if not 0 <= LONG_FORM_CONTEXT_SECONDS < LONG_FORM_WINDOW_SECONDS:
+    raise ValueError(
+        f"MUSICGEN_LONG_FORM_CONTEXT_SECONDS ({LONG_FORM_CONTEXT_SECONDS}) must be at least 0 "
+        f"and below MUSICGEN_LONG_FORM_WINDOW_SECONDS ({LONG_FORM_WINDOW_SECONDS})"
+    )
+if not 0 <= LONG_FORM_CROSSFADE_SECONDS < LONG_FORM_WINDOW_SECONDS - LONG_FORM_CONTEXT_SECONDS:
+    raise ValueError(
+        f"MUSICGEN_LONG_FORM_CROSSFADE_SECONDS ({LONG_FORM_CROSSFADE_SECONDS}) must be at least 0 "
+        f"and below the window minus its context ({LONG_FORM_WINDOW_SECONDS - LONG_FORM_CONTEXT_SECONDS})"
+    )
+
+# Every generated track is kept as its EnCodec codes under CODE_STORE_DIR and decoded
+# when /audio/{id} is fetched; recently served renditions stay cached within AUDIO_STORE_MB
+AUDIO_STORE_MB = float(os.environ.get("MUSICGEN_AUDIO_STORE_MB", "256"))
+# Sample rates /audio/{id} can resample to
+SERVE_SAMPLE_RATES = (16000, 22050, 24000, 32000, 44100, 48000)
+
+# Variations configuration
+# Upper bound on variations rendered by one /generate/variations call
+MAX_VARIATIONS = int(os.environ.get("MUSICGEN_MAX_VARIATIONS", "8"))
+
+# Job API configuration
+# Finished jobs (and their audio) are kept this long before GET /jobs/{id} returns 404
+JOB_RETENTION_SECONDS = float(os.environ.get("MUSICGEN_JOB_RETENTION_SECONDS", "3600"))
+# Finished jobs hold their encoded audio in memory; beyond these the oldest are dropped early
+# (the track itself stays available from /audio/{track_id})
+JOB_MAX_FINISHED = int(os.environ.get("MUSICGEN_JOB_MAX_FINISHED", "1000"))
+JOB_MAX_MB = float(os.environ.get("MUSICGEN_JOB_MAX_MB", "512"))
+
+# Generation cache configuration
+# Seeded requests are reproducible, so their audio is cached in memory and on disk
+CACHE_MEMORY_MB = float(os.environ.get("MUSICGEN_CACHE_MEMORY_MB", "256"))
+CACHE_DISK_MB = float(os.environ.get("MUSICGEN_CACHE_DISK_MB", "2048"))
+CACHE_DIR = os.environ.get("MUSICGEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".musicgen_cache"))
+CODE_STORE_DIR = os.environ.get("MUSICGEN_CODE_STORE_DIR", os.path.join(CACHE_DIR, "codes"))
+# /audio/{id}/extend conditions on up to this much of the end of the stored track, leaving
+# at least a second of the LONG_FORM_WINDOW_SECONDS window for new audio
+EXTEND_CONTEXT_SECONDS = float(os.environ.get("MUSICGEN_EXTEND_CONTEXT_SECONDS", "10"))
+
+# Prompt library: pregenerate_library.py renders the likeliest prompts off-peak into LIBRARY_DIR.
+# A request can be answered with the nearest library track by prompt embedding similarity,
+# without touching the GPU: "preview" (requests with preview=true), "all" or "off"
+LIBRARY_DIR = os.environ.get("MUSICGEN_LIBRARY_DIR", os.path.join(CACHE_DIR, "library"))
+LIBRARY_SERVE = os.environ.get("MUSICGEN_LIBRARY_SERVE", "preview")
+# Minimum cosine similarity between the request's prompt and a library prompt
+LIBRARY_THRESHOLD = float(os.environ.get("MUSICGEN_LIBRARY_THRESHOLD", "0.95"))
+# T5 encoder used for the prompt embeddings, always run on CPU
+LIBRARY_EMBEDDER = os.environ.get("MUSICGEN_LIBRARY_EMBEDDER", "t5-base")
+
+# Request coalescing configuration
+# Identical requests (prompt, model, duration, temperature bucket, decoder and seed) that arrive
+# while one is being rendered attach to it instead of generating again. "all", "seeded" (only
+# requests with a seed, which would render the same audio anyway) or "off"
+COALESCE = os.environ.get("MUSICGEN_COALESCE", "all")
+
+# Text-conditioning cache configuration
+# T5 embeddings per (model size, normalised prompt) are kept in an LRU of this size, on CPU;
+# 0 disables it. With persistence on, entries are saved to CACHE_DIR at shutdown and reloaded
+CONDITIONING_CACHE_MB = float(os.environ.get("MUSICGEN_CONDITIONING_CACHE_MB", "64"))
+CONDITIONING_CACHE_PERSIST = os.environ.get("MUSICGEN_CONDITIONING_CACHE_PERSIST", "0") == "1"
+
+# Profiling captures
+# POST /admin/profile arms a capture of the next N requests matching a filter; each one
+# records a sampling profile of every thread (and torch.profiler traces of the LM and decode
+# stages) while the request is in flight. Captures are written to PROFILE_DIR and pruned to
+# the newest PROFILE_MAX_CAPTURES, PROFILE_MAX_MB in total and PROFILE_RETENTION_HOURS old
+PROFILE_DIR = os.environ.get("MUSICGEN_PROFILE_DIR", os.path.join(CACHE_DIR, "profiles"))
+PROFILE_MAX_CAPTURES = int(os.environ.get("MUSICGEN_PROFILE_MAX_CAPTURES", "20"))
+PROFILE_MAX_MB = float(os.environ.get("MUSICGEN_PROFILE_MAX_MB", "200"))
+PROFILE_RETENTION_HOURS = float(os.environ.get("MUSICGEN_PROFILE_RETENTION_HOURS", "24"))
+# Sampling stops after this long so a stuck request can't grow a capture without bound
+PROFILE_MAX_SECONDS = float(os.environ.get("MUSICGEN_PROFILE_MAX_SECONDS", "300"))
+# /admin endpoints need this in X-Admin-Token and are disabled while it is unset.
+# ADMIN_ALLOW_LOOPBACK=1 also lets loopback callers in without a token; leave it off behind
+# a reverse proxy or sidecar, where every request arrives from 127.0.0.1
+ADMIN_TOKEN = os.environ.get("MUSICGEN_ADMIN_TOKEN", "")
+ADMIN_ALLOW_LOOPBACK = os.environ.get("MUSICGEN_ADMIN_ALLOW_LOOPBACK", "0") == "1"
+
+# Prometheus metrics, exposed on /metrics
+STAGE_SECONDS = Histogram(
+    "musicgen_stage_seconds", "Wall-clock time per generation stage", ["stage", "model"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+REQUEST_SECONDS = Histogram(
+    "musicgen_request_seconds", "End-to-end request time", ["endpoint"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+TIME_TO_FIRST_AUDIO_SECONDS = Histogram(
+    "musicgen_time_to_first_audio_seconds", "Time until the first streamed chunk is sent", ["model"],
+    buckets=(0.5, 1, 2, 3, 5, 10, 20, 30),
+)
+REAL_TIME_FACTOR = Histogram(
+    "musicgen_real_time_factor", "Audio seconds rendered per wall-clock second of generation", ["model"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32),
+)
+TOKENS_PER_SECOND = Histogram(
+    "musicgen_tokens_per_second", "Language model tokens (all codebooks and batch rows) per second", ["model"],
+    buckets=(25, 50, 100, 200, 400, 800, 1600, 3200, 6400, 12800),
+)
+BATCH_SIZE = Histogram("musicgen_batch_size", "Prompts per generate() call", buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+MODEL_LOADS = Counter("musicgen_model_loads_total", "Models loaded from disk", ["model"])
+MODEL_EVICTIONS = Counter("musicgen_model_evictions_total", "Models evicted from the pool", ["model"])
+MEMORY_PEAK_BYTES = Gauge("musicgen_memory_peak_bytes", "Memory high-water mark", ["kind"])
+OOM_EVENTS = Counter("musicgen_oom_events_total", "Batches and model loads that ran out of memory", ["model"])
+STAGE_AUDIO_SECONDS = Counter("musicgen_stage_audio_seconds_total", "Seconds of audio through each pipeline stage", ["stage", "model"])
+
+# Per-thread slot the text-conditioning hooks write into while a batch is generating
+_stage_context = threading.local()
+
+@contextmanager
+def timed_stage(timings: dict, stage: str):
+    """Add the wall-clock time of the block to timings[stage]"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+        record_span(stage, started)
+
+def record_span(stage: str, started: float):
+    """Add a stage that ran from started until now on this thread to the profile being captured, if any"""
+    capture = profiler.current
+    if capture is not None:
+        capture.span(stage, started, time.perf_counter())
+
+def _conditioning_started(module, args):
+    _stage_context.conditioning_started = time.perf_counter()
+
+def _conditioning_finished(module, args, output):
+    timings = getattr(_stage_context, "timings", None)
+    started = getattr(_stage_context, "conditioning_started", None)
+    if timings is not None and started is not None:
+        timings["text_conditioning"] = timings.get("text_conditioning", 0.0) + time.perf_counter() - started
+        record_span("text_conditioning", started)
+
+def install_stage_hooks(loaded):
+    """Time the T5 text conditioning inside lm.generate() via forward hooks on the condition provider"""
+    provider = getattr(loaded.lm, "condition_provider", None)
+    if provider is None:
+        return
+    
+    # Module-level hooks so the model stays picklable for the CPU replica pool
+    provider.register_forward_pre_hook(_conditioning_started)
+    provider.register_forward_hook(_conditioning_finished)
+
+# Process-lifetime high-water marks; the allocator and kernel peaks are reset per batch
+_memory_high_water = {}
+
+def _set_high_water(kind: str, value: int):
+    _memory_high_water[kind] = max(_memory_high_water.get(kind, 0), value)
+    MEMORY_PEAK_BYTES.labels(kind).set(_memory_high_water[kind])
+
+def record_memory_peaks():
+    """Update the memory high-water gauges"""
+    # ru_maxrss is reported in kilobytes on Linux
+    _set_high_water("rss", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    if device == "cuda":
+        import torch
+        _set_high_water("cuda_allocated", torch.cuda.max_memory_allocated())
+        _set_high_water("cuda_reserved", torch.cuda.max_memory_reserved())
+
+def _proc_status_bytes(field: str) -> Optional[int]:
+    """A kB field of /proc/self/status (VmRSS, VmHWM) in bytes, None where unavailable"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def memory_in_use() -> int:
+    """Bytes in use where inference allocates: CUDA tensors, or this process's RSS on CPU"""
+    if device == "cuda":
+        import torch
+        return torch.cuda.memory_allocated()
+    rss = _proc_status_bytes("VmRSS")
+    return rss if rss is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reset_memory_peak():
+    """Start a new peak measurement; record_memory_peaks() first keeps the lifetime marks"""
+    record_memory_peaks()
+    if device == "cuda":
+        import torch
+        torch.cuda.reset_peak_memory_stats()
+        return
+    try:
+        # Writing 5 to clear_refs resets the kernel's RSS high-water mark (VmHWM)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def memory_peak() -> int:
+    """Peak bytes in use since reset_memory_peak()"""
+    if device == "cuda":
+        import torch
+        return torch.cuda.max_memory_allocated()
+    peak = _proc_status_bytes("VmHWM")
+    return peak if peak is not None else memory_in_use()
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """Whether an exception is an allocation failure, on CUDA or CPU"""
+    if isinstance(error, (MemoryError, OutOfMemoryError)):
+        return True
+    # Replica failures arrive as RuntimeError("<type>: <message>")
+    message = str(error)
+    return isinstance(error, RuntimeError) and (
+        "out of memory" in message or "can't allocate memory" in message or message.startswith("MemoryError")
+    )
+
+def free_cached_memory():
+    """Return freed blocks to the device after an OOM so the retry starts from a clean allocator"""
+    gc.collect()
+    if device == "cuda":
+        import torch
+        torch.cuda.empty_cache()
+
+def timings_metadata(timings: dict) -> dict:
+    """Stage timings as response metadata fields"""
+    return {f"{stage}_seconds": round(seconds, 3) for stage, seconds in timings.items()}
 
 # Request/Response models
 class GenerateRequest(BaseModel):
     prompt: str
-    duration: Optional[int] = 30  # seconds (1-30)
+    duration: Optional[int] = 30  # seconds (1-30; up to LONG_FORM_MAX_SECONDS renders in windows)
     temperature: Optional[float] = 1.0  # 0.1-2.0
     model_size: Optional[str] = "small"  # 'small', 'medium', 'large', 'melody' (backward compat)
     model: Optional[str] = None  # 'small', 'medium', 'large', 'melody' (preferred)
     decoder: Optional[str] = "default"  # 'default' or 'multiband_diffusion'
+    seed: Optional[int] = None  # fixes sampling so the same request renders the same audio
+    format: Optional[str] = "wav"  # 'wav', 'flac', 'opus' or 'mp3'
+    preview: Optional[bool] = False  # a close pre-rendered library track is good enough
+    allow_fallback: Optional[bool] = False  # render with a smaller model if this one doesn't fit in memory
 
 class GenerateResponse(BaseModel):
     success: bool
@@ -48,157 +408,2406 @@ class GenerateResponse(BaseModel):
     error: Optional[str] = None
     metadata: dict
 
+class VariationsRequest(BaseModel):
+    prompt: Optional[str] = None  # single prompt shared by every variation
+    prompts: Optional[list[str]] = None  # or a small set of prompt variants, cycled over the variations
+    count: Optional[int] = None  # defaults to the longest of prompts/temperatures, else 4
+    temperatures: Optional[list[float]] = None  # per-variation temperature, cycled (0.1-2.0)
+    temperature: Optional[float] = 1.0  # used when temperatures is not given
+    seed: Optional[int] = None  # seeds the whole set, so it reproduces as a unit
+    duration: Optional[int] = 30  # seconds (1-30)
+    model: Optional[str] = "small"  # 'small', 'medium', 'large', 'melody'
+    decoder: Optional[str] = "default"  # 'default' or 'multiband_diffusion'
+    format: Optional[str] = "wav"  # 'wav', 'flac', 'opus' or 'mp3'
+
+class Variation(BaseModel):
+    index: int
+    prompt: str
+    temperature: float
+    seed: Optional[int] = None  # seed of the generate() call this variation came from
+    audio_base64: str
+    size_bytes: int
+    track_id: Optional[str] = None  # fetch again or extend via /audio/{track_id}
+
+class VariationsResponse(BaseModel):
+    success: bool
+    variations: list[Variation] = []
+    error: Optional[str] = None
+    metadata: dict
+
+class ProfileRequest(BaseModel):
+    count: Optional[int] = 1  # capture the next N matching requests (1-20)
+    mode: Optional[str] = "both"  # 'sampling' (stacks of every thread), 'torch' (torch.profiler) or 'both'
+    sample_interval_ms: Optional[float] = 5.0  # 1-100
+    expires_in_seconds: Optional[float] = 3600  # disarm if nothing matches by then
+    # Filters; a request must match all that are set
+    prompt_contains: Optional[str] = None
+    model: Optional[str] = None
+    path: Optional[str] = None  # 'generate', 'generate_audio' or 'job'
+    client: Optional[str] = None
+    min_duration: Optional[int] = None
+
+class ModelLoadError(Exception):
+    """Raised when the requested MusicGen checkpoint can't be loaded"""
+
+class OutOfMemoryError(Exception):
+    """Raised when a generation or model load runs out of memory even after retrying smaller"""
+
+def init_torch():
+    """Import torch on first use and pick the device"""
+    global device
+    import torch
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if device == "cpu":
+            # Inter-op threads can only be set before torch runs any parallel work
+            if CPU_INTEROP_THREADS > 0:
+                torch.set_num_interop_threads(CPU_INTEROP_THREADS)
+            if CPU_THREADS > 0:
+                torch.set_num_threads(CPU_THREADS)
+            print(f"🧵 CPU threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+    return torch
+
+def cpu_supports_bf16() -> bool:
+    """True when the CPU has native bf16 matmuls (AVX512-BF16 or AMX), otherwise autocast is slower"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+def _float_inputs(module, args):
+    """Forward pre-hook casting activations back to fp32 for quantized linears under autocast"""
+    return tuple(arg.float() for arg in args)
+
+class _Bf16Forward:
+    """Replacement for lm.forward running the original under CPU bf16 autocast, returning fp32 logits"""
+    def __init__(self, module):
+        self.module = module
+    
+    def __call__(self, *args, **kwargs):
+        import torch
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            return type(self.module).forward(self.module, *args, **kwargs).float()
+
+def optimize_for_cpu(loaded, quantize: bool = True, bf16: bool = False):
+    """
+    Apply the CPU inference path to a loaded model in place.
+    
+    Dynamic int8 quantization replaces the nn.Linear layers under lm (the transformer
+    feed-forward and output projections, and the conditioners' output projections) and
+    in the T5 text encoder; the fused attention input projections are plain parameters
+    and stay fp32. With bf16, the LM forward pass runs under CPU autocast and returns
+    fp32 logits so sampling precision is unchanged; T5 and EnCodec decoding stay fp32.
+    The quantized parts are listed in loaded.int8_modules.
+    """
+    import torch
+    
+    loaded.int8_modules = []
+    if quantize:
+        loaded.lm = torch.ao.quantization.quantize_dynamic(loaded.lm, {torch.nn.Linear}, dtype=torch.qint8)
+        loaded.int8_modules.append("lm")
+        if bf16:
+            # Quantized linears only take fp32 activations
+            for module in loaded.lm.modules():
+                if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+                    module.register_forward_pre_hook(_float_inputs)
+        # A frozen T5 sits in the conditioner's __dict__ rather than its submodules, so it
+        # stays out of checkpoints and out of reach of quantize_dynamic(lm)
+        conditioners = getattr(getattr(loaded.lm, "condition_provider", None), "conditioners", {})
+        for name, conditioner in conditioners.items():
+            t5 = conditioner.__dict__.get("t5")
+            if t5 is not None:
+                conditioner.__dict__["t5"] = torch.ao.quantization.quantize_dynamic(t5, {torch.nn.Linear}, dtype=torch.qint8)
+                loaded.int8_modules.append(f"t5 ({name})")
+    if bf16:
+        loaded.lm.forward = _Bf16Forward(loaded.lm)
+    loaded.cpu_optimized = True
+    return loaded
+
+def inference_context(gen_model):
+    """torch.inference_mode for CPU-optimised models, no_grad otherwise"""
+    import torch
+    return torch.inference_mode() if getattr(gen_model, "cpu_optimized", False) else torch.no_grad()
+
+conditioning_cache = MeteredConditioningCache(
+    int(CONDITIONING_CACHE_MB * 1024**2),
+    os.path.join(CACHE_DIR, "conditioning.pt") if CONDITIONING_CACHE_PERSIST else None,
+)
+
 def load_model(size: str = "small"):
     """Load MusicGen model"""
-    global model, model_size, device
+    init_torch()
+    from audiocraft.models import MusicGen
+    
+    print(f"🎵 Loading MusicGen model: {size} on {device}")
+    try:
+        model = MusicGen.get_pretrained("debug" if TINY_MODEL else f'facebook/musicgen-{size}', device=device)
+        model.set_generation_params(duration=30)
+        if device == "cpu" and ("all" in CPU_OPTIMIZED_MODELS or size in CPU_OPTIMIZED_MODELS):
+            bf16 = CPU_AUTOCAST_BF16 == "1" or (CPU_AUTOCAST_BF16 == "auto" and cpu_supports_bf16())
+            optimize_for_cpu(model, quantize=CPU_QUANTIZE_INT8, bf16=bf16)
+            print(f"⚙️ CPU-optimised path: int8={', '.join(model.int8_modules) or 'off'}, bf16={bf16}")
+        if device == "cpu" and CPU_WORKERS > 0:
+            share_model_memory(model)
+        install_stage_hooks(model)
+        if CONDITIONING_CACHE_MB > 0:
+            conditioning_cache.install(model, size)
+        print(f"✅ Model loaded successfully")
+    except Exception as e:
+        print(f"❌ Error loading model: {e}")
+        raise
+    
+    return model
+
+def model_memory_bytes(model) -> int:
+    """Bytes held by a loaded model's parameters and buffers"""
+    total = 0
+    for module in (model.lm, model.compression_model):
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+class ModelPool:
+    """
+    Keeps several MusicGen models resident, keyed by size, within a memory budget.
     
-    if model is None or model_size != size:
-        print(f"🎵 Loading MusicGen model: {size} on {device}")
+    Loads run on their own thread so batches for already-resident sizes keep rendering
+    while a new size is read from disk. Concurrent requests for a size that is still
+    loading share the same load. Models in use by a batch are never evicted.
+    """
+    
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._models = OrderedDict()  # size -> model, least recently used first
+        self._costs = {}  # size -> resident bytes
+        self._in_use = {}  # size -> number of batches holding the model
+        self._loading = {}  # size -> task loading the model
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="musicgen-loader")
+        self.loads = 0
+        self.evictions = 0
+        self.last_used = None
+    
+    async def acquire(self, size: str):
+        """Return the model for size, loading it first if needed; pair with release()"""
+        while size not in self._models:
+            task = self._loading.get(size)
+            if task is None:
+                task = asyncio.ensure_future(self._load(size))
+                self._loading[size] = task
+            await asyncio.shield(task)
+        
+        self._models.move_to_end(size)
+        self._in_use[size] = self._in_use.get(size, 0) + 1
+        self.last_used = size
+        return self._models[size]
+    
+    def release(self, size: str):
+        self._in_use[size] -= 1
+        # A load may have pushed the pool over budget while this model was busy
+        self._evict(0)
+    
+    async def _load(self, size: str):
         try:
-            model = MusicGen.get_pretrained(f'facebook/musicgen-{size}')
-            model.set_generation_params(duration=30)
-            model.to(device)
-            model_size = size
-            print(f"✅ Model loaded successfully")
+            self._evict(int(MODEL_SIZE_ESTIMATES_GB.get(size, 0) * 1024**3))
+            started = time.perf_counter()
+            try:
+                try:
+                    loaded = await asyncio.get_running_loop().run_in_executor(self._executor, load_model, size)
+                except Exception as e:
+                    if not is_out_of_memory(e):
+                        raise
+                    # Make room by dropping every idle model, then try once more
+                    OOM_EVENTS.labels(size).inc()
+                    print(f"⚠️ Out of memory loading {size}, evicting idle models and retrying")
+                    self._evict(self.budget_bytes)
+                    free_cached_memory()
+                    loaded = await asyncio.get_running_loop().run_in_executor(self._executor, load_model, size)
+            except Exception as e:
+                if is_out_of_memory(e):
+                    raise OutOfMemoryError(f"Not enough memory to load the {size} model") from e
+                raise ModelLoadError(str(e)) from e
+            STAGE_SECONDS.labels("model_load", size).observe(time.perf_counter() - started)
+            record_span("model_load", started)
+            MODEL_LOADS.labels(size).inc()
+            self._models[size] = loaded
+            self._costs[size] = model_memory_bytes(loaded)
+            self.loads += 1
+            self._evict(0, keep=size)
+        finally:
+            del self._loading[size]
+    
+    def _evict(self, incoming_bytes: int, keep: Optional[str] = None):
+        """Drop idle models, oldest first, until incoming_bytes more fits in the budget"""
+        evicted = False
+        for size in list(self._models):
+            if self.resident_bytes() + incoming_bytes <= self.budget_bytes:
+                break
+            if size == keep or self._in_use.get(size, 0) > 0:
+                continue
+            print(f"♻️ Evicting MusicGen model: {size} ({self._costs[size] / 1024**3:.2f} GB)")
+            del self._models[size]
+            del self._costs[size]
+            self.evictions += 1
+            MODEL_EVICTIONS.labels(size).inc()
+            evicted = True
+        
+        if evicted:
+            gc.collect()
+            if device == "cuda":
+                import torch
+                torch.cuda.empty_cache()
+    
+    def resident_sizes(self) -> list:
+        return list(self._models)
+    
+    def resident_bytes(self) -> int:
+        return sum(self._costs.values())
+    
+    def is_loaded(self) -> bool:
+        return len(self._models) > 0
+    
+    def stats(self) -> dict:
+        return {
+            "budget_gb": round(self.budget_bytes / 1024**3, 2),
+            "resident_gb": round(self.resident_bytes() / 1024**3, 2),
+            "resident": [
+                {
+                    "model_size": size,
+                    "memory_gb": round(self._costs[size] / 1024**3, 2),
+                    "in_use": self._in_use.get(size, 0),
+                    "cpu_optimized": getattr(self._models[size], "cpu_optimized", False),
+                }
+                for size in reversed(self._models)
+            ],
+            "loading": list(self._loading),
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+model_pool = ModelPool(int(MODEL_MEMORY_BUDGET_GB * 1024**3))
+
+# A single inference thread keeps the model (and GPU) owned by one caller at a time,
+# while the event loop stays free to serve /health, /stats and new connections
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="musicgen-inference")
+inference_queue = InferenceQueue(MAX_QUEUE_DEPTH, ClientQuotas(CLIENT_MAX_CONCURRENT, CLIENT_QUOTA_RATE, CLIENT_QUOTA_BURST))
+
+def inference_slots() -> int:
+    """Calls that can run at once: one per CPU replica, else the single inference thread"""
+    return replica_pool.workers if replica_pool is not None and device == "cpu" else 1
+
+scheduler = InferenceScheduler(SCHEDULER_AGING_RATE, COST_PRIORS, inference_slots)
+
+def init_replica(cores: list):
+    """ReplicaPool setup, run in each replica process: CPU inference on cores, returns its conditioning cache"""
+    global device
+    device = "cpu"
+    torch = init_torch()
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    return conditioning_cache
+
+replica_pool = ReplicaPool(CPU_WORKERS, init_replica, conditioning_cache) if CPU_WORKERS > 0 else None
+
+async def run_inference(size: str, gen_model, fn, *args, on_start=None, audio_seconds: float = 0.0, clients=(), **kwargs):
+    """
+    Run fn(gen_model, *args, **kwargs) wherever inference happens, returns its result.
+    
+    That is the single inference thread, or an idle CPU replica when MUSICGEN_CPU_WORKERS
+    is set and the server is on CPU, once the scheduler gives the call a slot.
+    audio_seconds (what the call generates) and clients (who it is for) set its place in
+    line; calls that generate nothing, like decoding stored codes, go to the front.
+    on_start() is called as the call begins.
+    """
+    if replica_pool is not None and device == "cpu":
+        return await scheduler.run(size, audio_seconds, clients, lambda: replica_pool.run(size, gen_model, fn, args, kwargs, model_pool.resident_sizes(), on_start))
+    
+    def call():
+        if on_start is not None:
+            on_start()
+        return fn(gen_model, *args, **kwargs)
+    
+    return await scheduler.run(size, audio_seconds, clients, lambda: asyncio.get_running_loop().run_in_executor(inference_executor, call))
+
+def bucket_temperature(temperature: float) -> float:
+    """Snap a temperature onto the batching grid so near-identical values share a batch"""
+    if TEMPERATURE_BUCKET <= 0:
+        return temperature
+    return round(round(temperature / TEMPERATURE_BUCKET) * TEMPERATURE_BUCKET, 4)
+
+_diffusion_lock = threading.Lock()
+_diffusion_decoder = None
+
+def multiband_diffusion():
+    """The MultiBand Diffusion decoder, loaded on first use and kept; raises ModelLoadError"""
+    global _diffusion_decoder
+    with _diffusion_lock:
+        if _diffusion_decoder is None:
+            init_torch()
+            print("📥 Loading MultiBand Diffusion decoder...")
+            started = time.perf_counter()
+            try:
+                from audiocraft.models import MultiBandDiffusion
+                _diffusion_decoder = MultiBandDiffusion.get_mbd_musicgen(device=device)
+            except Exception as e:
+                raise ModelLoadError(f"MultiBand Diffusion: {e}") from e
+            MODEL_LOADS.labels("multiband_diffusion").inc()
+            print(f"✅ MultiBand Diffusion loaded in {time.perf_counter() - started:.1f}s")
+        return _diffusion_decoder
+
+def decode_tokens(decode_model, tokens, decoder: str = "default"):
+    """Decode [batch, codebooks, frames] codes to a [batch, channels, samples] waveform on CPU"""
+    with inference_context(decode_model):
+        if decoder == "multiband_diffusion":
+            # MBD is trained on the 32 kHz EnCodec every MusicGen size here uses
+            return multiband_diffusion().tokens_to_wav(tokens.to(device)).cpu()
+        return decode_model.generate_audio(tokens.to(device)).cpu()
+
+def generate_with_timings(gen_model, prompts: list, timings: dict, progress: bool = True, decoder: Optional[str] = "default"):
+    """
+    MusicGen.generate() split into its stages so each one can be timed, returns (wav, tokens).
+    
+    Mirrors generate(): prepare the conditioning attributes, sample tokens with the LM
+    (whose first step is the T5 text conditioning, timed by install_stage_hooks) and
+    decode the tokens back to audio with the decoder. decoder=None stops after the LM
+    and returns wav as None, leaving decoding to the pipeline's decode stage.
+    """
+    _stage_context.timings = timings
+    try:
+        attributes, prompt_tokens = gen_model._prepare_tokens_and_attributes(prompts, None)
+        with timed_stage(timings, "token_generation"):
+            tokens = gen_model._generate_tokens(attributes, prompt_tokens, progress)
+        wav = None
+        if decoder is not None:
+            with timed_stage(timings, "decode"):
+                wav = decode_tokens(gen_model, tokens, decoder)
+    finally:
+        _stage_context.timings = None
+    
+    # The LM stage wall time includes the conditioning forward pass; report them separately
+    timings["token_generation"] -= timings.get("text_conditioning", 0.0)
+    return wav, tokens
+
+def profile_batch(timings: dict, tokens, duration: float, items: int, frame_rate: float) -> dict:
+    """Stage timings of a batch plus its tokens/sec and real-time factor"""
+    lm_seconds = timings["token_generation"] + timings.get("text_conditioning", 0.0)
+    tokens_per_second = tokens.numel() / lm_seconds if lm_seconds > 0 else 0.0
+    real_time_factor = duration * items / max(lm_seconds + timings.get("decode", 0.0), 1e-9)
+    return {
+        "frame_rate": frame_rate,
+        "timings": timings,
+        "tokens_per_second": round(tokens_per_second, 1),
+        "real_time_factor": round(real_time_factor, 3),
+    }
+
+def run_batch_generation(batch_model, size: str, prompts: list, duration: int, temperature: float, decoder: str, seed: Optional[int] = None, on_progress=None, decode: bool = True):
+    """
+    Render a list of prompts with one generate() call, returns (wav, sample_rate, tokens, profile).
+    
+    profile holds the stage timings for the batch plus its tokens/sec and real-time factor.
+    on_progress(generated_tokens, total_tokens) is called from the inference thread as the
+    language model advances. With decode=False only the LM stage runs: wav is None and
+    tokens stay on the device for the decode stage.
+    """
+    import torch
+    
+    if seed is not None:
+        torch.manual_seed(seed)
+    batch_model.set_generation_params(
+        duration=duration,
+        temperature=temperature
+    )
+    
+    print(f"🎵 Generating music...")
+    print(f"   Prompts: {prompts}")
+    print(f"   Batch size: {len(prompts)}")
+    print(f"   Model: {size}")
+    print(f"   Decoder: {decoder}")
+    print(f"   Duration: {duration}s")
+    print(f"   Temperature: {temperature}")
+    if seed is not None:
+        print(f"   Seed: {seed}")
+    
+    # Measured here so it is the memory of whichever process ran the batch, replicas included
+    baseline = memory_in_use()
+    reset_memory_peak()
+    with inference_context(batch_model):
+        if on_progress is not None:
+            on_progress(0, 1)
+            batch_model.set_custom_progress_callback(on_progress)
+        timings = {}
+        try:
+            with profiler.torch_session("lm" if not decode else "generate"):
+                wav, tokens = generate_with_timings(batch_model, prompts, timings, decoder=decoder if decode else None)
+        finally:
+            if on_progress is not None:
+                batch_model.set_custom_progress_callback(None)
+    
+    # EnCodec codes [batch, codebooks, frames], kept as the canonical form of each track
+    profile = profile_batch(timings, tokens, duration, len(prompts), batch_model.frame_rate)
+    profile["peak_memory_bytes"] = max(0, memory_peak() - baseline)
+    return wav, batch_model.sample_rate, tokens.cpu() if decode else tokens, profile
+
+def observe_batch_profile(size: str, batch_size: int, profile: dict):
+    """Record a run_batch_generation() profile in the metrics; runs in the front process"""
+    for stage, seconds in profile["timings"].items():
+        STAGE_SECONDS.labels(stage, size).observe(seconds)
+    TOKENS_PER_SECOND.labels(size).observe(profile["tokens_per_second"])
+    REAL_TIME_FACTOR.labels(size).observe(profile["real_time_factor"])
+    BATCH_SIZE.observe(batch_size)
+    record_memory_peaks()
+
+def stream_track(stream_model, prompt: str, duration: int, temperature: float, decoder: str = "default", seed: Optional[int] = None, on_chunk=None):
+    """
+    Sample a streamed track in one LM pass and decode its audio while it is sampled.
+    
+    Tokens are collected as the LM samples them. Under the delayed codebook pattern each
+    step samples one codebook of several frames, so a frame is complete a few steps after
+    its first codebook. From the progress callback, every STREAM_CHUNK_SECONDS of completed
+    frames (STREAM_FIRST_CHUNK_SECONDS for the first chunk) are decoded with the requested
+    decoder and a lead-in of earlier codes, cross-faded into the previous chunk and passed
+    to on_chunk(audio).
+    Returns the track's codes [codebooks, frames].
+    """
+    import torch
+    
+    if seed is not None:
+        torch.manual_seed(seed)
+    stream_model.set_generation_params(duration=duration, temperature=temperature)
+    lm = stream_model.lm
+    frame_rate = stream_model.frame_rate
+    samples_per_frame = int(stream_model.sample_rate / frame_rate)
+    _, _, fade_frames, lead_frames = long_form_frames(frame_rate)
+    # The first chunk has to outlast the audio held back for the cross-fade
+    chunk_frames = [max(fade_frames + 1, round(STREAM_FIRST_CHUNK_SECONDS * frame_rate)), max(1, round(STREAM_CHUNK_SECONDS * frame_rate))]
+    total_frames = int(duration * frame_rate)
+    pattern = lm.pattern_provider.get_pattern(total_frames)
+    codes = torch.zeros(lm.num_codebooks, total_frames, dtype=torch.long)
+    filled = [0] * total_frames  # codebooks sampled per frame
+    sampled = []  # [1, codebooks, 1] tokens of LM steps not mapped to frames yet
+    position = {"step": pattern.get_first_step_with_timesteps(0), "complete": 0, "emitted": 0}
+    crossfader = Crossfader(fade_frames * samples_per_frame)
+    
+    def sample_next_token(*args, **kwargs):
+        token = type(lm)._sample_next_token(lm, *args, **kwargs)
+        sampled.append(token)
+        return token
+    
+    def on_progress(generated_steps: int, total_steps: int):
+        for token in sampled:
+            for coord in pattern.layout[position["step"]]:
+                if coord.t < total_frames:
+                    codes[coord.q, coord.t] = token[0, coord.q, 0]
+                    filled[coord.t] += 1
+            position["step"] += 1
+        sampled.clear()
+        complete = position["complete"]
+        while complete < total_frames and filled[complete] == lm.num_codebooks:
+            complete += 1
+        position["complete"] = complete
+        
+        emitted = position["emitted"]
+        if complete - emitted < chunk_frames[emitted > 0] and not (complete == total_frames > emitted):
+            return
+        lead = min(lead_frames, emitted)
+        # Decoders run in fp32, outside the LM's autocast
+        with torch.autocast(device_type=device, enabled=False):
+            wav = decode_tokens(stream_model, codes[None, :, emitted - lead:complete], decoder)
+        position["emitted"] = complete
+        if on_chunk is not None:
+            on_chunk(crossfader.push(wav[0], lead * samples_per_frame, last=complete == total_frames))
+    
+    with inference_context(stream_model):
+        attributes, _ = stream_model._prepare_tokens_and_attributes([prompt], None)
+        lm._sample_next_token = sample_next_token
+        stream_model.set_custom_progress_callback(on_progress)
+        try:
+            stream_model._generate_tokens(attributes, None, True)
+        finally:
+            stream_model.set_custom_progress_callback(None)
+            del lm._sample_next_token
+    return codes
+
+class GenerationPipeline:
+    """
+    The decode stage of generation and throughput accounting for both stages.
+    
+    The LM stage runs on the inference worker under the scheduler; once it has the tokens
+    the slot is released and they queue here for the decode thread, so the LM is already
+    sampling the next batch while this one decodes. Per stage it counts batches, seconds
+    of audio and busy seconds: throughput is audio seconds per busy second, and
+    utilisation is busy time over uptime. With CPU replicas both stages run in the replica
+    and only the accounting happens here.
+    """
+    
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="musicgen-decode")
+        self.queued = 0
+        self.started_at = time.perf_counter()
+        self._stages = {stage: {"batches": 0, "audio_seconds": 0.0, "busy_seconds": 0.0} for stage in ("lm", "decode")}
+    
+    def record(self, stage: str, size: str, audio_seconds: float, busy_seconds: float):
+        totals = self._stages[stage]
+        totals["batches"] += 1
+        totals["audio_seconds"] += audio_seconds
+        totals["busy_seconds"] += busy_seconds
+        STAGE_AUDIO_SECONDS.labels(stage, size).inc(audio_seconds)
+    
+    async def decode(self, size: str, decode_model, tokens, decoder: str, timings: Optional[dict] = None):
+        """Decode [batch, codebooks, frames] tokens on the decode stage, returns the CPU waveform"""
+        if replica_pool is not None and device == "cpu":
+            started = time.perf_counter()
+            wav = await run_inference(size, decode_model, decode_tokens, tokens, decoder)
+            seconds = time.perf_counter() - started
+        else:
+            queued_at = time.perf_counter()
+            self.queued += 1
+            
+            def call():
+                started = time.perf_counter()
+                self.queued -= 1
+                with profiler.torch_session("decode"):
+                    wav = decode_tokens(decode_model, tokens, decoder)
+                record_span("decode", started)
+                return wav, started - queued_at, time.perf_counter() - started
+            
+            wav, queue_seconds, seconds = await asyncio.get_running_loop().run_in_executor(self.executor, call)
+            if timings is not None:
+                timings["decode_queue"] = queue_seconds
+        if timings is not None:
+            timings["decode"] = seconds
+        self.record("decode", size, wav.shape[0] * wav.shape[-1] / decode_model.sample_rate, seconds)
+        return wav
+    
+    def stats(self) -> dict:
+        uptime = time.perf_counter() - self.started_at
+        return {
+            "enabled": PIPELINE and not (replica_pool is not None and device == "cpu"),
+            "decode_queue": self.queued,
+            "diffusion_decoder_loaded": _diffusion_decoder is not None,
+            "stages": {
+                stage: {
+                    "batches": totals["batches"],
+                    "audio_seconds": round(totals["audio_seconds"], 1),
+                    "busy_seconds": round(totals["busy_seconds"], 2),
+                    "throughput": round(totals["audio_seconds"] / totals["busy_seconds"], 2) if totals["busy_seconds"] else None,
+                    "utilization": round(totals["busy_seconds"] / uptime, 3),
+                }
+                for stage, totals in self._stages.items()
+            },
+        }
+
+pipeline = GenerationPipeline()
+
+async def generate_batch(size: str, gen_model, prompts: list, duration: int, temperature: float, decoder: str, seed: Optional[int] = None, on_progress=None, on_start=None, clients=()):
+    """
+    Generate a batch through the LM and decode stages, returns (wav, sample_rate, tokens, profile).
+    
+    The LM stage holds a scheduler slot only while sampling tokens; decoding then waits
+    its turn on the decode thread. Without the pipeline, or on CPU replicas, both stages
+    run in one inference call.
+    """
+    audio_seconds = duration * len(prompts)
+    if not PIPELINE or (replica_pool is not None and device == "cpu"):
+        wav, sample_rate, tokens, profile = await run_inference(
+            size, gen_model, run_batch_generation, size, prompts, duration, temperature, decoder, seed,
+            on_progress=on_progress, on_start=on_start, audio_seconds=audio_seconds, clients=clients
+        )
+        timings = profile["timings"]
+        pipeline.record("lm", size, audio_seconds, timings["token_generation"] + timings.get("text_conditioning", 0.0))
+        pipeline.record("decode", size, audio_seconds, timings["decode"])
+        return wav, sample_rate, tokens, profile
+    
+    _, sample_rate, tokens, profile = await run_inference(
+        size, gen_model, run_batch_generation, size, prompts, duration, temperature, decoder, seed,
+        on_progress=on_progress, on_start=on_start, decode=False, audio_seconds=audio_seconds, clients=clients
+    )
+    timings = profile["timings"]
+    pipeline.record("lm", size, audio_seconds, timings["token_generation"] + timings.get("text_conditioning", 0.0))
+    wav = await pipeline.decode(size, gen_model, tokens, decoder, timings)
+    # EnCodec codes [batch, codebooks, frames], kept as the canonical form of each track
+    tokens = tokens.cpu()
+    return wav, sample_rate, tokens, {
+        **profile_batch(timings, tokens, duration, len(prompts), profile["frame_rate"]),
+        "peak_memory_bytes": profile["peak_memory_bytes"],
+    }
+
+def cpu_memory_available() -> Optional[int]:
+    """Bytes still free for inference on CPU, or None when there is nothing to go by"""
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    
+    # The cgroup counts replicas as well as this process
+    used = None
+    limit = int(CPU_MEMORY_LIMIT_GB * 1024**3)
+    try:
+        with open("/sys/fs/cgroup/memory.current") as f:
+            used = int(f.read())
+        if limit <= 0:
+            with open("/sys/fs/cgroup/memory.max") as f:
+                value = f.read().strip()
+            limit = 0 if value == "max" else int(value)
+    except (OSError, ValueError):
+        pass
+    if limit > 0:
+        headroom = max(0, limit - (used if used is not None else memory_in_use()))
+        available = headroom if available is None else min(available, headroom)
+    return available
+
+class MemoryPlanner:
+    """
+    Learns what generation costs in memory and sizes batches to the free headroom.
+    
+    Every batch reports its peak above what was in use when it started. Per model size
+    that becomes a bytes-per-audio-second rate, since the LM's cache and activations grow
+    with batch size times duration; the rate keeps the largest value seen so estimates err
+    high. A batch that runs out of memory anyway raises the rate to at least what it must
+    have needed and caps that (size, duration) at half the batch for OOM_CAP_SECONDS.
+    """
+    
+    def __init__(self, headroom: float, cap_seconds: float):
+        self.headroom = headroom
+        self.cap_seconds = cap_seconds
+        self._peaks = {}  # (size, duration, batch size) -> largest peak seen, bytes
+        self._rates = {}  # size -> bytes per second of audio in the batch
+        self._caps = {}  # (size, duration) -> (max batch size, expiry)
+        self.limited = 0
+        self.oom_events = 0
+        self.splits = 0
+        self.fallbacks = 0
+    
+    def observe(self, size: str, duration: float, batch_size: int, peak_bytes: int):
+        key = (size, duration, batch_size)
+        self._peaks[key] = max(self._peaks.get(key, 0), peak_bytes)
+        self._rates[size] = max(self._rates.get(size, 0.0), peak_bytes / (batch_size * duration))
+    
+    def estimate(self, size: str, duration: float, batch_size: int) -> Optional[int]:
+        """Predicted peak bytes of a batch, None until the size has been seen"""
+        if (size, duration, batch_size) in self._peaks:
+            return self._peaks[(size, duration, batch_size)]
+        rate = self._rates.get(size)
+        return None if rate is None else int(rate * batch_size * duration)
+    
+    def free_bytes(self) -> Optional[int]:
+        if device == "cuda":
+            import torch
+            free, _ = torch.cuda.mem_get_info()
+            # Blocks the caching allocator holds but isn't using are free to us
+            return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+        if device == "cpu":
+            return cpu_memory_available()
+        return None
+    
+    def max_batch(self, size: str, duration: float, wanted: int) -> int:
+        """Largest batch up to wanted predicted to fit in the headroom"""
+        fits = wanted
+        cap = self._caps.get((size, duration))
+        if cap is not None:
+            if cap[1] < time.monotonic():
+                del self._caps[(size, duration)]
+            else:
+                fits = min(fits, cap[0])
+        
+        free = self.free_bytes()
+        while free is not None and fits > 1:
+            estimate = self.estimate(size, duration, fits)
+            if estimate is None or estimate <= free * self.headroom:
+                break
+            fits -= 1
+        if fits < wanted:
+            self.limited += 1
+        return fits
+    
+    def record_oom(self, size: str, duration: float, batch_size: int, free_bytes: Optional[int]):
+        self.oom_events += 1
+        OOM_EVENTS.labels(size).inc()
+        if free_bytes:
+            self._rates[size] = max(self._rates.get(size, 0.0), free_bytes / (batch_size * duration))
+        if batch_size > 1:
+            self._caps[(size, duration)] = (batch_size // 2, time.monotonic() + self.cap_seconds)
+    
+    def stats(self) -> dict:
+        free = self.free_bytes()
+        now = time.monotonic()
+        return {
+            "headroom": self.headroom,
+            "free_gb": round(free / 1024**3, 2) if free is not None else None,
+            "mb_per_audio_second": {size: round(rate / 1024**2, 2) for size, rate in self._rates.items()},
+            "observed_batches": len(self._peaks),
+            "caps": {f"{size}/{duration}s": cap for (size, duration), (cap, expiry) in self._caps.items() if expiry >= now},
+            "limited": self.limited,
+            "oom_events": self.oom_events,
+            "splits": self.splits,
+            "fallbacks": self.fallbacks,
+        }
+
+memory_planner = MemoryPlanner(MEMORY_HEADROOM, OOM_CAP_SECONDS)
+
+def chunk_seed(seed: Optional[int], offset: int) -> Optional[int]:
+    """Seed for the slice of a seeded batch starting at row offset; the first slice keeps the batch's seed"""
+    if seed is None or offset == 0:
+        return seed
+    digest = hashlib.sha256(f"{seed}:{offset}".encode()).digest()
+    return int.from_bytes(digest[:4], "little")
+
+async def generate_batch_fitted(size: str, gen_model, prompts: list, duration: int, temperature: float, decoder: str, seed: Optional[int] = None, on_progress=None, on_start=None, clients=()):
+    """
+    generate_batch() sized to the free memory, returns (wav, sample_rate, tokens, profile).
+    
+    The prompts run in slices of at most memory_planner.max_batch(). A slice that runs out
+    of memory anyway is halved and retried after freeing cached blocks; a single prompt
+    that still doesn't fit raises OutOfMemoryError. Slices run one after another, their
+    rows are joined back in order and on_start() is called only for the first.
+    
+    Each slice is seeded with chunk_seed(seed, offset of its first row), so rows of a split
+    batch don't replay the same random stream; profile["seeds"] holds the seed every row
+    was rendered with. A seeded batch reproduces as long as it is sliced the same way.
+    """
+    started = []
+    
+    def start_once():
+        if not started:
+            started.append(True)
+            on_start()
+    
+    parts = []  # (result, seed) per slice, in row order
+    
+    async def run(chunk: list, offset: int):
+        free = memory_planner.free_bytes()
+        slice_seed = chunk_seed(seed, offset)
+        try:
+            result = await generate_batch(
+                size, gen_model, chunk, duration, temperature, decoder, slice_seed,
+                on_progress=on_progress, on_start=start_once if on_start is not None else None, clients=clients
+            )
         except Exception as e:
-            print(f"❌ Error loading model: {e}")
-            raise
+            if not is_out_of_memory(e):
+                raise
+            free_cached_memory()
+            memory_planner.record_oom(size, duration, len(chunk), free)
+            if len(chunk) == 1:
+                raise OutOfMemoryError(f"Not enough memory to render {duration}s with the {size} model") from e
+            print(f"⚠️ Out of memory on a batch of {len(chunk)} ({size}, {duration}s), splitting it")
+            memory_planner.splits += 1
+            half = len(chunk) // 2
+            await run(chunk[:half], offset)
+            await run(chunk[half:], offset + half)
+            return
+        memory_planner.observe(size, duration, len(chunk), result[3]["peak_memory_bytes"])
+        parts.append((result, slice_seed))
     
-    return model
+    limit = memory_planner.max_batch(size, duration, len(prompts))
+    if limit < len(prompts):
+        print(f"📐 Batch of {len(prompts)} limited to {limit} by free memory ({size}, {duration}s)")
+    for i in range(0, len(prompts), limit):
+        await run(prompts[i:i + limit], i)
+    seeds = [slice_seed for result, slice_seed in parts for _ in range(result[2].shape[0])]
+    if len(parts) == 1:
+        wav, sample_rate, tokens, profile = parts[0][0]
+        return wav, sample_rate, tokens, {**profile, "seeds": seeds}
+    
+    import torch
+    results = [result for result, _ in parts]
+    wav = torch.cat([result[0] for result in results])
+    tokens = torch.cat([result[2] for result in results])
+    timings = {}
+    for result in results:
+        for stage, seconds in result[3]["timings"].items():
+            timings[stage] = timings.get(stage, 0.0) + seconds
+    return wav, results[0][1], tokens, {
+        **profile_batch(timings, tokens, duration, len(prompts), results[0][3]["frame_rate"]),
+        "peak_memory_bytes": max(result[3]["peak_memory_bytes"] for result in results),
+        "seeds": seeds,
+    }
+
+def continue_codes(extend_model, prompt: str, context, seconds: float, temperature: float, seed: Optional[int] = None):
+    """
+    Sample `seconds` more of a track from the tail of its codes, returns only the new codes.
+    
+    The context codes are fed to the LM as its prompt tokens, the same path
+    generate_continuation() takes after EnCodec-encoding an audio prompt, so extending a
+    stored track skips both decoding it and re-encoding it. With context None the codes
+    are sampled from the prompt alone.
+    """
+    import torch
+    
+    if seed is not None:
+        torch.manual_seed(seed)
+    context_frames = 0 if context is None else context.shape[-1]
+    extend_model.set_generation_params(duration=context_frames / extend_model.frame_rate + seconds, temperature=temperature)
+    with inference_context(extend_model):
+        attributes, _ = extend_model._prepare_tokens_and_attributes([prompt], None)
+        tokens = extend_model._generate_tokens(attributes, None if context is None else context.unsqueeze(0).to(device), False)
+    return tokens[0, :, context_frames:].cpu()
+
+def long_form_frames(frame_rate: float) -> tuple:
+    """(window, context, crossfade, decode lead-in) lengths in frames"""
+    fade_frames = max(1, round(LONG_FORM_CROSSFADE_SECONDS * frame_rate))
+    return (
+        int(LONG_FORM_WINDOW_SECONDS * frame_rate),
+        int(LONG_FORM_CONTEXT_SECONDS * frame_rate),
+        fade_frames,
+        2 * fade_frames,
+    )
+
+async def decode_windowed(size: str, decode_model, codes, decoder: str, timings: dict):
+    """
+    Decode [codebooks, frames] codes one LONG_FORM_WINDOW_SECONDS window at a time.
+    
+    Returns the cross-faded [channels, samples] waveform; the decoder's activations never
+    cover more than one window, however long the track.
+    """
+    import torch
+    window_frames, _, fade_frames, lead_frames = long_form_frames(decode_model.frame_rate)
+    samples_per_frame = int(decode_model.sample_rate / decode_model.frame_rate)
+    crossfader = Crossfader(fade_frames * samples_per_frame)
+    parts = []
+    for start in range(0, codes.shape[-1], window_frames):
+        lead = min(lead_frames, start)
+        window_timings = {}
+        wav = await pipeline.decode(size, decode_model, codes[:, start - lead:start + window_frames].unsqueeze(0), decoder, window_timings)
+        timings["decode"] = timings.get("decode", 0.0) + window_timings["decode"]
+        parts.append(crossfader.push(wav[0], lead * samples_per_frame, last=start + window_frames >= codes.shape[-1]))
+    return torch.cat(parts, dim=-1)
+
+async def long_form_windows(size: str, long_model, prompt: str, duration: int, temperature: float, decoder: str, seed: Optional[int] = None, on_start=None, clients=()):
+    """
+    Render a track longer than one LM window, yielding its audio as each window lands.
+    
+    The first window is sampled from the prompt alone; each later one is prompted with the
+    last LONG_FORM_CONTEXT_SECONDS of codes and adds the rest of a window, so LM memory
+    and per-step cost stay those of a single window however long the track. Every window
+    is its own scheduler job, and its decode runs on the pipeline's decode stage while the
+    LM samples the next window. Yields (start seconds, [channels, samples] audio, new
+    codes, window timings), the audio already cross-faded into the previous window's.
+    on_start() is called as the first window begins.
+    """
+    import torch
+    frame_rate = long_model.frame_rate
+    samples_per_frame = int(long_model.sample_rate / frame_rate)
+    window_frames, context_frames, fade_frames, lead_frames = long_form_frames(frame_rate)
+    total_frames = int(duration * frame_rate)
+    crossfader = Crossfader(fade_frames * samples_per_frame)
+    codes = None  # [codebooks, frames] sampled so far
+    emitted = 0  # samples yielded so far
+    pending = None  # (decode task, lead-in frames, new codes, window timings) of the previous window
+    index = 0
+    
+    while True:
+        window = None
+        produced = 0 if codes is None else codes.shape[-1]
+        if produced < total_frames:
+            context = None if codes is None else codes[:, -context_frames:]
+            context_length = 0 if context is None else context.shape[-1]
+            seconds = min(total_frames - produced, window_frames - context_length) / frame_rate
+            started = time.perf_counter()
+            new_codes = await run_inference(
+                size, long_model, continue_codes, prompt, context, seconds, temperature,
+                None if seed is None else seed + index, on_start=on_start if index == 0 else None,
+                audio_seconds=context_length / frame_rate + seconds, clients=clients
+            )
+            lm_seconds = time.perf_counter() - started
+            pipeline.record("lm", size, seconds, lm_seconds)
+            
+            lead = min(lead_frames, produced)
+            decode_input = new_codes if codes is None else torch.cat([codes[:, produced - lead:], new_codes], dim=-1)
+            codes = new_codes if codes is None else torch.cat([codes, new_codes], dim=-1)
+            timings = {
+                "index": index,
+                "start_seconds": round(produced / frame_rate, 3),
+                "seconds": round(new_codes.shape[-1] / frame_rate, 3),
+                "context_seconds": round(context_length / frame_rate, 3),
+                "lm_seconds": round(lm_seconds, 3),
+            }
+            window = (asyncio.ensure_future(pipeline.decode(size, long_model, decode_input.unsqueeze(0), decoder, timings)), lead, new_codes, timings)
+            index += 1
+        
+        if pending is not None:
+            task, lead, new_codes, timings = pending
+            wav = (await task)[0]
+            for stage in ("decode_queue", "decode"):
+                if stage in timings:
+                    timings[f"{stage}_seconds"] = round(timings.pop(stage), 3)
+            audio = crossfader.push(wav, lead * samples_per_frame, last=window is None)
+            yield emitted / long_model.sample_rate, audio, new_codes, timings
+            emitted += audio.shape[-1]
+        if window is None:
+            return
+        pending = window
+
+audio_store = AudioStore(int(AUDIO_STORE_MB * 1024**2))
+
+code_store = CodeStore(CODE_STORE_DIR)
+
+prompt_library = PromptLibrary(LIBRARY_DIR, PromptEmbedder(LIBRARY_EMBEDDER), LIBRARY_THRESHOLD, LIBRARY_SERVE)
+
+def track_store(track_id: str) -> Optional[CodeStore]:
+    """Code store holding a track: the server's own, else the prompt library's"""
+    if code_store.record(track_id) is not None:
+        return code_store
+    return prompt_library.store_for(track_id)
+
+class GenerationBatcher:
+    """
+    Gathers concurrent requests with compatible settings and renders them together.
+    
+    Requests are grouped by (model size, duration, temperature bucket, decoder). A group is
+    flushed when it reaches max_batch_size or when window_seconds have passed since its
+    first request, whichever comes first. Each caller receives its own slice of the batch.
+    Seeded requests always run alone, since batch composition changes the sampled audio.
+    """
+    
+    def __init__(self, window_seconds: float, max_batch_size: int):
+        self.window_seconds = window_seconds
+        self.max_batch_size = max(1, max_batch_size)
+        self._pending = {}  # batch key -> list of (prompt, future, progress callback, enqueue time, client)
+        self._timers = {}  # batch key -> flush timer handle
+        self.batches_run = 0
+        self.items_run = 0
+    
+    async def submit(self, size: str, prompt: str, duration: int, temperature: float, decoder: str, seed: Optional[int] = None, on_progress=None, client: Optional[str] = None):
+        """Queue a prompt and wait for its audio, returns (audio_tensor, sample_rate, codes, batch_size, profile)"""
+        loop = asyncio.get_running_loop()
+        key = (size, duration, temperature, decoder, seed)
+        future = loop.create_future()
+        
+        batch = self._pending.setdefault(key, [])
+        batch.append((prompt, future, on_progress, time.perf_counter(), client))
+        
+        if len(batch) >= self.max_batch_size or self.window_seconds <= 0 or seed is not None:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.window_seconds, self._flush, key)
+        
+        return await future
+    
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if batch:
+            asyncio.get_running_loop().create_task(self._run_batch(key, batch))
+    
+    async def _run_batch(self, key, batch):
+        size, duration, temperature, decoder, seed = key
+        # Callers that disconnected while waiting don't need a slot in the batch
+        batch = [item for item in batch if not item[1].done()]
+        if not batch:
+            return
+        
+        callbacks = [callback for _, _, callback, _, _ in batch if callback is not None]
+        clients = tuple({client for _, _, _, _, client in batch if client is not None})
+        
+        def on_progress(generated_tokens, total_tokens):
+            for callback in callbacks:
+                callback(generated_tokens, total_tokens)
+        
+        started_at = [None]
+        
+        def on_start():
+            started_at[0] = time.perf_counter()
+            inference_queue.start(len(batch))
+        
+        try:
+            load_started = time.perf_counter()
+            batch_model = await model_pool.acquire(size)
+            load_seconds = time.perf_counter() - load_started
+            try:
+                wav, sample_rate, tokens, profile = await generate_batch_fitted(
+                    size, batch_model, [prompt for prompt, _, _, _, _ in batch], duration, temperature, decoder, seed,
+                    on_progress=on_progress if callbacks else None, on_start=on_start, clients=clients
+                )
+            finally:
+                if started_at[0] is not None:
+                    inference_queue.finish(len(batch), time.perf_counter() - started_at[0])
+                model_pool.release(size)
+        except Exception as e:
+            for _, future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        self.batches_run += 1
+        self.items_run += len(batch)
+        observe_batch_profile(size, len(batch), profile)
+        
+        # wav has shape [batch, channels, samples]; hand each caller its own row
+        for i, (_, future, _, enqueued_at, _) in enumerate(batch):
+            if not future.done():
+                # Time spent waiting for the model to load is reported as its own stage
+                queue_wait = max(0.0, started_at[0] - enqueued_at - load_seconds)
+                STAGE_SECONDS.labels("queue_wait", size).observe(queue_wait)
+                item_profile = {
+                    **profile,
+                    "timings": {"queue_wait": queue_wait, "model_load": load_seconds, **profile["timings"]},
+                }
+                future.set_result((wav[i], sample_rate, tokens[i], len(batch), item_profile))
+    
+    def stats(self) -> dict:
+        return {
+            "window_ms": self.window_seconds * 1000,
+            "max_batch_size": self.max_batch_size,
+            "pending_requests": sum(len(batch) for batch in self._pending.values()),
+            "batches_run": self.batches_run,
+            "items_run": self.items_run,
+            "average_batch_size": round(self.items_run / self.batches_run, 2) if self.batches_run else None,
+        }
+
+batcher = GenerationBatcher(BATCH_WINDOW_MS / 1000, MAX_BATCH_SIZE)
+
+generation_cache = GenerationCache(int(CACHE_MEMORY_MB * 1024**2), int(CACHE_DISK_MB * 1024**2), CACHE_DIR)
+
+render_flights = SingleFlight(COALESCE)
+stream_flights = SingleFlight(COALESCE)
+
+def validate_generation_request(request: GenerateRequest, long_form: bool = False):
+    """
+    Validate a request, returns (model_size, duration, temperature bucket, decoder, format).
+    
+    Durations go up to 30 seconds, or LONG_FORM_MAX_SECONDS where long_form is supported.
+    """
+    if not request.prompt or len(request.prompt.strip()) == 0:
+        raise HTTPException(status_code=400, detail="Prompt cannot be empty")
+    
+    max_duration = LONG_FORM_MAX_SECONDS if long_form else 30
+    if request.duration and (request.duration < 1 or request.duration > max_duration):
+        raise HTTPException(status_code=400, detail=f"Duration must be between 1 and {max_duration} seconds")
+    
+    if request.temperature and (request.temperature < 0.1 or request.temperature > 2.0):
+        raise HTTPException(status_code=400, detail="Temperature must be between 0.1 and 2.0")
+    
+    # Determine model size (prefer 'model' over 'model_size' for backward compat)
+    model_size = request.model or request.model_size or "small"
+    
+    # Validate model size
+    valid_models = ['small', 'medium', 'large', 'melody']
+    if model_size not in valid_models:
+        raise HTTPException(status_code=400, detail=f"Invalid model. Must be one of: {valid_models}")
+    
+    audio_format = request.format or "wav"
+    if audio_format not in AUDIO_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Must be one of: {list(AUDIO_FORMATS)}")
+    
+    decoder = request.decoder or "default"
+    if decoder not in DECODERS:
+        raise HTTPException(status_code=400, detail=f"Invalid decoder. Must be one of: {list(DECODERS)}")
+    
+    duration = request.duration or 30
+    temperature = bucket_temperature(request.temperature or 1.0)
+    return model_size, duration, temperature, decoder, audio_format
+
+def admit_or_reject(items: int = 1, client: Optional[str] = None, cost_seconds: float = 0.0):
+    """
+    Admit a request to the inference queue, or fail fast with Retry-After: 503 when the
+    queue is full, 429 when the client is over its own limits
+    """
+    try:
+        inference_queue.admit(items, client, cost_seconds)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except ClientLimitError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+def client_id(http_request: Request) -> str:
+    """Who a request is accounted to: its API key, else the CLIENT_HEADER header, else the peer address"""
+    api_key = http_request.headers.get("x-api-key")
+    if api_key:
+        # Keys are hashed so they never show up in /stats
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+    header = http_request.headers.get(CLIENT_HEADER)
+    if header:
+        return header.strip()[:64]
+    return "ip:" + (http_request.client.host if http_request.client else "unknown")
+
+profiler = RequestProfiler(
+    PROFILE_DIR, PROFILE_MAX_CAPTURES, int(PROFILE_MAX_MB * 1024**2), PROFILE_RETENTION_HOURS * 3600, PROFILE_MAX_SECONDS,
+)
+
+class StartupState:
+    """Tracks the background preload so /ready and /stats can report on it"""
+    def __init__(self, models: list):
+        self.models = models
+        self.phases = OrderedDict()  # phase -> seconds
+        self.ready = False
+        self.error = None
+        self.ready_after = None  # seconds from process start until ready
+    
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - started, 3)
+    
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "preload_models": self.models,
+            "phases_seconds": dict(self.phases),
+            "ready_after_seconds": self.ready_after,
+            "error": self.error,
+        }
+
+startup = StartupState(PRELOAD_MODELS)
+
+def warm_up(warm_model):
+    """Short throwaway generation so the first real request doesn't pay for kernel selection and allocator growth"""
+    warm_model.set_generation_params(duration=WARMUP_SECONDS)
+    with inference_context(warm_model):
+        warm_model.generate(["warm-up"], progress=False)
+
+async def warm_start():
+    """Import torch, then load and warm up PRELOAD_MODELS in the background"""
+    loop = asyncio.get_running_loop()
+    startup.phases["server_up"] = round(time.perf_counter() - PROCESS_STARTED, 3)
+    try:
+        with startup.phase("import_torch"):
+            await loop.run_in_executor(None, init_torch)
+        for size in startup.models:
+            with startup.phase(f"load_{size}"):
+                warm_model = await model_pool.acquire(size)
+            try:
+                with startup.phase(f"warmup_{size}"):
+                    # One warm-up per replica; each takes the next idle one
+                    await asyncio.gather(*(
+                        run_inference(size, warm_model, warm_up)
+                        for _ in range(inference_slots())
+                    ))
+            finally:
+                model_pool.release(size)
+    except Exception as e:
+        startup.error = str(e)
+        print(f"❌ Startup preload failed: {e}")
+        return
+    
+    startup.ready = True
+    startup.ready_after = round(time.perf_counter() - PROCESS_STARTED, 3)
+    print(f"✅ Ready after {startup.ready_after:.2f}s (models: {', '.join(startup.models) or 'none'})")
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    return {"status": "healthy", "device": device, "model_loaded": model is not None}
+    """Liveness probe; answers as soon as the process is up"""
+    return {"status": "healthy", "device": device, "model_loaded": model_pool.is_loaded()}
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe; 503 until the preloaded models are loaded and warmed up"""
+    if not startup.ready:
+        return Response(
+            content=json.dumps({"status": "failed" if startup.error else "starting", **startup.stats()}),
+            status_code=503,
+            media_type="application/json",
+        )
+    return {"status": "ready", **startup.stats()}
+
+def client_stats() -> dict:
+    """Per-client admission and scheduling state by client id"""
+    merged = {}
+    for source in (inference_queue.client_stats(), scheduler.client_stats()):
+        for client, stats in source.items():
+            merged.setdefault(client, {}).update(stats)
+    return merged
+
+@app.get("/queue")
+async def get_queue(client: str = Depends(client_id)):
+    """The calling client's place in the queue and its limits"""
+    return {
+        "client": client,
+        "active": 0,
+        "waiting": 0,
+        **client_stats().get(client, {}),
+        "max_concurrent": CLIENT_MAX_CONCURRENT or None,
+        "quota_rate_per_second": CLIENT_QUOTA_RATE or None,
+        "queue": inference_queue.stats(),
+    }
 
 @app.get("/stats")
 async def get_stats():
     """Get server statistics"""
     return {
         "device": device,
-        "model_loaded": model is not None,
-        "model_size": model_size if model else None,
-        "cuda_available": torch.cuda.is_available()
+        "tiny_model": TINY_MODEL,
+        "model_loaded": model_pool.is_loaded(),
+        "model_size": model_pool.last_used,
+        "cuda_available": device == "cuda",
+        "models": model_pool.stats(),
+        "batching": batcher.stats(),
+        "queue": inference_queue.stats(),
+        "scheduler": scheduler.stats(),
+        "pipeline": pipeline.stats(),
+        "memory": memory_planner.stats(),
+        "profiler": profiler.stats(),
+        "clients": client_stats(),
+        "cache": generation_cache.stats(),
+        "conditioning_cache": conditioning_cache.stats(),
+        "coalescing": {"render": render_flights.stats(), "stream": stream_flights.stats()},
+        "audio_store": audio_store.stats(),
+        "code_store": code_store.stats(),
+        "library": prompt_library.stats(),
+        "jobs": job_store.stats(),
+        "startup": startup.stats(),
+        "replicas": replica_pool.stats() if replica_pool is not None else None
     }
 
-@app.post("/generate", response_model=GenerateResponse)
-async def generate_music(request: GenerateRequest):
-    """Generate music from text prompt"""
-    global model
+# Queue state is read at scrape time rather than pushed on every change
+Gauge("musicgen_queue_depth", "Requests admitted but not yet running").set_function(
+    lambda: inference_queue.admitted - inference_queue.in_flight
+)
+Gauge("musicgen_in_flight", "Requests currently in a generate() call").set_function(lambda: inference_queue.in_flight)
+Gauge("musicgen_resident_model_bytes", "Memory held by resident models").set_function(model_pool.resident_bytes)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+def admin_access(http_request: Request):
+    """Admin endpoints need X-Admin-Token to match MUSICGEN_ADMIN_TOKEN, or a loopback caller with ADMIN_ALLOW_LOOPBACK"""
+    loopback = http_request.client is not None and http_request.client.host in ("127.0.0.1", "::1")
+    if ADMIN_ALLOW_LOOPBACK and loopback:
+        return
+    if not ADMIN_TOKEN:
+        # Disabled: answer as if the endpoints didn't exist
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(http_request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+def capture_links(capture: dict) -> dict:
+    return {
+        **capture,
+        "url": f"/admin/profiles/{capture['capture_id']}",
+        "downloads": {name: f"/admin/profiles/{capture['capture_id']}/{name}" for name in capture["files"]},
+    }
+
+@app.post("/admin/profile", dependencies=[Depends(admin_access)])
+async def arm_profiler(request: ProfileRequest):
+    """
+    Arm a profiling capture of the next matching requests.
     
-    start_time = time.time()
+    Each captured request gets a Chrome trace (stages per thread plus sampled Python
+    stacks; open in chrome://tracing or ui.perfetto.dev), a flame graph as SVG and folded
+    stacks, and with torch mode torch.profiler traces of its LM and decode stages. Its
+    response carries profile_url; GET /admin/profile lists captures with download links.
+    """
+    if not (1 <= request.count <= 20):
+        raise HTTPException(status_code=400, detail="Count must be between 1 and 20")
+    if request.mode not in ("sampling", "torch", "both"):
+        raise HTTPException(status_code=400, detail="Invalid mode. Must be 'sampling', 'torch' or 'both'")
+    if not (1 <= request.sample_interval_ms <= 100):
+        raise HTTPException(status_code=400, detail="Sample interval must be between 1 and 100 ms")
     
+    filters = {name: getattr(request, name) for name in RequestProfiler.FILTERS if getattr(request, name) is not None}
+    armed = profiler.arm({
+        "remaining": request.count,
+        "filters": filters,
+        "modes": {"sampling", "torch"} if request.mode == "both" else {request.mode},
+        "interval_seconds": request.sample_interval_ms / 1000,
+        "expires_at": time.time() + request.expires_in_seconds,
+    })
+    return {"armed": True, "remaining": armed["remaining"], "filters": filters, "mode": request.mode, "expires_at": armed["expires_at"]}
+
+@app.delete("/admin/profile", dependencies=[Depends(admin_access)])
+async def disarm_profiler():
+    """Disarm the profiler; a capture already running still completes"""
+    profiler.disarm()
+    return profiler.stats()
+
+@app.get("/admin/profile", dependencies=[Depends(admin_access)])
+async def get_profiler():
+    """Profiler state and the stored captures, newest first"""
+    captures = await asyncio.get_running_loop().run_in_executor(None, profiler.captures)
+    return {**profiler.stats(), "captures": [capture_links(capture) for capture in captures]}
+
+@app.get("/admin/profiles/{capture_id}", dependencies=[Depends(admin_access)])
+async def get_profile(capture_id: str):
+    """One capture's metadata, stage timeline and download links"""
+    path = profiler.artifact_path(capture_id, "capture.json")
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found or expired")
+    with open(path) as f:
+        return capture_links(json.load(f))
+
+@app.get("/admin/profiles/{capture_id}/{name}", dependencies=[Depends(admin_access)])
+async def download_profile(capture_id: str, name: str):
+    """Download one file of a capture"""
+    path = profiler.artifact_path(capture_id, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile file not found or expired")
+    media_type = {".json": "application/json", ".svg": "image/svg+xml"}.get(os.path.splitext(name)[1], "text/plain")
+    return FileResponse(path, media_type=media_type, filename=name)
+
+async def generate_track(prompt: str, model_size: str, duration: int, temperature: float, decoder: str, seed: Optional[int], on_progress, client: Optional[str] = None, allow_fallback: bool = False):
+    """
+    Render one prompt through the batcher and store its codes.
+    
+    Runs as a flight's task and owns the queue slot taken for it, releasing it once the
+    generation is done. Returns (wav, sample_rate, codes, batch_size, profile, track_id).
+    With allow_fallback a model that doesn't fit in memory is swapped for the next one
+    down in FALLBACK_MODELS; the profile then names both under model_size and fallback_from.
+    """
+    fallback_from = None
     try:
-        # Validate inputs
-        if not request.prompt or len(request.prompt.strip()) == 0:
-            raise HTTPException(status_code=400, detail="Prompt cannot be empty")
-        
-        if request.duration and (request.duration < 1 or request.duration > 30):
-            raise HTTPException(status_code=400, detail="Duration must be between 1 and 30 seconds")
-        
-        if request.temperature and (request.temperature < 0.1 or request.temperature > 2.0):
-            raise HTTPException(status_code=400, detail="Temperature must be between 0.1 and 2.0")
-        
-        # Determine model size (prefer 'model' over 'model_size' for backward compat)
-        model_size = request.model or request.model_size or "small"
+        while True:
+            try:
+                audio_tensor, sample_rate, codes, batch_size, profile = await batcher.submit(
+                    model_size, prompt, duration, temperature, decoder, seed, on_progress, client
+                )
+                break
+            except OutOfMemoryError:
+                smaller = FALLBACK_MODELS.get(model_size)
+                if not allow_fallback or smaller is None:
+                    raise
+                print(f"⚠️ {model_size} doesn't fit in memory, falling back to {smaller}")
+                memory_planner.fallbacks += 1
+                fallback_from = fallback_from or model_size
+                model_size = smaller
+    finally:
+        inference_queue.release(1, client)
+    if fallback_from is not None:
+        profile = {**profile, "model_size": model_size, "fallback_from": fallback_from}
+    
+    track_id = await asyncio.get_running_loop().run_in_executor(None, lambda: code_store.put(
+        codes, model_size, sample_rate, profile["frame_rate"],
+        {"prompt": prompt, "temperature": temperature, "seed": seed, "decoder": decoder},
+    ))
+    return audio_tensor, sample_rate, codes, batch_size, profile, track_id
+
+async def generate_long_track(prompt: str, model_size: str, duration: int, temperature: float, decoder: str, seed: Optional[int], on_progress, client: Optional[str] = None):
+    """
+    Render a track longer than one LM window and store its codes.
+    
+    The flight task for durations above LONG_FORM_WINDOW_SECONDS, owning its queue slot
+    like generate_track() and returning the same tuple. The waveform is filled in as the
+    windows arrive; the profile lists each window's timings under "windows".
+    """
+    start_time = time.perf_counter()
+    acquired = False
+    started_at = [None]
+    
+    def on_start():
+        started_at[0] = time.perf_counter()
+        inference_queue.start(1)
+    
+    try:
+        long_model = await model_pool.acquire(model_size)
+        acquired = True
+        import torch
+        sample_rate = long_model.sample_rate
+        total_frames = int(duration * long_model.frame_rate)
+        audio = None
+        written = 0
+        codes = []
+        windows = []
+        async for _, chunk, new_codes, timings in long_form_windows(
+            model_size, long_model, prompt, duration, temperature, decoder, seed,
+            on_start=on_start, clients=(client,) if client else ()
+        ):
+            if audio is None:
+                audio = chunk.new_zeros(chunk.shape[0], total_frames * int(sample_rate / long_model.frame_rate))
+            chunk = chunk[:, :audio.shape[-1] - written]
+            audio[:, written:written + chunk.shape[-1]] = chunk
+            written += chunk.shape[-1]
+            codes.append(new_codes)
+            windows.append(timings)
+            STAGE_SECONDS.labels("token_generation", model_size).observe(timings["lm_seconds"])
+            STAGE_SECONDS.labels("decode", model_size).observe(timings["decode_seconds"])
+            print(f"   🪟 Window {timings['index']}: {timings['seconds']}s in {timings['lm_seconds']}s (+{timings['decode_seconds']}s decode)")
+            if on_progress is not None:
+                on_progress(sum(window.shape[-1] for window in codes), total_frames)
         
-        # Validate model size
-        valid_models = ['small', 'medium', 'large', 'melody']
-        if model_size not in valid_models:
-            raise HTTPException(status_code=400, detail=f"Invalid model. Must be one of: {valid_models}")
+        codes = torch.cat(codes, dim=-1)
+        lm_seconds = sum(window["lm_seconds"] for window in windows)
+        generation_seconds = time.perf_counter() - start_time
+        profile = {
+            "frame_rate": long_model.frame_rate,
+            "timings": {"token_generation": lm_seconds, "decode": sum(window["decode_seconds"] for window in windows)},
+            "tokens_per_second": round(codes.numel() / lm_seconds, 1) if lm_seconds > 0 else 0.0,
+            "real_time_factor": round(duration / generation_seconds, 3),
+            "windows": windows,
+        }
+        REAL_TIME_FACTOR.labels(model_size).observe(duration / generation_seconds)
+    finally:
+        if acquired:
+            model_pool.release(model_size)
+        if started_at[0] is not None:
+            inference_queue.finish(1, time.perf_counter() - started_at[0])
+        inference_queue.release(1, client)
+    
+    track_id = await asyncio.get_running_loop().run_in_executor(None, lambda: code_store.put(
+        codes, model_size, sample_rate, profile["frame_rate"],
+        {"prompt": prompt, "temperature": temperature, "seed": seed, "decoder": decoder, "windows": len(windows)},
+    ))
+    return audio[:, :written], sample_rate, codes, 1, profile, track_id
+
+def library_applies(request: GenerateRequest, decoder: str) -> bool:
+    """Whether a request may be answered from the prompt library"""
+    if LIBRARY_SERVE == "off" or request.seed is not None or decoder != "default":
+        return False
+    return LIBRARY_SERVE == "all" or bool(request.preview)
+
+async def serve_from_library(prompt: str, model_size: str, duration: int, audio_format: str, start_time: float):
+    """Encoded audio of the nearest library track as (audio bytes, metadata), or None without a close enough one"""
+    loop = asyncio.get_running_loop()
+    match = await loop.run_in_executor(None, prompt_library.lookup, prompt, model_size, duration)
+    if match is None:
+        return None
+    track_id, similarity = match
+    track = track_metadata(track_id)
+    wav, sample_rate = await loop.run_in_executor(None, prompt_library.audio, track_id, duration)
+    audio_bytes = await loop.run_in_executor(None, encode_audio, wav, sample_rate, audio_format)
+    generation_time = time.time() - start_time
+    print(f"📚 Library hit ({similarity:.3f}) in {generation_time * 1000:.1f}ms: {track.get('prompt')}")
+    return audio_bytes, {
+        "model": track["model"],
+        "model_size": model_size,
+        "decoder": "default",
+        "duration": duration,
+        "temperature": track.get("temperature"),
+        "seed": None,
+        "batch_size": 0,
+        "sample_rate": sample_rate,
+        "format": audio_format,
+        "size_bytes": len(audio_bytes),
+        "track_id": track_id,
+        "generation_time_seconds": round(generation_time, 3),
+        "framework": "AudioCraft",
+        "device": "cpu",
+        "cache": "library",
+        "library_prompt": track.get("prompt"),
+        "library_similarity": round(similarity, 4),
+        "coalesced": False,
+    }
+
+async def render_request(request: GenerateRequest, client: Optional[str] = None, on_progress=None, admitted: bool = False, path: str = "generate"):
+    """
+    Produce encoded audio for a request, from the cache when possible.
+    
+    Previews may be answered by the prompt library, and an identical request already being
+    generated is joined instead of starting another generation. Returns (audio bytes, metadata). Raises HTTPException for invalid input or
+    a full queue and ModelLoadError when the checkpoint can't be loaded. Callers that
+    already hold a queue slot pass admitted=True; the slot is released here either way.
+    """
+    start_time = time.time()
+    loop = asyncio.get_running_loop()
+    holding_slot = admitted
+    try:
+        model_size, duration, temperature, decoder, audio_format = validate_generation_request(request, long_form=True)
         
-        # Load model if needed
-        try:
-            model = load_model(model_size)
-        except Exception as e:
-            return GenerateResponse(
-                success=False,
-                prompt=request.prompt,
-                error=f"Failed to load model: {str(e)}",
-                metadata={}
-            )
+        # Previews can make do with a close pre-rendered track, which needs no GPU at all
+        if library_applies(request, decoder):
+            served = await serve_from_library(request.prompt, model_size, duration, audio_format, start_time)
+            if served is not None:
+                return served
         
-        # Determine decoder
-        use_multiband = request.decoder == "multiband_diffusion"
-        duration = request.duration or 30
+        # Seeded requests are reproducible, so a previous render can be served as-is
+        cache_key = None
+        if request.seed is not None:
+            cache_key = make_cache_key(request.prompt, model_size, duration, temperature, decoder, request.seed, audio_format)
+            cached = await generation_cache.get(cache_key)
+            if cached is not None:
+                audio_bytes, cached_metadata, tier = cached
+                generation_time = time.time() - start_time
+                print(f"⚡ Cache hit ({tier}) in {generation_time * 1000:.1f}ms")
+                # Stage timings describe the original render, not this response
+                original = {key: value for key, value in cached_metadata.items() if key not in ("timings", "real_time_factor", "tokens_per_second", "windows")}
+                return audio_bytes, {
+                    **original,
+                    "generation_time_seconds": round(generation_time, 3),
+                    "cache": "hit",
+                    "cache_tier": tier,
+                    "saved_seconds": round(cached_metadata["generation_time_seconds"] - generation_time, 2),
+                }
         
-        # Set generation parameters
-        model.set_generation_params(
-            duration=duration,
-            temperature=request.temperature or 1.0
+        flight_key = render_flights.key(request.prompt, model_size, duration, temperature, decoder, request.seed)
+        if flight_key is not None and request.allow_fallback:
+            flight_key += ":fallback"
+        flight = render_flights.join(flight_key, path, on_progress)
+        coalesced = flight is not None
+        if not coalesced:
+            # Reject straight away when the queue is full rather than letting clients time out
+            if not holding_slot:
+                admit_or_reject(1, client, scheduler.estimate(model_size, duration))
+            # Generate audio, batched together with any compatible concurrent requests;
+            # the slot now belongs to the flight, which releases it when generation ends
+            holding_slot = False
+            # Beyond one LM window the track is rendered as cross-faded windows instead
+            if duration > LONG_FORM_WINDOW_SECONDS:
+                flight = render_flights.start(flight_key, lambda flight: generate_long_track(
+                    request.prompt, model_size, duration, temperature, decoder, request.seed, flight.on_progress, client
+                ), on_progress)
+            else:
+                flight = render_flights.start(flight_key, lambda flight: generate_track(
+                    request.prompt, model_size, duration, temperature, decoder, request.seed, flight.on_progress, client,
+                    allow_fallback=bool(request.allow_fallback)
+                ), on_progress)
+        else:
+            print(f"🔗 Joined an identical generation in flight ({flight.waiters} waiting)")
+    finally:
+        if holding_slot:
+            inference_queue.release(1, client)
+    
+    try:
+        audio_tensor, sample_rate, codes, batch_size, profile, track_id = await flight.result()
+    except Exception as e:
+        if not is_out_of_memory(e):
+            raise
+        # Memory frees up as running batches finish, so this is worth retrying
+        raise HTTPException(
+            status_code=503,
+            detail=f"{e}; retry later" + ("" if request.allow_fallback else " or set allow_fallback"),
+            headers={"Retry-After": str(max(1, math.ceil(scheduler.estimate(model_size, duration))))}
         )
+    
+    # Encode off the event loop; the profile is shared with every waiter on the flight
+    timings = dict(profile["timings"])
+    encode_started = time.perf_counter()
+    audio_bytes = await loop.run_in_executor(None, encode_audio, audio_tensor, sample_rate, audio_format)
+    timings["encode"] = time.perf_counter() - encode_started
+    record_span("encode", encode_started)
+    STAGE_SECONDS.labels("encode", model_size).observe(timings["encode"])
+    
+    generation_time = time.time() - start_time
+    
+    print(f"✅ Generation complete in {generation_time:.2f}s")
+    print(f"   Audio size: {len(audio_bytes)} bytes ({audio_format})")
+    
+    fallback_from = profile.get("fallback_from")
+    model_size = profile.get("model_size", model_size)
+    metadata = {
+        "model": f"facebook/musicgen-{model_size}",
+        "model_size": model_size,
+        **({"fallback_from": fallback_from} if fallback_from else {}),
+        "decoder": decoder,
+        "duration": duration,
+        "temperature": temperature,
+        "seed": request.seed,
+        "batch_size": batch_size,
+        "sample_rate": sample_rate,
+        "format": audio_format,
+        "size_bytes": len(audio_bytes),
+        "track_id": track_id,
+        "generation_time_seconds": round(generation_time, 2),
+        "timings": timings_metadata(timings),
+        "real_time_factor": profile["real_time_factor"],
+        "tokens_per_second": profile["tokens_per_second"],
+        **({"windows": profile["windows"]} if "windows" in profile else {}),
+        "framework": "AudioCraft",
+        "device": device
+    }
+    # A fallback render isn't what the cache key asked for
+    if fallback_from is not None:
+        cache_key = None
+    if cache_key is not None:
+        await generation_cache.put(cache_key, audio_bytes, metadata)
+    
+    return audio_bytes, {**metadata, "cache": "miss" if cache_key is not None else "bypass", "coalesced": coalesced}
+
+@app.post("/generate", response_model=GenerateResponse)
+async def generate_music(request: GenerateRequest, client: str = Depends(client_id)):
+    """Generate music from text prompt"""
+    start_time = time.perf_counter()
+    capture = profiler.begin("generate", request, client)
+    outcome = {}
+    try:
+        audio_bytes, metadata = await render_request(request, client)
         
-        print(f"🎵 Generating music...")
-        print(f"   Prompt: {request.prompt}")
-        print(f"   Model: {model_size}")
-        print(f"   Decoder: {request.decoder or 'default'}")
-        print(f"   Duration: {duration}s")
-        print(f"   Temperature: {request.temperature or 1.0}")
-        
-        # Generate audio
-        # Note: MultiBand Diffusion decoder support requires additional AudioCraft setup
-        # The standard MusicGen.generate() uses the default decoder
-        # For full MultiBand Diffusion support, you may need to:
-        # 1. Use MusicGen's extended API with decoder parameter
-        # 2. Or apply MultiBand Diffusion as a post-processing step
-        # For now, we log the preference but use standard generation
-        with torch.no_grad():
-            if use_multiband:
-                print("   ⚠️ MultiBand Diffusion requested but using default decoder")
-                print("   Note: Full MultiBand Diffusion support may require AudioCraft API updates")
-            wav = model.generate([request.prompt], progress=True)
-        
-        # Convert to numpy array and then to WAV bytes
-        audio_tensor = wav[0].cpu()  # Shape: [1, sample_rate * duration]
-        sample_rate = model.sample_rate
-        
-        # Convert to WAV format
-        buffer = io.BytesIO()
-        torchaudio.save(buffer, audio_tensor, sample_rate, format="wav")
-        wav_bytes = buffer.getvalue()
-        
-        # Convert to base64
-        audio_base64 = base64.b64encode(wav_bytes).decode('utf-8')
-        
-        generation_time = time.time() - start_time
-        
-        print(f"✅ Generation complete in {generation_time:.2f}s")
-        print(f"   Audio size: {len(wav_bytes)} bytes")
+        # Convert to base64 off the event loop
+        base64_started = time.perf_counter()
+        audio_base64 = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: base64.b64encode(audio_bytes).decode('utf-8')
+        )
+        base64_seconds = time.perf_counter() - base64_started
+        record_span("base64", base64_started)
+        STAGE_SECONDS.labels("base64", metadata["model_size"]).observe(base64_seconds)
+        if "timings" in metadata:
+            metadata = {**metadata, "timings": {**metadata["timings"], "base64_seconds": round(base64_seconds, 3)}}
+        REQUEST_SECONDS.labels("generate").observe(time.perf_counter() - start_time)
+        outcome["metadata"] = metadata
+        if capture is not None:
+            metadata = {**metadata, "profile_url": f"/admin/profiles/{capture.id}"}
         
         return GenerateResponse(
             success=True,
             audio_base64=audio_base64,
             prompt=request.prompt,
-            metadata={
-                "model": f"facebook/musicgen-{model_size}",
-                "model_size": model_size,
-                "decoder": request.decoder or "default",
-                "duration": duration,
-                "sample_rate": sample_rate,
-                "size_bytes": len(wav_bytes),
-                "generation_time_seconds": round(generation_time, 2),
-                "framework": "AudioCraft",
-                "device": device
-            }
+            metadata=metadata
         )
         
-    except HTTPException:
+    except HTTPException as e:
+        outcome["error"] = e.detail
         raise
+    except ModelLoadError as e:
+        outcome["error"] = f"Failed to load model: {str(e)}"
+        return GenerateResponse(
+            success=False,
+            prompt=request.prompt,
+            error=f"Failed to load model: {str(e)}",
+            metadata={}
+        )
     except Exception as e:
         print(f"❌ Generation error: {e}")
         import traceback
         traceback.print_exc()
+        outcome["error"] = f"Generation failed: {str(e)}"
         return GenerateResponse(
             success=False,
             prompt=request.prompt,
             error=f"Generation failed: {str(e)}",
             metadata={}
         )
+    finally:
+        await profiler.end(capture, outcome)
+
+def audio_headers(audio_id: str, metadata: dict) -> dict:
+    """Response headers carrying the essentials of a track's metadata"""
+    return {
+        "Accept-Ranges": "bytes",
+        "X-Audio-Id": audio_id,
+        "X-Audio-Metadata-Url": f"/audio/{audio_id}/metadata",
+        "X-Model": metadata["model_size"],
+        "X-Duration-Seconds": str(metadata["duration"]),
+        "X-Sample-Rate": str(metadata["sample_rate"]),
+        "X-Generation-Time-Seconds": str(metadata["generation_time_seconds"]),
+        "X-Cache": metadata.get("cache", "bypass"),
+    }
+
+@app.post("/generate/audio")
+async def generate_music_audio(request: GenerateRequest, client: str = Depends(client_id)):
+    """
+    Generate music and return the encoded audio as the raw response body.
+    
+    The track's codes are kept in the code store so it can be fetched again, in any format
+    and with Range support, from /audio/{track_id}; metadata is at /audio/{track_id}/metadata.
+    """
+    start_time = time.perf_counter()
+    capture = profiler.begin("generate_audio", request, client)
+    outcome = {}
+    try:
+        try:
+            audio_bytes, metadata = await render_request(request, client, path="generate_audio")
+        except HTTPException as e:
+            outcome["error"] = e.detail
+            raise
+        except ModelLoadError as e:
+            outcome["error"] = f"Failed to load model: {str(e)}"
+            raise HTTPException(status_code=503, detail=f"Failed to load model: {str(e)}")
+        except Exception as e:
+            print(f"❌ Generation error: {e}")
+            outcome["error"] = f"Generation failed: {str(e)}"
+            raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
+        
+        REQUEST_SECONDS.labels("generate_audio").observe(time.perf_counter() - start_time)
+        outcome["metadata"] = metadata
+        
+        # Starlette wants real bytes; this is the one copy on the binary path
+        audio_bytes = bytes(audio_bytes)
+        track_id = metadata["track_id"]
+        audio_store.put(rendition_key(track_id, metadata["format"], metadata["sample_rate"]), audio_bytes, metadata)
+        headers = {**audio_headers(track_id, metadata), "Location": f"/audio/{track_id}"}
+        if capture is not None:
+            headers["X-Profile-Url"] = f"/admin/profiles/{capture.id}"
+        return Response(
+            content=audio_bytes,
+            media_type=AUDIO_FORMATS[metadata["format"]],
+            headers=headers
+        )
+    finally:
+        await profiler.end(capture, outcome)
+
+def parse_range(range_header: str, size: int):
+    """Parse a single 'bytes=' Range header, returns (start, end) inclusive or None if unsatisfiable"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    if size <= 0:
+        return None  # no byte of an empty body can be satisfied
+    try:
+        if first == "":
+            length = int(last)
+            if length <= 0:
+                return None
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+def audio_response(audio_bytes: bytes, metadata: dict, audio_id: str, range_header: Optional[str] = None):
+    """Raw audio response, honouring a single byte Range"""
+    media_type = AUDIO_FORMATS[metadata["format"]]
+    headers = audio_headers(audio_id, metadata)
+    
+    if range_header is None:
+        return Response(content=audio_bytes, media_type=media_type, headers=headers)
+    
+    byte_range = parse_range(range_header, len(audio_bytes))
+    if byte_range is None:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{len(audio_bytes)}"}
+        )
+    start, end = byte_range
+    return Response(
+        content=audio_bytes[start:end + 1],
+        status_code=206,
+        media_type=media_type,
+        headers={**headers, "Content-Range": f"bytes {start}-{end}/{len(audio_bytes)}"}
+    )
+
+def track_metadata(track_id: str) -> Optional[dict]:
+    """Code store record and request metadata of a track, or None"""
+    store = track_store(track_id)
+    if store is None:
+        return None
+    record = store.record(track_id)
+    return {**store.metadata(track_id), **record, "model": f"facebook/musicgen-{record['model_size']}"}
+
+async def render_track(track_id: str, audio_format: str, sample_rate: Optional[int] = None):
+    """
+    Encoded audio of a stored track, returns (audio bytes, metadata) or None if unknown.
+    
+    Served from the rendition cache when this format and rate were produced recently,
+    otherwise the codes are decoded with the track's model, resampled if asked and encoded.
+    Prompt library tracks start from their pre-rendered audio instead of the codes.
+    """
+    track = track_metadata(track_id)
+    if track is None:
+        return None
+    sample_rate = sample_rate or track["sample_rate"]
+    key = rendition_key(track_id, audio_format, sample_rate)
+    entry = audio_store.get(key)
+    if entry is not None:
+        return entry
+    
+    start_time = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    model_size = track["model_size"]
+    store = track_store(track_id)
+    timings = {}
+    if store is code_store:
+        codes = await loop.run_in_executor(None, store.codes, track_id)
+        decode_model = await model_pool.acquire(model_size)
+        try:
+            if track["frames"] > LONG_FORM_WINDOW_SECONDS * track["frame_rate"]:
+                wav = await decode_windowed(model_size, decode_model, codes, track.get("decoder") or "default", timings)
+            else:
+                wav = (await pipeline.decode(model_size, decode_model, codes.unsqueeze(0), track.get("decoder") or "default", timings))[0]
+        finally:
+            model_pool.release(model_size)
+        STAGE_SECONDS.labels("decode", model_size).observe(timings["decode"])
+    else:
+        with timed_stage(timings, "load"):
+            wav, _ = await loop.run_in_executor(None, prompt_library.audio, track_id)
+    
+    if sample_rate != track["sample_rate"]:
+        import torchaudio
+        wav = await loop.run_in_executor(None, torchaudio.functional.resample, wav, track["sample_rate"], sample_rate)
+    with timed_stage(timings, "encode"):
+        audio_bytes = bytes(await loop.run_in_executor(None, encode_audio, wav, sample_rate, audio_format))
+    STAGE_SECONDS.labels("encode", model_size).observe(timings["encode"])
+    
+    metadata = {
+        **track,
+        "sample_rate": sample_rate,
+        "format": audio_format,
+        "size_bytes": len(audio_bytes),
+        "generation_time_seconds": round(time.perf_counter() - start_time, 3),
+        "timings": timings_metadata(timings),
+        "cache": "decoded",
+    }
+    audio_store.put(key, audio_bytes, metadata)
+    return audio_bytes, metadata
+
+@app.get("/audio/{track_id}")
+async def get_audio(track_id: str, format: str = "wav", sample_rate: Optional[int] = None, range: Optional[str] = Header(default=None)):
+    """Serve a stored track in any format and sample rate, honouring a single byte Range"""
+    if format not in AUDIO_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Must be one of: {list(AUDIO_FORMATS)}")
+    if sample_rate is not None and sample_rate not in SERVE_SAMPLE_RATES:
+        raise HTTPException(status_code=400, detail=f"Invalid sample rate. Must be one of: {list(SERVE_SAMPLE_RATES)}")
+    try:
+        rendered = await render_track(track_id, format, sample_rate)
+    except ModelLoadError as e:
+        raise HTTPException(status_code=503, detail=f"Failed to load model: {str(e)}")
+    if rendered is None:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    audio_bytes, metadata = rendered
+    return audio_response(audio_bytes, metadata, track_id, range)
+
+@app.get("/audio/{track_id}/metadata")
+async def get_audio_metadata(track_id: str):
+    """JSON metadata for a stored track"""
+    track = track_metadata(track_id)
+    if track is None:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    return {"track_id": track_id, "url": f"/audio/{track_id}", "metadata": track}
+
+class ExtendRequest(BaseModel):
+    prompt: Optional[str] = None  # defaults to the track's own prompt
+    duration: Optional[int] = 10  # seconds to add (1 up to LONG_FORM_WINDOW_SECONDS minus the context)
+    temperature: Optional[float] = 1.0
+    seed: Optional[int] = None
+    format: Optional[str] = "wav"
+
+@app.post("/audio/{track_id}/extend")
+async def extend_audio(track_id: str, request: ExtendRequest, client: str = Depends(client_id)):
+    """
+    Continue a stored track and return the whole extended track as raw audio.
+    
+    The LM is prompted with the last EXTEND_CONTEXT_SECONDS of the track's codes; the new
+    codes are appended to the original ones and stored as a new track, whose id is in
+    X-Audio-Id and Location. The original track is left as it was. Context and new audio
+    are sampled as one LM window, so at most LONG_FORM_WINDOW_SECONDS minus the context
+    can be added per call.
+    """
+    track = track_metadata(track_id)
+    if track is None:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    store = track_store(track_id)
+    prompt = request.prompt or track.get("prompt")
+    model_size, duration, temperature, _, audio_format = validate_generation_request(GenerateRequest(
+        prompt=prompt or "",
+        duration=request.duration,
+        temperature=request.temperature,
+        model=track["model_size"],
+        format=request.format,
+    ))
+    
+    start_time = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    # Context and extension share one LM window, so the context gives way to at least a second
+    window_frames = int(LONG_FORM_WINDOW_SECONDS * track["frame_rate"])
+    context_frames = max(0, min(track["frames"], int(EXTEND_CONTEXT_SECONDS * track["frame_rate"]), window_frames - int(track["frame_rate"])))
+    max_duration = int(LONG_FORM_WINDOW_SECONDS - context_frames / track["frame_rate"])
+    if duration > max_duration:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Duration must be between 1 and {max_duration} seconds to extend with {context_frames / track['frame_rate']:g}s of context"
+        )
+    generated_seconds = context_frames / track["frame_rate"] + duration
+    admit_or_reject(1, client, scheduler.estimate(model_size, generated_seconds))
+    try:
+        extend_model = await model_pool.acquire(model_size)
+        try:
+            started_at = [None]
+            
+            def on_start():
+                started_at[0] = time.perf_counter()
+                inference_queue.start(1)
+            
+            try:
+                context = await loop.run_in_executor(None, lambda: store.codes(track_id, last_frames=context_frames))
+                new_codes = await run_inference(
+                    model_size, extend_model, continue_codes,
+                    prompt, context, duration, temperature, request.seed,
+                    on_start=on_start, audio_seconds=generated_seconds, clients=(client,)
+                )
+            finally:
+                if started_at[0] is not None:
+                    inference_queue.finish(1, time.perf_counter() - started_at[0])
+        finally:
+            model_pool.release(model_size)
+    except ModelLoadError as e:
+        raise HTTPException(status_code=503, detail=f"Failed to load model: {str(e)}")
+    finally:
+        inference_queue.release(1, client)
+    
+    import torch
+    codes = torch.cat([await loop.run_in_executor(None, store.codes, track_id), new_codes], dim=-1)
+    extended_id = await loop.run_in_executor(None, lambda: code_store.put(
+        codes, model_size, track["sample_rate"], track["frame_rate"],
+        {"prompt": prompt, "temperature": temperature, "seed": request.seed, "decoder": track.get("decoder"), "parent_track_id": track_id},
+    ))
+    audio_bytes, metadata = await render_track(extended_id, audio_format)
+    metadata = {**metadata, "generation_time_seconds": round(time.perf_counter() - start_time, 3), "cache": "bypass"}
+    REQUEST_SECONDS.labels("extend").observe(time.perf_counter() - start_time)
+    
+    return Response(
+        content=audio_bytes,
+        media_type=AUDIO_FORMATS[audio_format],
+        headers={**audio_headers(extended_id, metadata), "Location": f"/audio/{extended_id}"}
+    )
+
+def plan_variations(request: VariationsRequest):
+    """Validate a variations request, returns a list of (prompt, temperature bucket) per variation"""
+    prompts = request.prompts or ([request.prompt] if request.prompt else [])
+    if not prompts or any(not prompt or not prompt.strip() for prompt in prompts):
+        raise HTTPException(status_code=400, detail="Provide a prompt or a non-empty list of prompts")
+    
+    temperatures = request.temperatures or [request.temperature or 1.0]
+    if any(temperature < 0.1 or temperature > 2.0 for temperature in temperatures):
+        raise HTTPException(status_code=400, detail="Temperature must be between 0.1 and 2.0")
+    
+    count = request.count or max(len(request.prompts or []), len(request.temperatures or []), 0) or 4
+    if count < 1 or count > MAX_VARIATIONS:
+        raise HTTPException(status_code=400, detail=f"Count must be between 1 and {MAX_VARIATIONS}")
+    
+    return [
+        (prompts[i % len(prompts)], bucket_temperature(temperatures[i % len(temperatures)]))
+        for i in range(count)
+    ]
+
+@app.post("/generate/variations", response_model=VariationsResponse)
+async def generate_variations(request: VariationsRequest, client: str = Depends(client_id)):
+    """
+    Generate several variations of a prompt in one batched forward pass.
+    
+    Variations cycle through the given prompts and temperatures. MusicGen samples a whole
+    batch at one temperature, so variations are grouped by temperature bucket and each
+    group is a single generate() call; with one temperature that is one call for all.
+    A seed makes the set reproducible as a unit (group i is seeded with seed + i).
+    """
+    start_time = time.time()
+    model_size, duration, _, decoder, audio_format = validate_generation_request(GenerateRequest(
+        prompt=request.prompt or (request.prompts or [""])[0],
+        duration=request.duration,
+        model=request.model,
+        decoder=request.decoder,
+        format=request.format,
+    ))
+    plan = plan_variations(request)
+    
+    groups = OrderedDict()  # temperature -> variation indices
+    for index, (_, temperature) in enumerate(plan):
+        groups.setdefault(temperature, []).append(index)
+    group_seeds = {
+        temperature: None if request.seed is None else request.seed + group_index
+        for group_index, temperature in enumerate(groups)
+    }
+    
+    admit_or_reject(len(plan), client, scheduler.estimate(model_size, duration) * len(groups))
+    loop = asyncio.get_running_loop()
+    try:
+        variation_model = await model_pool.acquire(model_size)
+        try:
+            rendered = {}
+            track_ids = {}
+            seeds = {}
+            timings = {}
+            for temperature, indices in groups.items():
+                started_at = [None]
+                
+                def on_start():
+                    started_at[0] = time.perf_counter()
+                    inference_queue.start(len(indices))
+                
+                try:
+                    wav, sample_rate, tokens, profile = await generate_batch_fitted(
+                        model_size, variation_model, [plan[i][0] for i in indices], duration, temperature, decoder,
+                        group_seeds[temperature], on_start=on_start, clients=(client,)
+                    )
+                finally:
+                    if started_at[0] is not None:
+                        inference_queue.finish(len(indices), time.perf_counter() - started_at[0])
+                observe_batch_profile(model_size, len(indices), profile)
+                for stage, seconds in profile["timings"].items():
+                    timings[stage] = timings.get(stage, 0.0) + seconds
+                with timed_stage(timings, "encode"):
+                    if audio_format == "wav":
+                        encoded = await loop.run_in_executor(None, encode_wav_batch, wav, sample_rate)
+                    else:
+                        encoded = [await loop.run_in_executor(None, encode_audio, row, sample_rate, audio_format) for row in wav]
+                for i, audio_bytes in zip(indices, encoded):
+                    rendered[i] = audio_bytes
+                for i, row, row_seed in zip(indices, tokens, profile["seeds"]):
+                    seeds[i] = row_seed
+                    track_ids[i] = await loop.run_in_executor(None, lambda: code_store.put(
+                        row, model_size, sample_rate, profile["frame_rate"],
+                        {"prompt": plan[i][0], "temperature": temperature, "seed": row_seed, "decoder": decoder},
+                    ))
+        finally:
+            model_pool.release(model_size)
+    except ModelLoadError as e:
+        return VariationsResponse(success=False, error=f"Failed to load model: {str(e)}", metadata={})
+    except Exception as e:
+        print(f"❌ Variations error: {e}")
+        return VariationsResponse(success=False, error=f"Generation failed: {str(e)}", metadata={})
+    finally:
+        inference_queue.release(len(plan), client)
+    
+    variations = [
+        Variation(
+            index=i,
+            prompt=prompt,
+            temperature=temperature,
+            seed=seeds[i],
+            audio_base64=base64.b64encode(rendered[i]).decode('utf-8'),
+            size_bytes=len(rendered[i]),
+            track_id=track_ids[i],
+        )
+        for i, (prompt, temperature) in enumerate(plan)
+    ]
+    generation_time = time.time() - start_time
+    print(f"✅ {len(plan)} variations in {len(groups)} generate() call(s), {generation_time:.2f}s")
+    REQUEST_SECONDS.labels("variations").observe(generation_time)
+    
+    return VariationsResponse(
+        success=True,
+        variations=variations,
+        metadata={
+            "model": f"facebook/musicgen-{model_size}",
+            "model_size": model_size,
+            "decoder": decoder,
+            "duration": duration,
+            "seed": request.seed,
+            "count": len(plan),
+            "generate_calls": len(groups),
+            "sample_rate": sample_rate,
+            "format": audio_format,
+            "size_bytes": sum(len(audio_bytes) for audio_bytes in rendered.values()),
+            "generation_time_seconds": round(generation_time, 2),
+            "timings": timings_metadata(timings),
+            "real_time_factor": round(duration * len(plan) / generation_time, 3),
+            "framework": "AudioCraft",
+            "device": device
+        }
+    )
+
+class GenerationJob:
+    """A request submitted through /jobs, its progress and, once finished, its audio"""
+    
+    def __init__(self, request: GenerateRequest, client: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.client = client
+        self.status = "queued"  # queued -> running -> completed | failed
+        self.progress = 0.0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.audio_bytes = None
+        self.metadata = None
+        self.error = None
+        self.task = None
+    
+    def on_progress(self, generated_tokens: int, total_tokens: int):
+        # Called from the inference thread; plain attribute writes are safe under the GIL
+        if self.status == "queued":
+            self.status = "running"
+            self.started_at = time.time()
+        self.progress = generated_tokens / total_tokens if total_tokens else 0.0
+    
+    async def run(self):
+        capture = profiler.begin("job", self.request, self.client)
+        try:
+            audio_bytes, metadata = await render_request(self.request, self.client, self.on_progress, admitted=True, path="job")
+            # Starlette wants real bytes when the result is served
+            self.audio_bytes = bytes(audio_bytes)
+            self.metadata = metadata if capture is None else {**metadata, "profile_url": f"/admin/profiles/{capture.id}"}
+            self.progress = 1.0
+            self.status = "completed"
+        except Exception as e:
+            print(f"❌ Job {self.id} failed: {e}")
+            if isinstance(e, ModelLoadError):
+                self.error = f"Failed to load model: {str(e)}"
+            elif isinstance(e, HTTPException):
+                self.error = e.detail
+            else:
+                self.error = f"Generation failed: {str(e)}"
+            self.status = "failed"
+        finally:
+            self.finished_at = time.time()
+            REQUEST_SECONDS.labels("job").observe(self.finished_at - self.created_at)
+            # This job's audio may have pushed finished jobs over their bounds
+            job_store.prune()
+            await profiler.end(capture, {"metadata": self.metadata} if self.error is None else {"error": self.error})
+    
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "progress_percent": round(self.progress * 100, 1),
+            "prompt": self.request.prompt,
+            "created_at": self.created_at,
+            "queue_seconds": round((self.started_at or time.time()) - self.created_at, 2),
+            "result_url": f"/jobs/{self.id}/result" if self.status == "completed" else None,
+            "expires_at": self.finished_at + JOB_RETENTION_SECONDS if self.finished_at else None,
+            "error": self.error,
+            "metadata": self.metadata,
+        }
+
+class JobStore:
+    """
+    Jobs by id; finished jobs are dropped once they are older than the retention period,
+    or earlier, oldest first, when there are more than max_finished of them or their
+    audio adds up to more than max_bytes.
+    """
+    
+    def __init__(self, retention_seconds: float, max_finished: int, max_bytes: int):
+        self.retention_seconds = retention_seconds
+        self.max_finished = max_finished
+        self.max_bytes = max_bytes
+        self._jobs = {}
+        self.evicted = 0
+    
+    def add(self, job: GenerationJob):
+        self.prune()
+        self._jobs[job.id] = job
+    
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        self.prune()
+        return self._jobs.get(job_id)
+    
+    def prune(self):
+        cutoff = time.time() - self.retention_seconds
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                del self._jobs[job_id]
+        
+        finished = sorted((job for job in self._jobs.values() if job.finished_at is not None), key=lambda job: job.finished_at)
+        held = sum(len(job.audio_bytes or b"") for job in finished)
+        while finished and (len(finished) > self.max_finished or held > self.max_bytes):
+            job = finished.pop(0)
+            held -= len(job.audio_bytes or b"")
+            del self._jobs[job.id]
+            self.evicted += 1
+    
+    def finished_bytes(self) -> int:
+        return sum(len(job.audio_bytes or b"") for job in self._jobs.values() if job.finished_at is not None)
+    
+    def stats(self) -> dict:
+        counts = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "retention_seconds": self.retention_seconds,
+            "audio_mb": round(self.finished_bytes() / 1024**2, 2),
+            "evicted": self.evicted,
+            **counts,
+        }
+
+job_store = JobStore(JOB_RETENTION_SECONDS, JOB_MAX_FINISHED, int(JOB_MAX_MB * 1024**2))
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: GenerateRequest, client: str = Depends(client_id)):
+    """
+    Queue a generation and return immediately with a job id.
+    
+    Poll GET /jobs/{job_id} for status and progress, then fetch the audio from
+    GET /jobs/{job_id}/result. Jobs take a queue slot up front, so a full queue is
+    rejected here with 503 + Retry-After just like /generate.
+    """
+    model_size, duration, _, _, _ = validate_generation_request(request, long_form=True)
+    admit_or_reject(1, client, scheduler.estimate(model_size, duration))
+    
+    job = GenerationJob(request, client)
+    job_store.add(job)
+    job.task = asyncio.get_running_loop().create_task(job.run())
+    
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "result_url": f"/jobs/{job.id}/result",
+    }
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Job status, progress percentage and, once completed, its metadata"""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, range: Optional[str] = Header(default=None)):
+    """Serve a completed job's audio, honouring a single byte Range"""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status} ({job.progress * 100:.0f}%)")
+    return audio_response(job.audio_bytes, job.metadata, job.metadata["track_id"], range)
+
+def sse_event(event: str, data: dict) -> str:
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def produce_stream(flight: Flight, prompt: str, model_size: str, duration: int, temperature: float, decoder: str, seed: Optional[int], client: Optional[str] = None):
+    """
+    Render a streamed track chunk by chunk and publish it on the flight.
+    
+    Publishes ("start", sample_rate), then ("chunk", (index, start seconds, audio, window
+    timings or None)) per segment, and returns ("done", chunk count). Up to one LM window
+    the track is a single stream_track() job whose chunks are published as the LM samples
+    them; long-form durations publish one cross-faded chunk per window. Runs as the
+    flight's task and owns the queue slot taken for it.
+    """
+    start_time = time.time()
+    acquired = False
+    started_at = [None]
+    
+    def on_start():
+        started_at[0] = time.time()
+        inference_queue.start(1)
+    
+    try:
+        stream_model = await model_pool.acquire(model_size)
+        acquired = True
+        sample_rate = stream_model.sample_rate
+        
+        print(f"🎵 Streaming music...")
+        print(f"   Prompt: {prompt}")
+        print(f"   Model: {model_size}")
+        print(f"   Decoder: {decoder}")
+        print(f"   Duration: {duration}s")
+        flight.publish(("start", sample_rate))
+        
+        if duration > LONG_FORM_WINDOW_SECONDS:
+            # Long-form: one chunk per window, cross-faded and decoded with the requested decoder
+            index = 0
+            async for start_seconds, chunk, _, timings in long_form_windows(
+                model_size, stream_model, prompt, duration, temperature, decoder, seed,
+                on_start=on_start, clients=(client,) if client else ()
+            ):
+                flight.publish(("chunk", (index, start_seconds, chunk, timings)))
+                index += 1
+            REAL_TIME_FACTOR.labels(model_size).observe(duration / (time.time() - start_time))
+            return "done", index
+        
+        loop = asyncio.get_running_loop()
+        published = {"chunks": 0, "samples": 0}
+        
+        def publish(chunk):
+            flight.publish(("chunk", (published["chunks"], published["samples"] / sample_rate, chunk, None)))
+            published["chunks"] += 1
+            published["samples"] += chunk.shape[-1]
+        
+        def on_chunk(chunk):
+            # From the inference thread, or on the loop when a replica's chunk is relayed
+            loop.call_soon_threadsafe(publish, chunk)
+        
+        await run_inference(
+            model_size, stream_model, stream_track, prompt, duration, temperature, decoder, seed,
+            on_chunk=on_chunk, on_start=on_start, audio_seconds=duration, clients=(client,) if client else ()
+        )
+        REAL_TIME_FACTOR.labels(model_size).observe(duration / (time.time() - start_time))
+        return "done", published["chunks"]
+    finally:
+        if acquired:
+            model_pool.release(model_size)
+        if started_at[0] is not None:
+            inference_queue.finish(1, time.time() - started_at[0])
+        inference_queue.release(1, client)
+
+@app.post("/generate/stream")
+async def generate_music_stream(request: GenerateRequest, client: str = Depends(client_id)):
+    """
+    Stream generated music as Server-Sent Events while it is being rendered.
+    
+    Emits a `start` event, then one `chunk` event per rendered segment (a standalone
+    base64 file in the requested format plus its offset in the track), and finally `done` with the same metadata
+    as /generate plus time_to_first_audio_seconds. Failures arrive as an `error` event.
+    Long-form durations send one chunk per window, with that window's timings.
+    An identical stream already in flight is joined: the chunks rendered so far are
+    replayed straight away and the rest arrive as they are rendered.
+    """
+    model_size, duration, temperature, decoder, audio_format = validate_generation_request(request, long_form=True)
+    flight_key = stream_flights.key(request.prompt, model_size, duration, temperature, decoder, request.seed)
+    flight = stream_flights.join(flight_key, "stream")
+    coalesced = flight is not None
+    if not coalesced:
+        admit_or_reject(1, client, scheduler.estimate(model_size, duration))
+        flight = stream_flights.start(flight_key, lambda flight: produce_stream(
+            flight, request.prompt, model_size, duration, temperature, decoder, request.seed, client
+        ))
+    
+    async def events():
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        first_audio_time = None
+        sample_rate = None
+        total_bytes = 0
+        chunks = 0
+        subscription = flight.subscribe()
+        try:
+            async for kind, payload in subscription:
+                if kind == "start":
+                    sample_rate = payload
+                    yield sse_event("start", {
+                        "prompt": request.prompt,
+                        "sample_rate": sample_rate,
+                        "duration": duration,
+                        "format": audio_format,
+                    })
+                elif kind == "chunk":
+                    index, start_seconds, chunk, timings = payload
+                    audio_bytes = await loop.run_in_executor(None, encode_audio, chunk, sample_rate, audio_format)
+                    if first_audio_time is None:
+                        first_audio_time = time.time() - start_time
+                        TIME_TO_FIRST_AUDIO_SECONDS.labels(model_size).observe(first_audio_time)
+                    
+                    yield sse_event("chunk", {
+                        "index": index,
+                        "start_seconds": round(start_seconds, 3),
+                        "duration_seconds": round(chunk.shape[-1] / sample_rate, 3),
+                        "audio_base64": base64.b64encode(audio_bytes).decode('utf-8'),
+                        **({"window": timings} if timings is not None else {}),
+                    })
+                    total_bytes += len(audio_bytes)
+                else:
+                    chunks = payload
+            
+            generation_time = time.time() - start_time
+            REQUEST_SECONDS.labels("stream").observe(generation_time)
+            print(f"✅ Stream complete in {generation_time:.2f}s (first audio after {first_audio_time:.2f}s)")
+            
+            yield sse_event("done", {
+                "model": f"facebook/musicgen-{model_size}",
+                "model_size": model_size,
+                "decoder": decoder,
+                "duration": duration,
+                "temperature": temperature,
+                "seed": request.seed,
+                "sample_rate": sample_rate,
+                "format": audio_format,
+                "chunks": chunks,
+                "size_bytes": total_bytes,
+                "time_to_first_audio_seconds": round(first_audio_time, 2),
+                "generation_time_seconds": round(generation_time, 2),
+                "coalesced": coalesced,
+                "framework": "AudioCraft",
+                "device": device
+            })
+        except Exception as e:
+            print(f"❌ Streaming error: {e}")
+            yield sse_event("error", {"error": f"Generation failed: {str(e)}"})
+        finally:
+            await subscription.aclose()
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 if __name__ == "__main__":
     import uvicorn
     print("🚀 Starting MusicGen server on http://localhost:8000")
-    print(f"📱 Device: {device}")
-    print("💡 Load model on first request (may take 30-60s)")
+    print(f"💡 Preloading models in the background: {', '.join(PRELOAD_MODELS) or 'none'} (poll /ready)")
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
@@ -8,8 +8,11 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional
+from functools import lru_cache
 import base64
 import io
+import os
+import random
 import time
 import asyncio
 import numpy as np
@@ -25,12 +28,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Simulated GPU configuration
+# Requests queue for one of MOCK_GPU_SLOTS slots and then hold it for
+# base latency + seconds of audio * per-second cost, scaled by lognormal jitter.
+# A slot that last ran a different model size pays MOCK_MODEL_SWITCH_SECONDS first.
+MOCK_GPU_SLOTS = int(os.environ.get("MUSICGEN_MOCK_GPU_SLOTS", "1"))
+MOCK_BASE_LATENCY_SECONDS = float(os.environ.get("MUSICGEN_MOCK_BASE_LATENCY_SECONDS", "0.5"))
+# Seconds of compute per second of audio, roughly a T4 without batching
+MOCK_SECONDS_PER_AUDIO_SECOND = {
+    "small": float(os.environ.get("MUSICGEN_MOCK_COST_SMALL", "0.35")),
+    "medium": float(os.environ.get("MUSICGEN_MOCK_COST_MEDIUM", "0.9")),
+    "large": float(os.environ.get("MUSICGEN_MOCK_COST_LARGE", "1.8")),
+    "melody": float(os.environ.get("MUSICGEN_MOCK_COST_MELODY", "1.0")),
+}
+MOCK_MODEL_SWITCH_SECONDS = float(os.environ.get("MUSICGEN_MOCK_MODEL_SWITCH_SECONDS", "8"))
+MOCK_LATENCY_JITTER = float(os.environ.get("MUSICGEN_MOCK_LATENCY_JITTER", "0.15"))  # lognormal sigma
+# Requests waiting beyond this depth are rejected with 503 + Retry-After, like the real server
+MOCK_MAX_QUEUE_DEPTH = int(os.environ.get("MUSICGEN_MOCK_MAX_QUEUE_DEPTH", "16"))
+MOCK_SEED = os.environ.get("MUSICGEN_MOCK_SEED")
+
 # Request/Response models
 class GenerateRequest(BaseModel):
     prompt: str
     duration: Optional[int] = 30
     temperature: Optional[float] = 1.0
-    model_size: Optional[str] = "small"
+    model_size: Optional[str] = "small"  # backward compat
+    model: Optional[str] = None  # preferred, as sent by the Supabase proxy
 
 class GenerateResponse(BaseModel):
     success: bool
@@ -41,8 +64,8 @@ class GenerateResponse(BaseModel):
 
 def generate_mock_audio(duration_seconds: int = 30, sample_rate: int = 32000):
     """Generate a simple sine wave audio for testing"""
-    # Generate a simple tone (440 Hz sine wave)
-    t = np.linspace(0, duration_seconds, int(sample_rate * duration_seconds), False)
+    # The tone repeats every second, so synthesise one second and tile it
+    t = np.arange(sample_rate, dtype=np.float32) / sample_rate
     frequency = 440.0  # A4 note
     audio_data = np.sin(2 * np.pi * frequency * t)
     
@@ -55,6 +78,7 @@ def generate_mock_audio(duration_seconds: int = 30, sample_rate: int = 32000):
     
     # Convert to 16-bit PCM
     audio_data = (audio_data * 32767).astype(np.int16)
+    audio_data = np.tile(audio_data, int(np.ceil(duration_seconds)))[:int(sample_rate * duration_seconds)]
     
     return audio_data, sample_rate
 
@@ -73,6 +97,101 @@ def create_wav_file(audio_data, sample_rate):
     
     return buffer.getvalue()
 
+@lru_cache(maxsize=64)
+def cached_mock_audio(duration_seconds: int, sample_rate: int = 32000):
+    """WAV bytes and their base64 for a duration, built once and reused by every request"""
+    audio_data, sample_rate = generate_mock_audio(duration_seconds, sample_rate)
+    wav_bytes = create_wav_file(audio_data, sample_rate)
+    return wav_bytes, base64.b64encode(wav_bytes).decode('utf-8')
+
+class QueueFullError(Exception):
+    """Raised when the simulated GPU queue is at MOCK_MAX_QUEUE_DEPTH"""
+    def __init__(self, retry_after: int):
+        super().__init__(f"Queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class SimulatedGPU:
+    """Capacity and latency model standing in for the real inference queue"""
+    def __init__(self, slots: int, max_depth: int, seed: Optional[str] = None):
+        self.slots = asyncio.Semaphore(slots)
+        self.slot_models = [None] * slots  # model size each slot last ran
+        self.free_slots = set(range(slots))  # one per unit of the semaphore
+        self.max_depth = max_depth
+        self.rng = random.Random(seed)
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.model_switches = 0
+        self.busy_seconds = 0.0
+        self.started_at = time.time()
+    
+    def service_seconds(self, model_size: str, duration: float) -> float:
+        """Draw the compute time for one request"""
+        mean = MOCK_BASE_LATENCY_SECONDS + duration * MOCK_SECONDS_PER_AUDIO_SECOND.get(model_size, 0.35)
+        return mean * self.rng.lognormvariate(0, MOCK_LATENCY_JITTER)
+    
+    def _estimated_wait(self) -> int:
+        per_request = self.busy_seconds / self.completed if self.completed else 10.0
+        return max(1, int(per_request * (self.waiting + 1) / len(self.slot_models)))
+    
+    async def run(self, model_size: str, duration: float) -> dict:
+        """Queue for a slot and hold it for the simulated compute time, returns timings"""
+        if self.waiting >= self.max_depth:
+            self.rejected += 1
+            raise QueueFullError(self._estimated_wait())
+        
+        enqueued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        queue_wait = time.perf_counter() - enqueued
+        
+        # Among free slots, prefer one that already has this model resident, then an empty one
+        free = sorted(self.free_slots)
+        slot = next((i for i in free if self.slot_models[i] == model_size), None)
+        if slot is None:
+            slot = next((i for i in free if self.slot_models[i] is None), free[0])
+        self.free_slots.remove(slot)
+        switch_seconds = 0.0 if self.slot_models[slot] == model_size else MOCK_MODEL_SWITCH_SECONDS
+        if switch_seconds:
+            self.model_switches += 1
+        self.slot_models[slot] = model_size
+        
+        compute_seconds = self.service_seconds(model_size, duration)
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(switch_seconds + compute_seconds)
+        finally:
+            self.in_flight -= 1
+            self.free_slots.add(slot)
+            self.slots.release()
+        self.completed += 1
+        self.busy_seconds += switch_seconds + compute_seconds
+        
+        return {
+            "queue_wait_seconds": round(queue_wait, 3),
+            "model_load_seconds": round(switch_seconds, 3),
+            "token_generation_seconds": round(compute_seconds, 3),
+        }
+    
+    def stats(self) -> dict:
+        elapsed = time.time() - self.started_at
+        return {
+            "slots": len(self.slot_models),
+            "resident": self.slot_models,
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "model_switches": self.model_switches,
+            "utilization": round(self.busy_seconds / (elapsed * len(self.slot_models)), 3) if elapsed else 0.0,
+        }
+
+gpu = SimulatedGPU(MOCK_GPU_SLOTS, MOCK_MAX_QUEUE_DEPTH, MOCK_SEED)
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -86,7 +205,8 @@ async def get_stats():
         "model_loaded": True,
         "model_size": "small",
         "cuda_available": False,
-        "mode": "mock"
+        "mode": "mock",
+        "gpu": gpu.stats()
     }
 
 @app.post("/generate", response_model=GenerateResponse)
@@ -110,18 +230,17 @@ async def generate_music(request: GenerateRequest):
         print(f"   Duration: {request.duration or 30}s")
         print(f"   Temperature: {request.temperature or 1.0}")
         
-        # Simulate generation time (1-3 seconds for mock)
-        await asyncio.sleep(1.5)
-        
-        # Generate mock audio (simple sine wave)
+        # Simulate queueing and generation time on the modelled GPU
         duration = request.duration or 30
-        audio_data, sample_rate = generate_mock_audio(duration, sample_rate=32000)
-        
-        # Convert to WAV format
-        wav_bytes = create_wav_file(audio_data, sample_rate)
+        model_size = request.model or request.model_size or "small"
+        try:
+            timings = await gpu.run(model_size, duration)
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
         
-        # Convert to base64
-        audio_base64 = base64.b64encode(wav_bytes).decode('utf-8')
+        # Mock audio (simple sine wave) is the same for every request of this duration
+        sample_rate = 32000
+        wav_bytes, audio_base64 = cached_mock_audio(duration, sample_rate)
         
         generation_time = time.time() - start_time
         
@@ -134,12 +253,14 @@ async def generate_music(request: GenerateRequest):
             audio_base64=audio_base64,
             prompt=request.prompt,
             metadata={
-                "model": f"facebook/musicgen-{request.model_size or 'small'}",
-                "model_size": request.model_size or "small",
+                "model": f"facebook/musicgen-{model_size}",
+                "model_size": model_size,
                 "duration": duration,
                 "sample_rate": sample_rate,
                 "size_bytes": len(wav_bytes),
                 "generation_time_seconds": round(generation_time, 2),
+                "timings": timings,
+                "real_time_factor": round(duration / generation_time, 3),
                 "framework": "Mock (AudioCraft not installed)",
                 "device": "cpu"
             }
@@ -162,6 +283,7 @@ if __name__ == "__main__":
     import uvicorn
     print("Starting MusicGen MOCK server on http://localhost:8000")
     print("Device: cpu (mock mode)")
+    print(f"Simulated GPU: {MOCK_GPU_SLOTS} slot(s), {MOCK_SECONDS_PER_AUDIO_SECOND['small']}s per audio second (small)")
     print("NOTE: This is a MOCK server for testing")
     print("Install AudioCraft for real music generation")
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,134 @@
+"""
+Single-flight coalescing for musicgen_server.py: identical generations requested while
+one is already running attach to it instead of starting their own.
+"""
+
+import asyncio
+from typing import Optional
+
+from prometheus_client import Counter
+
+from musicgen_cache import make_cache_key
+
+# Prometheus metrics, exposed on musicgen_server.py's /metrics
+COALESCED_REQUESTS = Counter("musicgen_coalesced_requests_total", "Requests that attached to an identical in-flight generation", ["path"])
+
+class Flight:
+    """
+    One in-flight generation and everyone waiting on it.
+    
+    Progress reported by the work is fanned out to every waiter's callback, and streamed
+    work publishes its items here so waiters that join late replay what they missed.
+    """
+    
+    def __init__(self):
+        self.task = None
+        self.waiters = 1
+        self.progress = None  # last (generated_tokens, total_tokens)
+        self.items = []
+        self._listeners = []
+        self._updated = asyncio.Event()
+    
+    def listen(self, on_progress):
+        if on_progress is None:
+            return
+        self._listeners.append(on_progress)
+        if self.progress is not None:
+            on_progress(*self.progress)
+    
+    def on_progress(self, generated_tokens: int, total_tokens: int):
+        # Called from the inference thread
+        self.progress = (generated_tokens, total_tokens)
+        for listener in list(self._listeners):
+            listener(generated_tokens, total_tokens)
+    
+    def publish(self, item):
+        self.items.append(item)
+        self._wake()
+    
+    def _wake(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+    
+    async def result(self):
+        """Wait for the work without cancelling it if this waiter goes away"""
+        try:
+            return await asyncio.shield(self.task)
+        finally:
+            self.waiters -= 1
+    
+    async def subscribe(self):
+        """Every published item in order, then the work's result (or its exception) as the last item"""
+        index = 0
+        try:
+            while True:
+                while index < len(self.items):
+                    yield self.items[index]
+                    index += 1
+                if self.task.done():
+                    yield self.task.result()
+                    return
+                await self._updated.wait()
+        finally:
+            self.waiters -= 1
+            # Nobody is listening to the stream any more
+            if self.waiters == 0 and not self.task.done():
+                self.task.cancel()
+
+class SingleFlight:
+    """
+    Identical generations in flight, keyed by make_cache_key(..., audio_format=None).
+    
+    The first request for a key starts the work as its own task; requests with the same
+    key that arrive before it finishes join that flight and get the same result, so a
+    burst of identical requests costs one generation.
+    """
+    
+    def __init__(self, mode: str):
+        self.mode = mode
+        self._flights = {}  # key -> Flight
+        self.started = 0
+        self.coalesced = 0
+    
+    def key(self, prompt: str, size: str, duration: int, temperature: float, decoder: str, seed: Optional[int]) -> Optional[str]:
+        """Coalescing key of a request, or None when coalescing doesn't apply to it"""
+        if self.mode == "all" or (self.mode == "seeded" and seed is not None):
+            return make_cache_key(prompt, size, duration, temperature, decoder, seed, None)
+        return None
+    
+    def join(self, key: Optional[str], path: str, on_progress=None) -> Optional[Flight]:
+        flight = self._flights.get(key) if key is not None else None
+        if flight is not None:
+            flight.waiters += 1
+            flight.listen(on_progress)
+            self.coalesced += 1
+            COALESCED_REQUESTS.labels(path).inc()
+        return flight
+    
+    def start(self, key: Optional[str], work, on_progress=None) -> Flight:
+        """Run work(flight), a coroutine function, as a new flight; joinable unless key is None"""
+        flight = Flight()
+        flight.listen(on_progress)
+        flight.task = asyncio.get_running_loop().create_task(work(flight))
+        self.started += 1
+        if key is not None:
+            self._flights[key] = flight
+        
+        def finished(task):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight._wake()
+            if not task.cancelled():
+                task.exception()  # waiters may all be gone; don't warn about it
+        
+        flight.task.add_done_callback(finished)
+        return flight
+    
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "in_flight": len(self._flights),
+            "waiting": sum(flight.waiters - 1 for flight in self._flights.values()),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
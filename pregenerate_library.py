@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Prompt Library Pre-generation
+Renders the likeliest prompts ahead of time into the server's prompt library, so
+preview requests can be answered with the nearest pre-rendered track instead of a
+GPU generation (see MUSICGEN_LIBRARY_SERVE in musicgen_server.py).
+
+Prompts are the frontend's buildMusicGenPrompt() applied to its own vocabularies:
+genres and their energy fit, instrument phrases and presets, the mood map, tempo and
+energy buckets, style levels and vocal types. Every combination gets a prior weight
+(the UI defaults, genre instruments and matching presets weigh more) and the --count
+heaviest are rendered, after any prompts that recur in --history. Tracks are rendered
+in large batches at the longest duration, since the server trims them to any shorter
+request. Runs are resumable: prompts already in the library are skipped, and with
+--window the job waits for the off-peak window and stops when it closes.
+
+Usage:
+    python pregenerate_library.py --list --count 20
+    python pregenerate_library.py --model small --count 500 --batch-size 16 --window 01:00-06:00
+    python pregenerate_library.py --history .musicgen_cache/codes/tracks.jsonl --count 1000
+"""
+
+import argparse
+import collections
+import datetime
+import heapq
+import json
+import math
+import os
+import re
+import time
+
+import numpy as np
+
+from benchmark_load import GENRE_OPTIONS, INSTRUMENT_OPTIONS, REPO_DIR
+
+PROMPT_BUILDER = os.path.join(REPO_DIR, "src", "services", "musicgen.ts")
+
+# Prior weights of the builder's inputs. Style level and vocal type default to 5 and
+# instrumental in the UI, the tempo to 120 bpm when the analysis has none
+STYLE_LEVEL_WEIGHTS = {5: 6.0}
+VOCAL_WEIGHTS = {"instrumental": 4.0, "minimal-vocals": 1.0, "vocal-focused": 1.0}
+TEMPO_BPMS = {60: 1.0, 80: 1.0, 100: 1.0, 120: 3.0, 140: 1.0, 160: 1.0}
+ENERGY_LEVELS = {"Low": 3, "Medium": 5, "High": 8}
+# Energies outside a genre's energyFit are possible, just unlikely
+OFF_FIT_WEIGHT = 0.25
+# Instrument selections: the genre's defaults, its presets, other presets, single instruments
+GENRE_DEFAULT_WEIGHT = 4.0
+GENRE_PRESET_WEIGHT = 4.0
+PRESET_WEIGHT = 1.0
+SINGLE_INSTRUMENT_WEIGHT = 0.5
+
+
+def ts_block(source: str, name: str) -> str:
+    """Body of `name: Record<...> = { ... }` or `const name = { ... }` in a TypeScript source"""
+    return source.split(name, 1)[1].split("{", 1)[1].split("\n}", 1)[0]
+
+
+def load_vocabulary():
+    """Genres, instrument phrases, presets and moods as the frontend defines them"""
+    with open(GENRE_OPTIONS) as f:
+        genre_block = ts_block(f.read(), "export const GENRES")
+    with open(INSTRUMENT_OPTIONS) as f:
+        instrument_source = f.read()
+    with open(PROMPT_BUILDER) as f:
+        builder_source = f.read()
+
+    genres = [
+        {"id": genre_id, "label": label, "energy_fit": re.findall(r"'(\w+)'", energy_fit)}
+        for genre_id, label, energy_fit in re.findall(
+            r"id: '([^']+)',\s*label: '([^']+)',.*?energyFit: \[([^\]]*)\]", genre_block, re.S)
+    ]
+    phrases = dict(re.findall(
+        r"id: '([^']+)',\s*label: '[^']+',\s*promptPhrase: '([^']+)'",
+        ts_block(instrument_source, "export const INSTRUMENTS")))
+    presets = [
+        {"instruments": re.findall(r"'([^']+)'", instruments), "genre": genre}
+        for instruments, genre in re.findall(
+            r"instruments: \[([^\]]*)\],\s*genre: '([^']+)'",
+            ts_block(instrument_source, "export const INSTRUMENT_PRESETS"))
+    ]
+    moods = dict(re.findall(r"(\w+): '([^']+)'", ts_block(builder_source, "function getMoodDescriptor")))
+    if not genres or not phrases or not moods:
+        raise ValueError("Could not read the prompt vocabularies from src/")
+    return genres, phrases, presets, moods
+
+
+# Ports of src/services/musicgen.ts and src/lib/promptBlender.ts
+
+def tempo_descriptor(bpm: float) -> str:
+    if bpm < 70:
+        return "very slow ballad"
+    if bpm < 90:
+        return "slow gentle tempo"
+    if bpm < 110:
+        return "medium relaxed tempo"
+    if bpm < 130:
+        return "moderate upbeat tempo"
+    if bpm < 150:
+        return "fast energetic tempo"
+    return "very fast intense tempo"
+
+
+def energy_descriptor(energy: float) -> str:
+    if energy <= 2:
+        return "very soft gentle dynamics"
+    if energy <= 4:
+        return "soft mellow dynamics"
+    if energy <= 6:
+        return "moderate balanced dynamics"
+    if energy <= 8:
+        return "powerful driving dynamics"
+    return "very intense explosive dynamics"
+
+
+def style_descriptor(level: int) -> tuple:
+    """(era, production) for a style level 0-10"""
+    if level <= 3:
+        era = ["1980s", "1990s", "vintage"][math.floor(level / 2)]
+        return f"{era} lo-fi", "raw production with vinyl crackle and warm analog character"
+    if level <= 6:
+        return "", "polished studio recording with clean mix"
+    era = ["modern", "2020s", "contemporary"][min(math.floor((level - 7) / 1.5), 2)]
+    return f"{era} cinematic", "pristine clarity with professional mastering"
+
+
+def vocal_descriptor(vocal_type: str) -> str:
+    return {
+        "instrumental": "instrumental, no vocals",
+        "minimal-vocals": "subtle vocal textures and wordless vocals",
+        "vocal-focused": "prominent vocals with lead vocal melody",
+    }[vocal_type]
+
+
+def default_instruments(genre_label: str) -> list:
+    genre = genre_label.lower()
+    if "piano" in genre or "classical" in genre:
+        return ["piano"]
+    if "jazz" in genre:
+        return ["piano", "bass", "drums"]
+    if "electronic" in genre or "synth" in genre:
+        return ["synth", "bass", "drums"]
+    if "rock" in genre or "indie" in genre:
+        return ["guitar", "bass", "drums"]
+    if "hip-hop" in genre or "trap" in genre:
+        return ["bass", "drums"]
+    if "folk" in genre or "acoustic" in genre:
+        return ["guitar", "piano"]
+    return ["piano", "bass", "drums"]
+
+
+def build_prompt(genre: str, mood: str, tempo: str, instruments: str, style: tuple, vocal: str, energy: str) -> str:
+    era, production = style
+    parts = [f"{era} {genre}" if era else genre, mood, tempo, f"with {instruments}", production, vocal, energy, "high quality production"]
+    return ", ".join(part for part in parts if part)
+
+
+def prompt_dimensions(genres, phrases, presets, moods) -> list:
+    """Each builder input as a list of (weight, value); genre, energy and instruments are joint"""
+    def instrument_phrase(ids):
+        return " with ".join(phrases[i] for i in ids if i in phrases)
+
+    arrangements = []
+    for genre in genres:
+        selections = collections.defaultdict(float)
+        selections[instrument_phrase(default_instruments(genre["label"]))] += GENRE_DEFAULT_WEIGHT
+        for preset in presets:
+            selections[instrument_phrase(preset["instruments"])] += GENRE_PRESET_WEIGHT if preset["genre"] == genre["id"] else PRESET_WEIGHT
+        for phrase in phrases.values():
+            selections[phrase] += SINGLE_INSTRUMENT_WEIGHT
+        for energy, level in ENERGY_LEVELS.items():
+            energy_weight = 1.0 if energy in genre["energy_fit"] else OFF_FIT_WEIGHT
+            for instruments, weight in selections.items():
+                arrangements.append((energy_weight * weight, (genre["label"], instruments, energy_descriptor(level))))
+
+    # Several moods and style levels share a descriptor; their weights add up
+    mood_weights = collections.Counter(moods.values())
+    style_weights = collections.defaultdict(float)
+    for level in range(11):
+        style_weights[style_descriptor(level)] += STYLE_LEVEL_WEIGHTS.get(level, 1.0)
+    tempo_weights = collections.defaultdict(float)
+    for bpm, weight in TEMPO_BPMS.items():
+        tempo_weights[tempo_descriptor(bpm)] += weight
+
+    return [
+        arrangements,
+        [(weight, mood) for mood, weight in mood_weights.items()],
+        [(weight, tempo) for tempo, weight in tempo_weights.items()],
+        [(weight, style) for style, weight in style_weights.items()],
+        [(weight, vocal_descriptor(vocal)) for vocal, weight in VOCAL_WEIGHTS.items()],
+    ]
+
+
+def heaviest_combinations(dimensions: list):
+    """
+    Yield (weight, values) for one value per dimension, heaviest product of weights first.
+
+    Best-first search over index tuples into the weight-sorted dimensions, so only the
+    frontier is ever materialised rather than the whole cartesian product.
+    """
+    dimensions = [sorted(dimension, key=lambda item: -item[0]) for dimension in dimensions]
+
+    def weight(index):
+        return math.prod(dimension[i][0] for dimension, i in zip(dimensions, index))
+
+    start = (0,) * len(dimensions)
+    frontier = [(-weight(start), start)]
+    seen = {start}
+    while frontier:
+        negative_weight, index = heapq.heappop(frontier)
+        yield -negative_weight, [dimension[i][1] for dimension, i in zip(dimensions, index)]
+        for axis, i in enumerate(index):
+            if i + 1 < len(dimensions[axis]):
+                neighbour = index[:axis] + (i + 1,) + index[axis + 1:]
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    heapq.heappush(frontier, (-weight(neighbour), neighbour))
+
+
+def history_prompts(paths: list, min_count: int) -> list:
+    """Prompts that occur at least min_count times in code store tracks.jsonl files, most frequent first"""
+    counts = collections.Counter()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    prompt = json.loads(line).get("prompt")
+                except ValueError:
+                    continue
+                if prompt:
+                    counts[" ".join(prompt.split())] += 1
+    return [prompt for prompt, count in counts.most_common() if count >= min_count]
+
+
+def candidate_prompts(count: int, history: list) -> list:
+    """The count prompts to render as (weight, prompt), recurring history prompts first"""
+    genres, phrases, presets, moods = load_vocabulary()
+    candidates = {prompt: math.inf for prompt in history[:count]}
+    for weight, (arrangement, mood, tempo, style, vocal) in heaviest_combinations(prompt_dimensions(genres, phrases, presets, moods)):
+        if len(candidates) >= count:
+            break
+        genre, instruments, energy = arrangement
+        candidates.setdefault(build_prompt(genre, mood, tempo, instruments, style, vocal, energy), weight)
+    return list((weight, prompt) for prompt, weight in candidates.items())
+
+
+def parse_window(spec: str) -> tuple:
+    """"01:00-06:00" as (start, end) minutes after midnight; the window may wrap past midnight"""
+    start, end = (int(hours) * 60 + int(minutes) for hours, minutes in (part.split(":") for part in spec.split("-")))
+    return start, end
+
+
+def in_window(window: tuple) -> bool:
+    now = datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    start, end = window
+    return start <= minute < end if start < end else minute >= start or minute < end
+
+
+def publish_index(path: str, track_ids: list, vectors):
+    """Atomically replace embeddings.npz, which is what makes new tracks visible to the server"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, track_ids=np.array(track_ids), vectors=np.asarray(vectors, dtype=np.float32))
+    os.replace(temp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render likely prompts into the server's prompt library")
+    parser.add_argument("--model", default="small")
+    parser.add_argument("--duration", type=int, default=30, help="Seconds per track; shorter requests are served trimmed")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--count", type=int, default=500, help="Prompts in the library for this model")
+    parser.add_argument("--batch-size", type=int, default=8, help="Prompts per generate() call")
+    parser.add_argument("--history", nargs="*", default=[], help="Code store tracks.jsonl files whose recurring prompts go first")
+    parser.add_argument("--history-min", type=int, default=2, help="Occurrences for a history prompt to count as recurring")
+    parser.add_argument("--window", help="Only render between HH:MM-HH:MM local time (e.g. 01:00-06:00)")
+    parser.add_argument("--output", help="Library directory (default: the server's MUSICGEN_LIBRARY_DIR)")
+    parser.add_argument("--list", action="store_true", help="Print the chosen prompts and their weights, render nothing")
+    args = parser.parse_args()
+
+    candidates = candidate_prompts(args.count, history_prompts(args.history, args.history_min))
+    if args.list:
+        for weight, prompt in candidates:
+            print(f"{'history' if weight == math.inf else f'{weight:8.2f}'}  {prompt}")
+        return
+
+    import musicgen_server as server
+    library_dir = args.output or server.LIBRARY_DIR
+    store = server.CodeStore(library_dir)
+    audio_dir = os.path.join(library_dir, "audio")
+    os.makedirs(audio_dir, exist_ok=True)
+    index_path = os.path.join(library_dir, "embeddings.npz")
+    embedder = server.PromptEmbedder(server.LIBRARY_EMBEDDER)
+
+    # Resume: keep the published index and skip prompts this model already has at this length
+    track_ids, vectors = [], np.zeros((0, 0), dtype=np.float32)
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            track_ids, vectors = [str(track_id) for track_id in index["track_ids"]], index["vectors"]
+    done = set()
+    for track_id in track_ids:
+        record = store.record(track_id)
+        if record is not None and record["model_size"] == args.model and record["duration"] >= args.duration:
+            done.add(" ".join(store.metadata(track_id)["prompt"].split()))
+    pending = [prompt for _, prompt in candidates if " ".join(prompt.split()) not in done]
+    print(f"📚 {len(candidates)} prompts, {len(candidates) - len(pending)} already in {library_dir}, {len(pending)} to render")
+    if not pending:
+        return
+
+    window = parse_window(args.window) if args.window else None
+    if window is not None and not in_window(window):
+        print(f"⏳ Waiting for the {args.window} window...")
+        while not in_window(window):
+            time.sleep(60)
+
+    gen_model = server.load_model(args.model)
+    started = time.perf_counter()
+    rendered = 0
+    for first in range(0, len(pending), args.batch_size):
+        if window is not None and not in_window(window):
+            print(f"🌅 Window {args.window} closed; rerun to resume ({len(pending) - rendered} prompts left)")
+            break
+        prompts = pending[first:first + args.batch_size]
+        wav, sample_rate, tokens, profile = server.run_batch_generation(
+            gen_model, args.model, prompts, args.duration, args.temperature, "default"
+        )
+        new_ids = []
+        for prompt, row, audio in zip(prompts, tokens.cpu(), server.encode_wav_batch(wav, sample_rate)):
+            track_id = store.put(row, args.model, sample_rate, profile["frame_rate"], {
+                "prompt": prompt, "temperature": args.temperature, "seed": None, "decoder": "default", "library": True,
+            })
+            with open(os.path.join(audio_dir, f"{track_id}.wav"), "wb") as f:
+                f.write(audio)
+            new_ids.append(track_id)
+
+        # Publish after every batch so a running server picks up tracks as they land
+        new_vectors = embedder.embed(prompts)
+        vectors = new_vectors if not len(track_ids) else np.concatenate([vectors, new_vectors])
+        track_ids += new_ids
+        publish_index(index_path, track_ids, vectors)
+        rendered += len(prompts)
+        elapsed = time.perf_counter() - started
+        print(f"✅ {rendered}/{len(pending)} rendered, {rendered * args.duration / elapsed:.2f} audio seconds per second")
+
+    print(f"📚 Library: {len(track_ids)} tracks in {library_dir}")
+
+
+if __name__ == "__main__":
+    main()
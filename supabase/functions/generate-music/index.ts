@@ -155,12 +155,12 @@ serve(async (req) => {
       );
     }
     
-    // Validate duration
-    if (duration < 1 || duration > 30) {
+    // Validate duration (beyond 30 seconds Modal renders long-form windows)
+    if (duration < 1 || duration > 60) {
       return new Response(
         JSON.stringify({ 
           success: false,
-          error: "Duration must be between 1 and 30 seconds" 
+          error: "Duration must be between 1 and 60 seconds" 
         }),
         { 
           status: 400,
@@ -0,0 +1,80 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The servers are flat scripts at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep caches and stored codes out of the working tree, and inference in this process
+os.environ.setdefault("MUSICGEN_CACHE_DIR", tempfile.mkdtemp(prefix="musicgen-tests-"))
+os.environ.setdefault("MUSICGEN_CPU_WORKERS", "0")
+
+
+def tiny_musicgen(name: str = "debug", device=None):
+    """
+    audiocraft's debug MusicGen (EnCodec with 4 codebooks at 25 frames/s) and a 2-layer LM.
+    
+    Its text conditioner is a lookup table over hashed words rather than T5, so nothing is
+    downloaded; the weights are seeded, so every load is the same model.
+    """
+    import torch
+    from audiocraft.models import MusicGen
+    from audiocraft.models.builders import get_debug_compression_model
+    from audiocraft.models.lm import LMModel
+    from audiocraft.modules.codebooks_patterns import DelayedPatternProvider
+    from audiocraft.modules.conditioners import ConditionFuser, ConditioningProvider, LUTConditioner
+    
+    torch.manual_seed(0)
+    dim = 16
+    provider = ConditioningProvider({"description": LUTConditioner(n_bins=128, dim=dim, output_dim=dim, tokenizer="noop")})
+    fuser = ConditionFuser({"cross": ["description"], "prepend": [], "sum": [], "input_interpolate": []})
+    lm = LMModel(
+        DelayedPatternProvider(n_q=4), provider, fuser, n_q=4, card=400, dim=dim, num_heads=4,
+        custom=True, num_layers=2, cross_attention=True, causal=True,
+    ).eval()
+    return MusicGen(name, get_debug_compression_model().eval(), lm, max_duration=30)
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    """musicgen_server with every model size loading tiny_musicgen(), and empty pools, queues, stores and caches"""
+    pytest.importorskip("audiocraft")
+    from audiocraft.models import MusicGen
+    import musicgen_server
+    
+    monkeypatch.setattr(MusicGen, "get_pretrained", staticmethod(tiny_musicgen))
+    monkeypatch.setattr(musicgen_server, "model_pool", musicgen_server.ModelPool(musicgen_server.model_pool.budget_bytes))
+    monkeypatch.setattr(musicgen_server, "inference_queue", musicgen_server.InferenceQueue(
+        musicgen_server.MAX_QUEUE_DEPTH, musicgen_server.ClientQuotas(0, 0, musicgen_server.CLIENT_QUOTA_BURST)
+    ))
+    monkeypatch.setattr(musicgen_server, "scheduler", musicgen_server.InferenceScheduler(
+        musicgen_server.SCHEDULER_AGING_RATE, musicgen_server.COST_PRIORS, musicgen_server.inference_slots
+    ))
+    monkeypatch.setattr(musicgen_server, "batcher", musicgen_server.GenerationBatcher(
+        musicgen_server.BATCH_WINDOW_MS / 1000, musicgen_server.MAX_BATCH_SIZE
+    ))
+    monkeypatch.setattr(musicgen_server, "job_store", musicgen_server.JobStore(musicgen_server.JOB_RETENTION_SECONDS, 1000, 64 * 1024**2))
+    monkeypatch.setattr(musicgen_server, "code_store", musicgen_server.CodeStore(str(tmp_path / "codes")))
+    monkeypatch.setattr(musicgen_server, "audio_store", musicgen_server.AudioStore(16 * 1024**2))
+    monkeypatch.setattr(musicgen_server, "generation_cache", musicgen_server.GenerationCache(1024**2, 0, str(tmp_path)))
+    monkeypatch.setattr(musicgen_server, "render_flights", musicgen_server.SingleFlight("all"))
+    monkeypatch.setattr(musicgen_server, "stream_flights", musicgen_server.SingleFlight("all"))
+    return musicgen_server
+
+
+@pytest.fixture
+def api(server):
+    """Runs an async scenario(client) against the app in one event loop, returns its result"""
+    import asyncio
+    import httpx
+    
+    def run(scenario):
+        async def main():
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://musicgen", timeout=60) as client:
+                return await scenario(client)
+        return asyncio.run(main())
+    
+    return run
@@ -0,0 +1,96 @@
+"""Stored tracks: /generate/audio, /audio/{track_id} renditions, their metadata and /extend"""
+
+import io
+import wave
+
+
+def wav_info(audio_bytes: bytes):
+    with wave.open(io.BytesIO(audio_bytes)) as f:
+        return f.getnchannels(), f.getframerate(), f.getnframes()
+
+
+def test_generated_track_is_served_again_from_its_codes(server, api, monkeypatch):
+    async def scenario(client):
+        generated = await client.post("/generate/audio", json={"prompt": "stored lofi", "duration": 2})
+        track_id = generated.headers["X-Audio-Id"]
+        stored = await client.get(generated.headers["Location"])
+        # Without the rendition kept from the response, the track is decoded from its codes
+        monkeypatch.setattr(server, "audio_store", server.AudioStore(16 * 1024**2))
+        decoded = await client.get(f"/audio/{track_id}")
+        resampled = await client.get(f"/audio/{track_id}", params={"sample_rate": 16000})
+        partial = await client.get(f"/audio/{track_id}", headers={"Range": "bytes=-100"})
+        unsatisfiable = await client.get(f"/audio/{track_id}", headers={"Range": "bytes=999999999-"})
+        metadata = (await client.get(f"/audio/{track_id}/metadata")).json()
+        return generated, stored, decoded, resampled, partial, unsatisfiable, metadata
+
+    generated, stored, decoded, resampled, partial, unsatisfiable, metadata = api(scenario)
+
+    assert generated.status_code == 200
+    assert generated.headers["content-type"] == "audio/wav"
+    assert wav_info(generated.content) == (1, 32000, 2 * 32000)
+    assert stored.content == generated.content
+    assert decoded.headers["X-Cache"] == "decoded"
+    assert wav_info(decoded.content) == (1, 32000, 2 * 32000)
+    assert wav_info(resampled.content) == (1, 16000, 2 * 16000)
+    assert resampled.headers["X-Sample-Rate"] == "16000"
+    assert partial.status_code == 206
+    assert partial.content == decoded.content[-100:]
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers["Content-Range"] == f"bytes */{len(decoded.content)}"
+    track = metadata["metadata"]
+    assert (track["prompt"], track["model_size"], track["frames"], track["duration"]) == ("stored lofi", "small", 50, 2.0)
+    assert server.code_store.stats()["tracks"] == 1
+
+
+def test_code_store_reads_back_after_a_restart(server):
+    import torch
+
+    codes = torch.randint(0, 2048, (4, 75))
+    track_id = server.code_store.put(codes, "small", 32000, 25, {"prompt": "kept"})
+
+    reopened = server.CodeStore(server.code_store.directory)
+
+    assert torch.equal(reopened.codes(track_id), codes)
+    assert torch.equal(reopened.codes(track_id, last_frames=10), codes[:, -10:])
+    assert reopened.record(track_id)["duration"] == 3.0
+    assert reopened.metadata(track_id) == {"prompt": "kept"}
+
+
+def test_extend_appends_to_a_new_track(server, api):
+    async def scenario(client):
+        original = await client.post("/generate/audio", json={"prompt": "extend lofi", "duration": 2, "seed": 3})
+        track_id = original.headers["X-Audio-Id"]
+        extended = await client.post(f"/audio/{track_id}/extend", json={"duration": 1, "seed": 4})
+        extended_metadata = (await client.get(f"/audio/{extended.headers['X-Audio-Id']}/metadata")).json()
+        original_metadata = (await client.get(f"/audio/{track_id}/metadata")).json()
+        too_long = await client.post(f"/audio/{track_id}/extend", json={"duration": 29})
+        unknown = await client.post("/audio/0123456789abcdef/extend", json={"duration": 1})
+        return original, extended, extended_metadata, original_metadata, too_long, unknown
+
+    original, extended, extended_metadata, original_metadata, too_long, unknown = api(scenario)
+
+    assert extended.status_code == 200
+    assert extended.headers["X-Audio-Id"] != original.headers["X-Audio-Id"]
+    assert extended.headers["Location"] == f"/audio/{extended.headers['X-Audio-Id']}"
+    assert wav_info(extended.content) == (1, 32000, 3 * 32000)
+    track = extended_metadata["metadata"]
+    assert track["parent_track_id"] == original.headers["X-Audio-Id"]
+    assert (track["prompt"], track["frames"]) == ("extend lofi", 75)
+    # The extension starts with the original codes
+    original_codes = server.code_store.codes(original.headers["X-Audio-Id"])
+    assert (server.code_store.codes(extended.headers["X-Audio-Id"])[:, :50] == original_codes).all()
+    assert original_metadata["metadata"]["frames"] == 50
+    assert too_long.status_code == 422
+    assert unknown.status_code == 404
+
+
+def test_unknown_tracks_and_invalid_renditions(api):
+    async def scenario(client):
+        return [
+            (await client.get("/audio/0123456789abcdef")).status_code,
+            (await client.get("/audio/0123456789abcdef/metadata")).status_code,
+            (await client.get("/audio/0123456789abcdef", params={"format": "aiff"})).status_code,
+            (await client.get("/audio/0123456789abcdef", params={"sample_rate": 12345})).status_code,
+        ]
+
+    assert api(scenario) == [404, 404, 400, 400]
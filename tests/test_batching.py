@@ -0,0 +1,57 @@
+"""Request batching (GenerationBatcher) through the /generate endpoint"""
+
+import asyncio
+import base64
+
+import pytest
+
+
+@pytest.fixture
+def batcher(server, monkeypatch):
+    """A batcher whose window is long enough for every request of a scenario to arrive"""
+    fresh = server.GenerationBatcher(1.0, 4)
+    monkeypatch.setattr(server, "batcher", fresh)
+    return fresh
+
+
+def generate_all(api, bodies: list) -> list:
+    """POST every body to /generate at once, returns their metadata in order"""
+    async def scenario(client):
+        responses = await asyncio.gather(*(client.post("/generate", json=body) for body in bodies))
+        return [response.json() for response in responses]
+
+    results = api(scenario)
+    assert all(result["success"] for result in results), results
+    return results
+
+
+def test_compatible_requests_share_one_batch(api, batcher):
+    results = generate_all(api, [{"prompt": f"lofi take {i}", "duration": 1} for i in range(3)])
+
+    assert [result["metadata"]["batch_size"] for result in results] == [3, 3, 3]
+    assert len({result["metadata"]["track_id"] for result in results}) == 3
+    # Each caller gets its own row of the batch
+    assert len({result["audio_base64"] for result in results}) == 3
+    samples = (len(base64.b64decode(results[0]["audio_base64"])) - 44) // 2
+    assert samples == 32000
+    assert (batcher.batches_run, batcher.items_run) == (1, 3)
+
+
+def test_a_full_batch_runs_without_waiting_for_the_window(api, batcher):
+    results = generate_all(api, [{"prompt": f"lofi take {i}", "duration": 1} for i in range(5)])
+
+    assert sorted(result["metadata"]["batch_size"] for result in results) == [1, 4, 4, 4, 4]
+    assert (batcher.batches_run, batcher.items_run) == (2, 5)
+
+
+def test_incompatible_and_seeded_requests_run_apart(api, batcher):
+    results = generate_all(api, [
+        {"prompt": "one second", "duration": 1},
+        {"prompt": "two seconds", "duration": 2},
+        {"prompt": "seeded a", "duration": 1, "seed": 1},
+        {"prompt": "seeded b", "duration": 1, "seed": 1},
+    ])
+
+    assert [result["metadata"]["batch_size"] for result in results] == [1, 1, 1, 1]
+    assert batcher.batches_run == 4
+    assert batcher.stats()["pending_requests"] == 0
@@ -0,0 +1,57 @@
+"""optimize_for_cpu(): int8 quantization of the LM and the T5 text encoder"""
+
+import pytest
+
+from conftest import tiny_musicgen
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("audiocraft")
+transformers = pytest.importorskip("transformers")
+
+import musicgen_server as server
+
+
+def with_t5(loaded):
+    """Gives the tiny model's text conditioner a small T5 kept the way T5Conditioner keeps a frozen one"""
+    config = transformers.T5Config(vocab_size=64, d_model=16, d_kv=8, d_ff=32, num_layers=1, num_heads=2)
+    conditioner = loaded.lm.condition_provider.conditioners["description"]
+    conditioner.__dict__["t5"] = transformers.T5EncoderModel(config).eval()
+    return loaded
+
+
+def quantized_linears(module) -> int:
+    return sum(isinstance(child, torch.ao.nn.quantized.dynamic.Linear) for child in module.modules())
+
+
+def test_int8_reaches_the_t5_outside_the_module_tree():
+    loaded = with_t5(tiny_musicgen())
+    assert quantized_linears(loaded.lm.condition_provider.conditioners["description"].t5) == 0
+
+    server.optimize_for_cpu(loaded, quantize=True)
+
+    t5 = loaded.lm.condition_provider.conditioners["description"].t5
+    assert loaded.int8_modules == ["lm", "t5 (description)"]
+    assert quantized_linears(t5) > 0
+    assert quantized_linears(loaded.lm) > 0
+    # Still outside the LM's state dict
+    assert not any(key.startswith("condition_provider.conditioners.description.t5") for key in loaded.lm.state_dict())
+    hidden = t5(input_ids=torch.tensor([[1, 2, 3]])).last_hidden_state
+    assert hidden.shape == (1, 3, 16)
+
+
+def test_without_quantization_nothing_is_int8():
+    loaded = server.optimize_for_cpu(with_t5(tiny_musicgen()), quantize=False)
+
+    assert loaded.int8_modules == []
+    assert quantized_linears(loaded.lm) == 0
+
+
+def test_optimized_model_still_generates():
+    loaded = server.optimize_for_cpu(tiny_musicgen(), quantize=True, bf16=True)
+    loaded.set_generation_params(duration=1)
+
+    with server.inference_context(loaded):
+        wav = loaded.generate(["warm-up"], progress=False)
+
+    assert loaded.int8_modules == ["lm"]
+    assert wav.shape == (1, 1, loaded.sample_rate)
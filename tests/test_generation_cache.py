@@ -0,0 +1,58 @@
+"""The seeded-render cache (GenerationCache) behind /generate"""
+
+
+def test_seeded_request_is_served_from_memory_the_second_time(server, api):
+    body = {"prompt": "cached lofi", "duration": 1, "seed": 5}
+
+    async def scenario(client):
+        return [(await client.post("/generate", json=body)).json() for _ in range(2)]
+
+    first, second = api(scenario)
+
+    assert first["metadata"]["cache"] == "miss"
+    assert (second["metadata"]["cache"], second["metadata"]["cache_tier"]) == ("hit", "memory")
+    assert second["audio_base64"] == first["audio_base64"]
+    assert second["metadata"]["track_id"] == first["metadata"]["track_id"]
+    # Stage timings belong to the original render
+    assert "timings" not in second["metadata"]
+    assert server.generation_cache.stats()["memory_hits"] == 1
+    assert server.batcher.batches_run == 1
+
+
+def test_disk_tier_outlives_the_process(server, api, monkeypatch, tmp_path):
+    body = {"prompt": "cached lofi", "duration": 1, "seed": 5}
+    monkeypatch.setattr(server, "generation_cache", server.GenerationCache(1024**2, 1024**2, str(tmp_path / "disk")))
+
+    async def first(client):
+        return (await client.post("/generate", json=body)).json()
+
+    rendered = api(first)
+    # A new cache over the same directory, as after a restart
+    monkeypatch.setattr(server, "generation_cache", server.GenerationCache(1024**2, 1024**2, str(tmp_path / "disk")))
+
+    async def again(client):
+        return [(await client.post("/generate", json=body)).json() for _ in range(2)]
+
+    from_disk, promoted = api(again)
+
+    assert rendered["metadata"]["cache"] == "miss"
+    assert (from_disk["metadata"]["cache"], from_disk["metadata"]["cache_tier"]) == ("hit", "disk")
+    assert promoted["metadata"]["cache_tier"] == "memory"
+    assert from_disk["audio_base64"] == rendered["audio_base64"]
+
+
+def test_unseeded_and_differing_requests_are_not_served_from_cache(server, api):
+    async def scenario(client):
+        responses = []
+        for body in (
+            {"prompt": "cached lofi", "duration": 1},
+            {"prompt": "cached lofi", "duration": 1},
+            {"prompt": "cached lofi", "duration": 1, "seed": 5},
+            {"prompt": "cached lofi", "duration": 1, "seed": 6},
+            {"prompt": "cached lofi", "duration": 1, "seed": 5, "temperature": 0.8},
+        ):
+            responses.append((await client.post("/generate", json=body)).json()["metadata"]["cache"])
+        return responses
+
+    assert api(scenario) == ["bypass", "bypass", "miss", "miss", "miss"]
+    assert server.generation_cache.stats()["memory_hits"] == 0
@@ -0,0 +1,79 @@
+"""Asynchronous generation jobs: /jobs, their status and their result"""
+
+import asyncio
+import threading
+
+
+async def until_finished(client, job_id: str) -> dict:
+    for _ in range(600):
+        job = (await client.get(f"/jobs/{job_id}")).json()
+        if job["status"] in ("completed", "failed"):
+            return job
+        await asyncio.sleep(0.05)
+    raise AssertionError("timed out")
+
+
+def test_job_runs_in_the_background_and_serves_its_audio(server, api, monkeypatch):
+    release = threading.Event()
+    original = server.run_batch_generation
+
+    def run_batch_generation(*args, **kwargs):
+        release.wait(30)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(server, "run_batch_generation", run_batch_generation)
+
+    async def scenario(client):
+        created = await client.post("/jobs", json={"prompt": "job lofi", "duration": 1}, headers={"X-Client-Id": "jobs"})
+        job_id = created.json()["job_id"]
+        pending = (await client.get(f"/jobs/{job_id}")).json()
+        early = await client.get(f"/jobs/{job_id}/result")
+        release.set()
+        finished = await until_finished(client, job_id)
+        result = await client.get(finished["result_url"])
+        partial = await client.get(finished["result_url"], headers={"Range": "bytes=0-43"})
+        return created, pending, early, finished, result, partial
+
+    created, pending, early, finished, result, partial = api(scenario)
+
+    assert created.status_code == 202
+    assert created.json()["status_url"] == f"/jobs/{created.json()['job_id']}"
+    assert pending["status"] in ("queued", "running")
+    assert pending["result_url"] is None
+    assert early.status_code == 409
+    assert finished["status"] == "completed"
+    assert finished["progress_percent"] == 100.0
+    assert finished["expires_at"] is not None
+    assert result.headers["content-type"] == "audio/wav"
+    assert len(result.content) == 44 + 32000 * 2
+    assert result.headers["X-Audio-Id"] == finished["metadata"]["track_id"]
+    assert partial.status_code == 206
+    assert partial.content == result.content[:44]
+    assert partial.headers["Content-Range"] == f"bytes 0-43/{len(result.content)}"
+    assert server.job_store.stats()["completed"] == 1
+
+
+def test_failed_and_unknown_jobs(server, api, monkeypatch):
+    def run_batch_generation(*args, **kwargs):
+        raise RuntimeError("decoder exploded")
+
+    monkeypatch.setattr(server, "run_batch_generation", run_batch_generation)
+
+    async def scenario(client):
+        job_id = (await client.post("/jobs", json={"prompt": "job lofi", "duration": 1})).json()["job_id"]
+        finished = await until_finished(client, job_id)
+        result = await client.get(f"/jobs/{job_id}/result")
+        unknown = await client.get("/jobs/0123456789abcdef")
+        invalid = await client.post("/jobs", json={"prompt": "", "duration": 1})
+        return finished, result, unknown, invalid
+
+    finished, result, unknown, invalid = api(scenario)
+
+    assert finished["status"] == "failed"
+    assert "decoder exploded" in finished["error"]
+    assert result.status_code == 500
+    assert unknown.status_code == 404
+    assert invalid.status_code == 400
+    # The failed job gave its queue slot back
+    assert server.inference_queue.admitted == 0
+    assert server.inference_queue.stats()["in_flight"] == 0
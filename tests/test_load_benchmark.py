@@ -0,0 +1,93 @@
+"""Workload replay and reporting in benchmark_load.py, and the cache keys a replay hits"""
+
+import argparse
+
+import benchmark_load
+import musicgen_server as server
+
+
+def workload_args(**overrides):
+    """benchmark_load.py's defaults"""
+    defaults = dict(
+        durations="5:0.5,10:0.3,30:0.2",
+        models="small",
+        min_temperature=0.8,
+        max_temperature=1.2,
+        max_instruments=3,
+        request_seeds=False,
+        seed=0,
+    )
+    return argparse.Namespace(**{**defaults, **overrides})
+
+
+def test_same_seed_replays_the_same_workload():
+    first = benchmark_load.build_workload(workload_args(seed=3), 20)
+
+    assert benchmark_load.build_workload(workload_args(seed=3), 20) == first
+    assert benchmark_load.build_workload(workload_args(seed=4), 20) != first
+
+
+def test_workload_follows_the_mixes():
+    workload = benchmark_load.build_workload(workload_args(models="small:1,medium:1", request_seeds=True), 50)
+
+    assert {body["duration"] for body in workload} <= {5, 10, 30}
+    assert {body["model"] for body in workload} == {"small", "medium"}
+    assert all(body["model_size"] == body["model"] for body in workload)
+    assert all(0.8 <= body["temperature"] <= 1.2 for body in workload)
+    assert [body["seed"] for body in workload] == list(range(50))
+    assert all(body["prompt"].endswith("energy, high quality production") for body in workload)
+
+
+def test_parse_mix():
+    assert benchmark_load.parse_mix("5:0.6,10:0.3,30", int) == ([5, 10, 30], [0.6, 0.3, 1.0])
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+
+    assert benchmark_load.percentile(values, 0.50) == 50
+    assert benchmark_load.percentile(values, 0.95) == 95
+    assert benchmark_load.percentile(values, 0.99) == 99
+    assert benchmark_load.percentile([3, 1, 2], 0.50) == 2
+    assert benchmark_load.percentile([4.0], 0.95) == 4.0
+
+
+def test_summary_counts_errors():
+    results = [
+        {"duration": 5, "latency": 1.0, "error": None, "server_rtf": 2.0, "batch_size": 2, "cache": "hit"},
+        {"duration": 5, "latency": 3.0, "error": None, "server_rtf": 4.0, "batch_size": 4, "cache": "miss"},
+        {"duration": 5, "latency": 9.0, "error": "HTTP 503"},
+    ]
+
+    summary = benchmark_load.summarize(results, wall_seconds=10.0)
+
+    assert summary["succeeded"] == 2
+    assert summary["error_rate"] == round(1 / 3, 4)
+    assert summary["errors"] == {"HTTP 503": 1}
+    assert summary["latency_seconds"]["max"] == 3.0
+    assert summary["mean_batch_size"] == 3
+    assert summary["cache_hits"] == 1
+
+
+def cache_key(body: dict, audio_format="wav") -> str:
+    return server.make_cache_key(body["prompt"], body["model"], body["duration"], body["temperature"], "default", body.get("seed"), audio_format)
+
+
+def test_replayed_seeded_requests_hit_the_same_cache_keys():
+    first = benchmark_load.build_workload(workload_args(request_seeds=True), 10)
+    replay = benchmark_load.build_workload(workload_args(request_seeds=True), 10)
+
+    keys = [cache_key(body) for body in first]
+    assert keys == [cache_key(body) for body in replay]
+    assert len(set(keys)) == len(keys)
+
+
+def test_cache_key_ignores_whitespace_but_not_settings():
+    body = {"prompt": "lofi, with soft piano", "model": "small", "duration": 5, "temperature": 1.0, "seed": 1}
+    key = cache_key(body)
+
+    assert cache_key({**body, "prompt": "  lofi,  with soft\tpiano "}) == key
+    for change in ({"model": "medium"}, {"duration": 10}, {"temperature": 0.9}, {"seed": 2}):
+        assert cache_key({**body, **change}) != key
+    assert cache_key(body, "mp3") != key
+    assert cache_key(body, None) != key
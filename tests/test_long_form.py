@@ -0,0 +1,65 @@
+"""Long-form generation: tracks longer than one LM window, rendered and decoded window by window"""
+
+import io
+import wave
+
+import pytest
+
+
+@pytest.fixture
+def windows(server, monkeypatch):
+    """4 s windows continuing from 2 s of context, cross-faded over 0.2 s"""
+    monkeypatch.setattr(server, "LONG_FORM_WINDOW_SECONDS", 4)
+    monkeypatch.setattr(server, "LONG_FORM_CONTEXT_SECONDS", 2)
+    monkeypatch.setattr(server, "LONG_FORM_CROSSFADE_SECONDS", 0.2)
+
+
+def samples(audio_bytes: bytes) -> int:
+    with wave.open(io.BytesIO(audio_bytes)) as f:
+        return f.getnframes()
+
+
+def test_track_longer_than_a_window_is_rendered_in_windows(server, api, windows, monkeypatch):
+    async def scenario(client):
+        generated = await client.post("/generate/audio", json={"prompt": "long lofi", "duration": 7, "seed": 9})
+        track_id = generated.headers["X-Audio-Id"]
+        metadata = (await client.get(f"/audio/{track_id}/metadata")).json()["metadata"]
+        # Decoded again from the stored codes, also one window at a time
+        monkeypatch.setattr(server, "audio_store", server.AudioStore(16 * 1024**2))
+        decoded = await client.get(f"/audio/{track_id}")
+        return generated, metadata, decoded
+
+    generated, metadata, decoded = api(scenario)
+
+    assert generated.status_code == 200
+    assert samples(generated.content) == 7 * 32000
+    assert (metadata["frames"], metadata["windows"]) == (175, 3)
+    assert decoded.headers["X-Cache"] == "decoded"
+    assert samples(decoded.content) == 7 * 32000
+
+
+def test_generate_reports_each_window(server, api, windows):
+    async def scenario(client):
+        return (await client.post("/generate", json={"prompt": "long lofi", "duration": 7})).json()
+
+    result = api(scenario)
+
+    assert result["success"]
+    reported = result["metadata"]["windows"]
+    assert [window["seconds"] for window in reported] == [4.0, 2.0, 1.0]
+    assert [window["context_seconds"] for window in reported] == [0.0, 2.0, 2.0]
+    assert [window["start_seconds"] for window in reported] == [0.0, 4.0, 6.0]
+    assert all("decode_seconds" in window for window in reported)
+    # Every window was its own scheduler job
+    assert server.scheduler.stats()["dispatched"] == 3
+
+
+def test_durations_stay_bounded(server, api, windows):
+    # LONG_FORM_MAX_SECONDS for /generate; variations are single-window only
+    async def scenario(client):
+        return [
+            (await client.post("/generate", json={"prompt": "long lofi", "duration": server.LONG_FORM_MAX_SECONDS + 1})).status_code,
+            (await client.post("/generate/variations", json={"prompt": "long lofi", "duration": 31, "count": 1})).status_code,
+        ]
+
+    assert api(scenario) == [400, 400]
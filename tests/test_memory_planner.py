@@ -0,0 +1,149 @@
+"""Batch sizing to free memory, split-on-OOM and model fallback in musicgen_server.py"""
+
+import asyncio
+
+import pytest
+import torch
+
+import musicgen_server as server
+
+
+class FakeModel:
+    """A loaded model that renders one row per prompt and runs out of memory above max_batch"""
+
+    sample_rate = 32000
+    frame_rate = 50
+
+    def __init__(self, max_batch: int):
+        self.max_batch = max_batch
+        self.batches = []  # prompts of every generate call, in call order
+        self.seeds = []  # seed of every generate call, in call order
+
+
+def fake_run_batch_generation(batch_model, size, prompts, duration, temperature, decoder, seed=None, on_progress=None, decode=True):
+    """run_batch_generation() for FakeModel; every row of audio and codes holds its prompt's number"""
+    batch_model.batches.append(list(prompts))
+    batch_model.seeds.append(seed)
+    if len(prompts) > batch_model.max_batch:
+        raise torch.cuda.OutOfMemoryError(f"CUDA out of memory. Tried to allocate 2.00 GiB for a batch of {len(prompts)}")
+    frames = int(duration * batch_model.frame_rate)
+    numbers = torch.tensor([int(prompt.split()[-1]) for prompt in prompts])
+    tokens = numbers.view(-1, 1, 1).expand(-1, 4, frames).clone()
+    wav = numbers.view(-1, 1, 1).float().expand(-1, 1, frames * 640).clone()
+    profile = server.profile_batch({"token_generation": 0.01, "decode": 0.01}, tokens, duration, len(prompts), batch_model.frame_rate)
+    profile["peak_memory_bytes"] = 0
+    return wav, batch_model.sample_rate, tokens, profile
+
+
+@pytest.fixture
+def planner(monkeypatch):
+    """A fresh MemoryPlanner, with generation running FakeModel in this process"""
+    monkeypatch.setattr(server, "run_batch_generation", fake_run_batch_generation)
+    monkeypatch.setattr(server, "PIPELINE", False)
+    fresh = server.MemoryPlanner(headroom=0.9, cap_seconds=60)
+    monkeypatch.setattr(server, "memory_planner", fresh)
+    return fresh
+
+
+def prompts(count: int) -> list:
+    return [f"prompt {i}" for i in range(count)]
+
+
+def fitted(model: FakeModel, batch: list, size: str = "small", duration: int = 2, seed=None):
+    return asyncio.run(server.generate_batch_fitted(size, model, batch, duration, 1.0, "default", seed))
+
+
+def test_oom_halves_the_batch_and_keeps_results_in_order(planner):
+    model = FakeModel(max_batch=2)
+
+    wav, sample_rate, tokens, profile = fitted(model, prompts(5))
+
+    assert model.batches == [prompts(5), prompts(2), prompts(5)[2:], ["prompt 2"], ["prompt 3", "prompt 4"]]
+    assert wav[:, 0, 0].tolist() == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert tokens[:, 0, 0].tolist() == [0, 1, 2, 3, 4]
+    assert sample_rate == FakeModel.sample_rate
+    assert planner.oom_events == 2
+    assert planner.splits == 2
+
+
+def test_split_slices_of_a_seeded_batch_get_their_own_seeds(planner, monkeypatch):
+    model = FakeModel(max_batch=2)
+
+    *_, profile = fitted(model, prompts(5), seed=42)
+
+    # Calls: all 5, rows 0-1, rows 2-4, row 2, rows 3-4
+    first, low, high, row_2, rows_3_4 = model.seeds
+    assert first == low == 42
+    assert high == row_2 == server.chunk_seed(42, 2)
+    assert rows_3_4 == server.chunk_seed(42, 3)
+    assert len({42, row_2, rows_3_4}) == 3
+    assert profile["seeds"] == [42, 42, row_2, rows_3_4, rows_3_4]
+
+    # The same split replays the same seeds
+    monkeypatch.setattr(server, "memory_planner", server.MemoryPlanner(headroom=0.9, cap_seconds=60))
+    again = FakeModel(max_batch=2)
+    assert fitted(again, prompts(5), seed=42)[3]["seeds"] == profile["seeds"]
+
+
+def test_unsplit_batch_keeps_its_seed(planner):
+    model = FakeModel(max_batch=4)
+
+    assert fitted(model, prompts(3), seed=7)[3]["seeds"] == [7, 7, 7]
+    assert fitted(model, prompts(2))[3]["seeds"] == [None, None]
+    assert model.seeds == [7, None]
+
+
+def test_oom_caps_later_batches_of_the_same_shape(planner):
+    model = FakeModel(max_batch=2)
+    fitted(model, prompts(4))
+    model.batches.clear()
+
+    fitted(model, prompts(4))
+
+    assert model.batches == [prompts(2), prompts(4)[2:]]
+    assert planner.oom_events == 1
+    assert planner.stats()["caps"] == {"small/2s": 2}
+
+
+def test_single_prompt_that_does_not_fit_raises(planner):
+    with pytest.raises(server.OutOfMemoryError):
+        fitted(FakeModel(max_batch=0), prompts(1))
+
+
+def render_track(monkeypatch, models: dict, allow_fallback: bool):
+    """generate_track() for prompt 7 at medium through the batcher, with models resident per size"""
+    async def acquire(size):
+        return models[size]
+
+    monkeypatch.setattr(server.model_pool, "acquire", acquire)
+    monkeypatch.setattr(server.model_pool, "release", lambda size: None)
+
+    async def render():
+        server.inference_queue.admit(1)
+        return await server.generate_track("prompt 7", "medium", 2, 1.0, "default", None, None, allow_fallback=allow_fallback)
+
+    return asyncio.run(render())
+
+
+def test_allow_fallback_renders_with_the_smaller_model(planner, monkeypatch):
+    models = {"medium": FakeModel(max_batch=0), "small": FakeModel(max_batch=4)}
+
+    wav, _, codes, _, profile, track_id = render_track(monkeypatch, models, allow_fallback=True)
+
+    assert models["medium"].batches == [["prompt 7"]]
+    assert models["small"].batches == [["prompt 7"]]
+    assert profile["model_size"] == "small"
+    assert profile["fallback_from"] == "medium"
+    assert wav[0, 0].item() == 7.0
+    assert server.track_metadata(track_id)["model_size"] == "small"
+    assert planner.fallbacks == 1
+
+
+def test_without_allow_fallback_oom_is_raised(planner, monkeypatch):
+    models = {"medium": FakeModel(max_batch=0), "small": FakeModel(max_batch=4)}
+
+    with pytest.raises(server.OutOfMemoryError):
+        render_track(monkeypatch, models, allow_fallback=False)
+
+    assert models["small"].batches == []
+    assert planner.fallbacks == 0
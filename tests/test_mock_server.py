@@ -0,0 +1,82 @@
+"""musicgen_server_mock.py: the simulated GPU's latency and capacity model behind /generate"""
+
+import base64
+import io
+import wave
+
+import pytest
+from fastapi.testclient import TestClient
+
+import musicgen_server_mock as mock
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """TestClient for the mock, with near-zero simulated latency on a fresh two-slot GPU"""
+    monkeypatch.setattr(mock, "MOCK_BASE_LATENCY_SECONDS", 0.01)
+    monkeypatch.setattr(mock, "MOCK_SECONDS_PER_AUDIO_SECOND", {"small": 0.001, "medium": 0.002})
+    monkeypatch.setattr(mock, "MOCK_MODEL_SWITCH_SECONDS", 0.02)
+    monkeypatch.setattr(mock, "gpu", mock.SimulatedGPU(2, 4, "0"))
+    return TestClient(mock.app)
+
+
+def test_generate_returns_a_wav_of_the_requested_duration(client):
+    response = client.post("/generate", json={"prompt": "mock lofi", "duration": 3})
+
+    body = response.json()
+    assert response.status_code == 200 and body["success"]
+    with wave.open(io.BytesIO(base64.b64decode(body["audio_base64"]))) as f:
+        assert (f.getnchannels(), f.getframerate(), f.getnframes()) == (1, 32000, 3 * 32000)
+    metadata = body["metadata"]
+    assert metadata["size_bytes"] == 44 + 3 * 32000 * 2
+    assert set(metadata["timings"]) == {"queue_wait_seconds", "model_load_seconds", "token_generation_seconds"}
+    assert metadata["timings"]["model_load_seconds"] == 0.02
+
+
+def test_slots_keep_their_model_resident(client):
+    for model in ("small", "medium", "small", "medium"):
+        assert client.post("/generate", json={"prompt": "mock", "duration": 1, "model": model}).status_code == 200
+
+    gpu = client.get("/stats").json()["gpu"]
+    assert gpu["completed"] == 4
+    assert gpu["model_switches"] == 2
+    assert sorted(gpu["resident"]) == ["medium", "small"]
+
+
+def test_full_queue_is_rejected_with_retry_after(client, monkeypatch):
+    monkeypatch.setattr(mock, "gpu", mock.SimulatedGPU(1, 0, "0"))
+
+    response = client.post("/generate", json={"prompt": "mock", "duration": 1})
+
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert client.get("/stats").json()["gpu"]["rejected"] == 1
+
+
+@pytest.mark.parametrize("body", [
+    {"prompt": " ", "duration": 5},
+    {"prompt": "mock", "duration": 31},
+    {"prompt": "mock", "duration": 5, "temperature": 2.5},
+])
+def test_invalid_requests_are_rejected(client, body):
+    assert client.post("/generate", json=body).status_code == 400
+
+
+def test_audio_of_a_duration_is_built_once(client):
+    mock.cached_mock_audio.cache_clear()
+
+    first = client.post("/generate", json={"prompt": "one", "duration": 2}).json()
+    second = client.post("/generate", json={"prompt": "two", "duration": 2}).json()
+
+    assert first["audio_base64"] == second["audio_base64"]
+    assert mock.cached_mock_audio.cache_info().hits == 1
+
+
+def test_service_time_follows_the_latency_model(monkeypatch):
+    monkeypatch.setattr(mock, "MOCK_BASE_LATENCY_SECONDS", 0.5)
+    monkeypatch.setattr(mock, "MOCK_SECONDS_PER_AUDIO_SECOND", {"small": 0.35, "large": 1.8})
+    monkeypatch.setattr(mock, "MOCK_LATENCY_JITTER", 0.0)
+
+    assert mock.SimulatedGPU(1, 1).service_seconds("small", 10) == pytest.approx(0.5 + 10 * 0.35)
+    monkeypatch.setattr(mock, "MOCK_LATENCY_JITTER", 0.15)
+    assert mock.SimulatedGPU(1, 1, "7").service_seconds("large", 10) == mock.SimulatedGPU(1, 1, "7").service_seconds("large", 10)
@@ -0,0 +1,157 @@
+"""modal_local.py's stand-in for the Modal runtime, driving modal_musicgen.py's container routing"""
+
+import asyncio
+import sys
+import threading
+
+import pytest
+
+import modal_local
+
+
+@pytest.fixture(scope="module")
+def modal_app():
+    """modal_musicgen imported against the stub, with containers that load no weights"""
+    saved = {name: sys.modules.pop(name) for name in ("modal", "modal_musicgen") if name in sys.modules}
+    modal_local.install()
+    import modal_musicgen
+    yield modal_musicgen
+    for name in ("modal", "modal_musicgen"):
+        sys.modules.pop(name, None)
+    sys.modules.update(saved)
+
+
+@pytest.fixture
+def containers(modal_app, monkeypatch):
+    """Replaces the model load and generate() with fakes, returns the sizes of started containers"""
+    started = []
+
+    def load_model(self):
+        started.append(self.model_size)
+
+    def generate(self, prompt, duration=30, temperature=1.0, decoder="default", seed=None, format="wav", binary=False, job_id=None):
+        if prompt == "fail":
+            raise RuntimeError("generation failed")
+        release = getattr(self, "release", None)
+        if release is not None:
+            release.wait(5)
+        return {"success": True, "prompt": prompt, "model": self.model_size, "container": id(self)}
+
+    load_model._modal_enter = True
+    generate._modal_method = True
+    user_cls = modal_app.MusicGenModel.user_cls
+    monkeypatch.setattr(user_cls, "load_model", load_model)
+    monkeypatch.setattr(user_cls, "generate", generate)
+    monkeypatch.setattr(user_cls, "release", None, raising=False)
+    modal_app.MusicGenModel._pools.clear()
+    return started
+
+
+def test_each_model_size_has_its_own_pool(modal_app, containers):
+    small = modal_app.model_container("small").generate.remote(prompt="a")
+    medium = modal_app.model_container("medium").generate.remote(prompt="b")
+    again = modal_app.model_container("small").generate.remote(prompt="c")
+
+    assert (small["model"], medium["model"], again["model"]) == ("small", "medium", "small")
+    assert again["container"] == small["container"]
+    assert containers == ["small", "medium"]
+
+
+def test_remote_aio(modal_app, containers):
+    result = asyncio.run(modal_app.model_container("large").generate.remote.aio(prompt="a"))
+
+    assert result["model"] == "large"
+
+
+def test_map_keeps_order_and_can_return_exceptions(modal_app, containers):
+    outputs = list(modal_app.model_container("small").generate.map(["a", "fail", "c"], return_exceptions=True))
+
+    assert outputs[0]["prompt"] == "a"
+    assert isinstance(outputs[1], RuntimeError)
+    assert outputs[2]["prompt"] == "c"
+    with pytest.raises(RuntimeError):
+        list(modal_app.model_container("small").generate.map(["fail"]))
+
+
+def test_map_aio_keeps_order(modal_app, containers):
+    async def collect():
+        return [output async for output in modal_app.model_container("small").generate.map.aio(["a", "b", "c"], [5, 5, 5])]
+
+    assert [output["prompt"] for output in asyncio.run(collect())] == ["a", "b", "c"]
+
+
+def test_spawned_call_is_fetched_by_id(modal_app, containers, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(modal_app.MusicGenModel.user_cls, "release", release)
+
+    call = modal_app.model_container("small").generate.spawn(prompt="later")
+    with pytest.raises(TimeoutError):
+        modal_app.modal.FunctionCall.from_id(call.object_id).get(timeout=0)
+    release.set()
+
+    assert modal_app.modal.FunctionCall.from_id(call.object_id).get(timeout=5)["prompt"] == "later"
+
+
+def test_a_pool_runs_at_most_local_containers_calls_at_once(modal_app, containers, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(modal_app.MusicGenModel.user_cls, "release", release)
+    handle = modal_app.model_container("small").generate
+
+    calls = [handle.spawn(prompt=str(i)) for i in range(modal_local.LOCAL_CONTAINERS + 2)]
+    threading.Timer(0.2, release.set).start()
+    results = [modal_app.modal.FunctionCall.from_id(call.object_id).get(timeout=5) for call in calls]
+
+    assert [result["prompt"] for result in results] == [str(i) for i in range(len(calls))]
+    assert len({result["container"] for result in results}) == modal_local.LOCAL_CONTAINERS
+    assert containers == ["small"] * modal_local.LOCAL_CONTAINERS
+
+
+def test_dict_from_name_is_shared(modal_app):
+    jobs = modal_app.modal.Dict.from_name("tunestory-musicgen-jobs")
+
+    assert jobs is modal_app.job_state
+    jobs["a"] = 1
+    assert jobs.get("a") == 1
+    assert asyncio.run(jobs.pop.aio("a")) == 1
+    assert jobs.get("a", "gone") == "gone"
+    with pytest.raises(KeyError):
+        jobs.pop("a")
+
+
+def web_client(modal_app, monkeypatch):
+    """TestClient for the web app, with its metrics in their own registry rather than the server's"""
+    import functools
+
+    import prometheus_client
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(prometheus_client, "Histogram", functools.partial(prometheus_client.Histogram, registry=prometheus_client.CollectorRegistry()))
+    return TestClient(modal_app.fastapi_app())
+
+
+def test_jobs_expire_from_when_they_finished(modal_app, containers, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(modal_app.MusicGenModel.user_cls, "release", release)
+    client = web_client(modal_app, monkeypatch)
+    job_id = client.post("/jobs", json={"prompt": "slow", "model": "small"}).json()["job_id"]
+
+    # Queued for longer than the retention period is not expired
+    job = modal_app.job_state.get(job_id)
+    modal_app.job_state[job_id] = {**job, "created_at": job["created_at"] - 2 * modal_app.JOB_RETENTION_SECONDS}
+    pending = client.get(f"/jobs/{job_id}").json()
+    assert pending["status"] in ("queued", "running")
+    assert pending["expires_at"] is None
+
+    release.set()
+    modal_app.modal.FunctionCall.from_id(job["call_id"]).get(timeout=5)
+    finished = client.get(f"/jobs/{job_id}").json()
+    finished_at = modal_app.job_state.get(job_id)["finished_at"]
+    assert finished["status"] == "completed"
+    assert finished["expires_at"] == finished_at + modal_app.JOB_RETENTION_SECONDS
+    assert client.get(f"/jobs/{job_id}").json()["expires_at"] == finished["expires_at"]
+
+    # No progress was ever published, so only the job entry is there to drop
+    modal_app.job_state[job_id] = {**modal_app.job_state.get(job_id), "finished_at": finished_at - modal_app.JOB_RETENTION_SECONDS - 1}
+    assert client.get(f"/jobs/{job_id}").status_code == 404
+    assert modal_app.job_state.get(job_id) is None
+    assert client.get(f"/jobs/{job_id}").status_code == 404
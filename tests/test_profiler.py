@@ -0,0 +1,114 @@
+"""On-demand request profiling: /admin/profile, captured requests and their artifacts"""
+
+import pytest
+
+from musicgen_profiler import render_flamegraph_svg, sample_spans
+
+ADMIN = {"X-Admin-Token": "secret"}
+
+
+@pytest.fixture
+def profiler(server, monkeypatch, tmp_path):
+    """A fresh profiler writing under tmp_path, with the admin endpoints behind a token"""
+    fresh = server.RequestProfiler(str(tmp_path / "profiles"), 5, 50 * 1024**2, 3600, 60)
+    monkeypatch.setattr(server, "profiler", fresh)
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(server, "ADMIN_ALLOW_LOOPBACK", False)
+    return fresh
+
+
+def test_admin_endpoints_need_the_token(server, api, profiler, monkeypatch):
+    async def scenario(client):
+        missing = await client.get("/admin/profile")
+        wrong = await client.get("/admin/profile", headers={"X-Admin-Token": "guess"})
+        allowed = await client.get("/admin/profile", headers=ADMIN)
+        monkeypatch.setattr(server, "ADMIN_TOKEN", "")
+        disabled = await client.get("/admin/profile", headers=ADMIN)
+        return missing, wrong, allowed, disabled
+
+    missing, wrong, allowed, disabled = api(scenario)
+
+    assert (missing.status_code, wrong.status_code, allowed.status_code) == (403, 403, 200)
+    assert allowed.json()["captures"] == []
+    # Without a token configured the endpoints don't exist
+    assert disabled.status_code == 404
+
+
+def test_armed_profiler_captures_the_next_matching_request(server, api, profiler):
+    async def scenario(client):
+        armed = await client.post("/admin/profile", json={"count": 1, "mode": "sampling", "sample_interval_ms": 2, "prompt_contains": "profiled"}, headers=ADMIN)
+        unmatched = (await client.post("/generate", json={"prompt": "plain lofi", "duration": 1})).json()
+        matched = (await client.post("/generate", json={"prompt": "profiled lofi", "duration": 1})).json()
+        after = (await client.post("/generate", json={"prompt": "profiled lofi again", "duration": 1})).json()
+        capture = (await client.get(matched["metadata"]["profile_url"], headers=ADMIN)).json()
+        svg = await client.get(capture["downloads"]["flamegraph.svg"], headers=ADMIN)
+        trace = (await client.get(capture["downloads"]["trace.json"], headers=ADMIN)).json()
+        listing = (await client.get("/admin/profile", headers=ADMIN)).json()
+        return armed.json(), unmatched, matched, after, capture, svg, trace, listing
+
+    armed, unmatched, matched, after, capture, svg, trace, listing = api(scenario)
+
+    assert armed["filters"] == {"prompt_contains": "profiled"}
+    assert "profile_url" not in unmatched["metadata"]
+    assert "profile_url" not in after["metadata"]
+    assert (capture["path"], capture["prompt"], capture["modes"]) == ("generate", "profiled lofi", ["sampling"])
+    assert capture["metadata"]["track_id"] == matched["metadata"]["track_id"]
+    assert capture["samples"] > 0
+    assert {"decode", "encode", "base64"} <= {stage["stage"] for stage in capture["stages"]}
+    assert capture["files"] == ["flamegraph.folded", "flamegraph.svg", "trace.json"]
+    assert svg.headers["content-type"] == "image/svg+xml"
+    assert svg.text.startswith("<svg")
+    assert {"request", "stage", "sample"} <= {event.get("cat") for event in trace["traceEvents"]}
+    assert (listing["armed"], listing["captured"], len(listing["captures"])) == (False, 1, 1)
+
+
+def test_torch_mode_records_the_model_stages(server, api, profiler):
+    async def scenario(client):
+        await client.post("/admin/profile", json={"mode": "torch", "path": "generate_audio"}, headers=ADMIN)
+        generated = await client.post("/generate/audio", json={"prompt": "torch lofi", "duration": 1})
+        return (await client.get(generated.headers["X-Profile-Url"], headers=ADMIN)).json()
+
+    capture = api(scenario)
+
+    assert capture["samples"] == 0
+    assert any(name.startswith("torch_") and name.endswith(".json") for name in capture["files"])
+    assert any(name.startswith("torch_") and name.endswith(".txt") for name in capture["files"])
+
+
+def test_invalid_arm_requests_and_unknown_captures(api, profiler):
+    async def scenario(client):
+        return [
+            (await client.post("/admin/profile", json={"count": 0}, headers=ADMIN)).status_code,
+            (await client.post("/admin/profile", json={"mode": "perf"}, headers=ADMIN)).status_code,
+            (await client.post("/admin/profile", json={"sample_interval_ms": 500}, headers=ADMIN)).status_code,
+            (await client.get("/admin/profiles/0123456789abcdef", headers=ADMIN)).status_code,
+            (await client.get("/admin/profiles/0123456789abcdef/.hidden", headers=ADMIN)).status_code,
+        ]
+
+    assert api(scenario) == [400, 400, 400, 404, 404]
+
+
+def test_samples_become_nested_spans_per_thread():
+    samples = [
+        (0.00, "main", ("a", "b")),
+        (0.01, "main", ("a", "b", "c")),
+        (0.02, "main", ("a", "d")),
+        (0.10, "main", ("a",)),  # idle in between
+    ]
+
+    spans = sorted(sample_spans(samples, 0.01), key=lambda span: (span[2], span[1]))
+
+    assert spans == [
+        ("main", "a", 0.0, 0.03),
+        ("main", "b", 0.0, 0.02),
+        ("main", "c", 0.01, 0.02),
+        ("main", "d", 0.02, 0.03),
+        ("main", "a", 0.1, pytest.approx(0.11)),
+    ]
+
+
+def test_flamegraph_widths_follow_sample_counts():
+    svg = render_flamegraph_svg({("main", "a"): 3, ("main", "b"): 1}, "test <profile>")
+
+    assert 'width="900.0"' in svg and 'width="300.0"' in svg
+    assert "test &lt;profile&gt;" in svg
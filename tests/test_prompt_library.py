@@ -0,0 +1,90 @@
+"""Serving previews from the pre-rendered prompt library (PromptLibrary)"""
+
+import base64
+import io
+import os
+import wave
+
+import numpy as np
+import pytest
+import torch
+
+from musicgen_common import encode_wav
+
+
+class FakeEmbedder:
+    """Fixed unit vectors per prompt instead of T5"""
+
+    VECTORS = {"library lofi": [1.0, 0.0], "library lofi, softer": [0.98, 0.199], "heavy metal": [0.0, 1.0]}
+
+    def embed(self, prompts: list) -> np.ndarray:
+        return np.array([self.VECTORS[prompt] for prompt in prompts], dtype=np.float32)
+
+
+@pytest.fixture
+def library(server, monkeypatch, tmp_path):
+    """A library with one 4 s small-model track for "library lofi", laid out as pregenerate_library.py does"""
+    directory = str(tmp_path / "library")
+    store = server.CodeStore(directory)
+    track_id = store.put(torch.zeros(4, 100, dtype=torch.long), "small", 32000, 25, {"prompt": "library lofi", "temperature": 1.0})
+    os.makedirs(os.path.join(directory, "audio"))
+    with open(os.path.join(directory, "audio", f"{track_id}.wav"), "wb") as f:
+        f.write(encode_wav(torch.full((1, 4 * 32000), 0.5), 32000))
+    np.savez(os.path.join(directory, "embeddings.npz"), track_ids=np.array([track_id]), vectors=np.array([[1.0, 0.0]], dtype=np.float32))
+
+    monkeypatch.setattr(server, "LIBRARY_SERVE", "preview")
+    monkeypatch.setattr(server, "prompt_library", server.PromptLibrary(directory, FakeEmbedder(), 0.95, "preview"))
+    return track_id
+
+
+def samples(result: dict) -> int:
+    with wave.open(io.BytesIO(base64.b64decode(result["audio_base64"]))) as f:
+        return f.getnframes()
+
+
+def test_close_preview_is_served_from_the_library(server, api, library):
+    async def scenario(client):
+        return (await client.post("/generate", json={"prompt": "library lofi, softer", "duration": 2, "preview": True})).json()
+
+    result = api(scenario)
+
+    metadata = result["metadata"]
+    assert (metadata["cache"], metadata["track_id"], metadata["library_prompt"]) == ("library", library, "library lofi")
+    assert metadata["library_similarity"] == pytest.approx(0.98, abs=1e-3)
+    # Cut to the requested duration
+    assert samples(result) == 2 * 32000
+    assert server.batcher.batches_run == 0
+    assert server.prompt_library.stats()["hits"] == 1
+
+
+@pytest.mark.parametrize("body", [
+    {"prompt": "library lofi", "duration": 2},
+    {"prompt": "library lofi", "duration": 2, "preview": True, "seed": 1},
+    {"prompt": "library lofi", "duration": 5, "preview": True},
+    {"prompt": "heavy metal", "duration": 2, "preview": True},
+])
+def test_other_requests_are_generated(server, api, library, body):
+    async def scenario(client):
+        return (await client.post("/generate", json=body)).json()
+
+    result = api(scenario)
+
+    assert result["success"]
+    assert result["metadata"]["cache"] in ("miss", "bypass")
+    assert samples(result) == body["duration"] * 32000
+    assert server.batcher.batches_run == 1
+
+
+def test_library_tracks_are_served_like_stored_ones(server, api, library):
+    async def scenario(client):
+        audio = await client.get(f"/audio/{library}")
+        metadata = (await client.get(f"/audio/{library}/metadata")).json()
+        return audio, metadata
+
+    audio, metadata = api(scenario)
+
+    assert audio.status_code == 200
+    with wave.open(io.BytesIO(audio.content)) as f:
+        assert f.getnframes() == 4 * 32000
+    assert metadata["metadata"]["prompt"] == "library lofi"
+    assert server.code_store.stats()["tracks"] == 0
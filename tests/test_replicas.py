@@ -0,0 +1,46 @@
+"""CPU replica processes: shared weights, the shared conditioning cache and streamed chunks"""
+
+import pytest
+
+
+@pytest.fixture
+def replicas(server, monkeypatch):
+    """Two spawned replicas serving the tiny model, with an empty conditioning cache in front"""
+    monkeypatch.setattr(server, "CPU_WORKERS", 2)
+    monkeypatch.setattr(server, "conditioning_cache", server.MeteredConditioningCache(1024**2))
+    pool = server.ReplicaPool(2, server.init_replica, server.conditioning_cache)
+    monkeypatch.setattr(server, "replica_pool", pool)
+    yield pool
+    pool.stop()
+
+
+def test_replicas_share_the_conditioning_cache(server, api, replicas):
+    async def scenario(client):
+        first = await client.post("/generate", json={"prompt": "replica lofi", "duration": 1, "seed": 1})
+        after_first = server.conditioning_cache.stats()
+        second = await client.post("/generate", json={"prompt": "replica lofi", "duration": 2, "seed": 1})
+        stats = (await client.get("/stats")).json()
+        return first.json(), after_first, second.json(), stats
+
+    first, after_first, second, stats = api(scenario)
+
+    assert first["success"] and second["success"]
+    assert stats["replicas"]["calls"] == 2
+    # The prompt and the empty classifier-free guidance prompt were conditioned on replica 0
+    assert (after_first["entries"], after_first["hits"], after_first["misses"]) == (2, 0, 2)
+    # and were hits on replica 1
+    assert replicas._synced[1] >= {("small", "replica lofi"), ("small", "")}
+    conditioning = stats["conditioning_cache"]
+    assert (conditioning["entries"], conditioning["hits"], conditioning["misses"]) == (2, 2, 2)
+
+
+def test_replicas_relay_streamed_chunks(api, replicas):
+    async def scenario(client):
+        response = await client.post("/generate/stream", json={"prompt": "replica stream", "duration": 4, "seed": 2})
+        return [line.split(": ", 1)[1] for line in response.text.splitlines() if line.startswith("event:")]
+
+    events = api(scenario)
+
+    assert events[0] == "start" and events[-1] == "done"
+    assert events.count("chunk") >= 2
+    assert replicas.stats()["restarts"] == 0
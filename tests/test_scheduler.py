@@ -0,0 +1,107 @@
+"""Per-client admission (ClientQuotas) on the endpoints, and InferenceScheduler's ordering"""
+
+import asyncio
+import threading
+
+import pytest
+
+from musicgen_scheduler import ClientLimitError, ClientQuotas, InferenceScheduler
+
+
+def test_client_over_its_concurrency_limit_gets_429(server, api, monkeypatch):
+    monkeypatch.setattr(server, "CLIENT_MAX_CONCURRENT", 1)
+    monkeypatch.setattr(server, "inference_queue", server.InferenceQueue(16, ClientQuotas(1, 0, 300)))
+    release = threading.Event()
+    original = server.run_batch_generation
+
+    def run_batch_generation(*args, **kwargs):
+        release.wait(30)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(server, "run_batch_generation", run_batch_generation)
+
+    async def scenario(client):
+        first = asyncio.ensure_future(client.post("/generate", json={"prompt": "a one", "duration": 1}, headers={"X-Client-Id": "a"}))
+        while server.inference_queue.admitted == 0:
+            await asyncio.sleep(0.01)
+        queue = (await client.get("/queue", headers={"X-Client-Id": "a"})).json()
+        second = await client.post("/generate", json={"prompt": "a two", "duration": 1}, headers={"X-Client-Id": "a"})
+        other = asyncio.ensure_future(client.post("/generate", json={"prompt": "b one", "duration": 1}, headers={"X-Client-Id": "b"}))
+        release.set()
+        done = await asyncio.gather(first, other)
+        after = (await client.get("/queue", headers={"X-Client-Id": "a"})).json()
+        return queue, second, done, after
+
+    queue, second, done, after = api(scenario)
+
+    assert (queue["client"], queue["active"], queue["max_concurrent"]) == ("a", 1, 1)
+    assert second.status_code == 429
+    assert second.headers["Retry-After"] == "5"
+    assert [response.json()["success"] for response in done] == [True, True]
+    assert after["active"] == 0
+
+
+def test_quota_admits_one_oversized_request_then_waits_for_refill():
+    quotas = ClientQuotas(0, rate=1.0, burst=10.0)
+
+    quotas.admit("a", 1, cost_seconds=15.0)
+    with pytest.raises(ClientLimitError) as rejected:
+        quotas.admit("a", 1, cost_seconds=1.0)
+
+    assert rejected.value.reason == "quota"
+    assert rejected.value.retry_after >= 1
+    quotas.admit("b", 1, cost_seconds=1.0)
+    assert quotas.stats()["a"]["rejected"] == 1
+
+
+def run_scheduled(scheduler: InferenceScheduler, jobs: list) -> list:
+    """
+    Occupy every slot with a "blocker" job, queue jobs as (name, audio seconds, clients,
+    delay before queueing) behind them, then let the blockers finish; returns the order run.
+    """
+    async def main():
+        order = []
+        blocked = asyncio.Event()
+
+        async def call(name: str):
+            order.append(name)
+            if name.startswith("blocker"):
+                await blocked.wait()
+
+        tasks = [asyncio.ensure_future(scheduler.run("small", 30, (f"blocker {i}",), lambda i=i: call(f"blocker {i}"))) for i in range(scheduler.slots())]
+        await asyncio.sleep(0)
+        for name, seconds, clients, delay in jobs:
+            await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(scheduler.run("small", seconds, clients, lambda name=name: call(name))))
+        await asyncio.sleep(0)
+        blocked.set()
+        await asyncio.gather(*tasks)
+        return [name for name in order if not name.startswith("blocker")]
+
+    return asyncio.run(main())
+
+
+def test_shortest_job_runs_first():
+    scheduler = InferenceScheduler(0.0, {"small": 1.0}, lambda: 1)
+
+    order = run_scheduled(scheduler, [("long", 30, ("a",), 0), ("medium", 10, ("b",), 0), ("short", 1, ("c",), 0)])
+
+    assert order == ["short", "medium", "long"]
+    assert scheduler.stats()["overtaken"] == 2
+
+
+def test_aging_lets_a_long_wait_overtake():
+    scheduler = InferenceScheduler(1000.0, {"small": 1.0}, lambda: 1)
+
+    order = run_scheduled(scheduler, [("long", 30, ("a",), 0), ("short", 1, ("b",), 0.1)])
+
+    assert order == ["long", "short"]
+
+
+def test_estimate_uses_the_model_rate():
+    scheduler = InferenceScheduler(1.0, {"small": 0.5, "large": 2.5}, lambda: 1)
+
+    assert scheduler.estimate("small", 10) == 5.0
+    assert scheduler.estimate("large", 10) == 25.0
+    # Unknown sizes are assumed to be as slow as the slowest known one
+    assert scheduler.estimate("huge", 10) == 25.0
@@ -0,0 +1,93 @@
+"""Coalescing identical in-flight generations (SingleFlight) through the /generate endpoint"""
+
+import asyncio
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def gated(server, monkeypatch):
+    """Counts run_batch_generation() calls and holds each one until the returned event is set"""
+    calls = []
+    release = threading.Event()
+    original = server.run_batch_generation
+    
+    def run_batch_generation(*args, **kwargs):
+        calls.append(args[2])
+        release.wait(30)
+        return original(*args, **kwargs)
+    
+    monkeypatch.setattr(server, "run_batch_generation", run_batch_generation)
+    yield calls, release
+    release.set()
+
+
+async def until(condition):
+    for _ in range(600):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError("timed out")
+
+
+def test_identical_requests_share_one_generation(server, api, gated):
+    calls, release = gated
+    body = {"prompt": "rainy city lofi", "duration": 2}
+    
+    async def scenario(client):
+        first = asyncio.ensure_future(client.post("/generate", json=body))
+        await until(lambda: calls)
+        joined = [asyncio.ensure_future(client.post("/generate", json=body)) for _ in range(2)]
+        await until(lambda: server.render_flights.coalesced == 2)
+        waiting = (await client.get("/stats")).json()["coalescing"]["render"]["waiting"]
+        
+        # A waiter that goes away stops counting without cancelling the generation
+        joined[1].cancel()
+        await asyncio.gather(joined[1], return_exceptions=True)
+        after_cancel = (await client.get("/stats")).json()["coalescing"]["render"]
+        
+        release.set()
+        responses = await asyncio.gather(first, joined[0])
+        done = (await client.get("/stats")).json()["coalescing"]["render"]
+        return waiting, after_cancel, responses, done
+    
+    waiting, after_cancel, responses, done = api(scenario)
+    
+    assert waiting == 2
+    assert after_cancel["waiting"] == 1
+    assert after_cancel["in_flight"] == 1
+    assert len(calls) == 1
+    metadata = [response.json()["metadata"] for response in responses]
+    assert [response.json()["success"] for response in responses] == [True, True]
+    assert [m["coalesced"] for m in metadata] == [False, True]
+    assert metadata[0]["track_id"] == metadata[1]["track_id"]
+    assert responses[0].json()["audio_base64"] == responses[1].json()["audio_base64"]
+    assert done["in_flight"] == 0
+    assert done["waiting"] == 0
+    assert done["started"] == 1
+
+
+def test_flight_waiters_drop_as_results_are_collected():
+    import musicgen_server as server
+    
+    async def scenario():
+        flights = server.SingleFlight("all")
+        gate = asyncio.Event()
+        
+        async def work(flight):
+            await gate.wait()
+            return "audio"
+        
+        flight = flights.start("key", work)
+        joined = flights.join("key", "/generate")
+        assert flights.stats()["waiting"] == 1
+        results = [asyncio.ensure_future(flight.result()), asyncio.ensure_future(joined.result())]
+        await asyncio.sleep(0)
+        gate.set()
+        return await asyncio.gather(*results), flight.waiters
+    
+    results, waiters = asyncio.run(scenario())
+    
+    assert results == ["audio", "audio"]
+    assert waiters == 0
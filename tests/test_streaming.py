@@ -0,0 +1,130 @@
+"""Token-level streaming: stream_track() and the /generate/stream SSE endpoint"""
+
+import base64
+import io
+import json
+import wave
+
+import pytest
+
+from conftest import tiny_musicgen
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("audiocraft")
+
+import musicgen_server as server
+
+
+@pytest.fixture
+def model():
+    server.init_torch()
+    return tiny_musicgen()
+
+
+def stream(model, duration: int, seed: int = 3):
+    """stream_track() of a fixed prompt, returns (codes, chunks, LM forward passes run before each chunk)"""
+    forwards = []
+    model.lm.register_forward_hook(lambda *_: forwards.append(None))
+    chunks = []
+    before = []
+    
+    def on_chunk(chunk):
+        chunks.append(chunk)
+        before.append(len(forwards))
+    
+    codes = server.stream_track(model, "rainy lofi", duration, 1.0, seed=seed, on_chunk=on_chunk)
+    return codes, chunks, before + [len(forwards)]
+
+
+def test_chunks_arrive_while_the_lm_is_sampling(model):
+    codes, chunks, forwards = stream(model, 4)
+    
+    # 100 frames: the 2 s first chunk less the cross-fade it holds back, then the rest
+    samples_per_frame = model.sample_rate // model.frame_rate
+    fade = server.long_form_frames(model.frame_rate)[2] * samples_per_frame
+    assert [chunk.shape[-1] for chunk in chunks] == [50 * samples_per_frame - fade, 50 * samples_per_frame + fade]
+    assert forwards[0] < forwards[-1] / 2 + model.lm.num_codebooks
+    assert forwards[1] == forwards[-1]
+    assert codes.shape == (model.lm.num_codebooks, 100)
+
+
+def test_streamed_track_is_the_one_shot_render(model):
+    codes, chunks, _ = stream(model, 4)
+    wav, _, tokens, _ = server.run_batch_generation(model, "small", ["rainy lofi"], 4, 1.0, "default", seed=3)
+    
+    assert torch.equal(tokens[0], codes)
+    audio = torch.cat(chunks, dim=-1)
+    assert audio.shape == wav[0].shape
+    # Only the seams differ, by the decoder's edge effects
+    assert (audio - wav[0]).abs().max() < 0.05
+
+
+def test_later_chunks_follow_stream_chunk_seconds(model, monkeypatch):
+    monkeypatch.setattr(server, "STREAM_CHUNK_SECONDS", 1)
+    
+    _, chunks, forwards = stream(model, 4)
+    
+    # 100 frames: 50, then 25 and 25
+    assert len(chunks) == 3
+    assert forwards == sorted(forwards)
+
+
+def sse_events(text: str) -> list:
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_stream_endpoint_sends_chunks_then_done(server, api, monkeypatch):
+    runs = []
+    original = server.stream_track
+    
+    def stream_track(*args, **kwargs):
+        runs.append(args[1])
+        return original(*args, **kwargs)
+    
+    monkeypatch.setattr(server, "stream_track", stream_track)
+    
+    async def scenario(client):
+        return await client.post("/generate/stream", json={"prompt": "rainy lofi", "duration": 4, "seed": 3})
+    
+    response = api(scenario)
+    events = sse_events(response.text)
+    
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert [kind for kind, _ in events] == ["start", "chunk", "chunk", "done"]
+    assert runs == ["rainy lofi"]
+    chunks = [payload for kind, payload in events if kind == "chunk"]
+    assert [chunk["start_seconds"] for chunk in chunks] == [0.0, chunks[0]["duration_seconds"]]
+    assert sum(chunk["duration_seconds"] for chunk in chunks) == pytest.approx(4)
+    with wave.open(io.BytesIO(base64.b64decode(chunks[0]["audio_base64"]))) as first:
+        assert first.getframerate() == events[0][1]["sample_rate"]
+    done = events[-1][1]
+    assert done["chunks"] == 2
+    assert done["seed"] == 3
+    assert done["time_to_first_audio_seconds"] <= done["generation_time_seconds"]
+
+
+def test_stream_decodes_with_multiband_diffusion(server, api, monkeypatch):
+    decoded = []
+    
+    class Diffusion:
+        """Stands in for MultiBand Diffusion, decoding with the model's own EnCodec"""
+        def tokens_to_wav(self, tokens):
+            decoded.append(tokens.shape[-1])
+            return server.model_pool._models["small"].generate_audio(tokens)
+    
+    monkeypatch.setattr(server, "multiband_diffusion", Diffusion)
+    
+    async def scenario(client):
+        return await client.post("/generate/stream", json={"prompt": "rainy lofi", "duration": 4, "decoder": "multiband_diffusion"})
+    
+    events = sse_events(api(scenario).text)
+    
+    # 50 frames, then the other 50 behind a lead-in of earlier codes
+    lead_frames = server.long_form_frames(25)[3]
+    assert decoded == [50, 50 + lead_frames]
+    assert [kind for kind, _ in events] == ["start", "chunk", "chunk", "done"]
+    assert events[-1][1]["decoder"] == "multiband_diffusion"